@@ -7,14 +7,18 @@ from threading import Thread
 import ob2.config as config
 import ob2.dockergrader
 import ob2.mailer
+import ob2.pushhook
 import ob2.repomanager
 import ob2.web
+from ob2.database.identifier_index import run_pruning
 from ob2.database.migrations import migrate
-from ob2.database.validation import validate_database_constraints
+from ob2.database.validation import check_query_plans, validate_database_constraints
 from ob2.dockergrader import reset_grader
 from ob2.mailer import mailer_queue
+from ob2.pushhook import pushhook_queue
 from ob2.repomanager import repomanager_queue
 from ob2.util.config_data import validate_config
+from ob2.util.resumable_queue import run_compaction
 
 from ob2.database import DbCursor  # noqa (for --ipython mode)
 from ob2.util.github_api import _get_github_admin  # noqa (for --ipython mode)
@@ -45,6 +49,9 @@ def main():
     # Validates constraints on the configuration data and database data in conjunction
     validate_database_constraints()
 
+    # Warns about queries that would need a full table scan (these usually mean a missing index)
+    check_query_plans()
+
     if config.mode == "ipython":
         # If we're running --ipython mode, STOP here (don't interfere with a server that may be
         # running simultaneuosly). Launch the IPython shell and wait for user input.
@@ -54,7 +61,7 @@ def main():
         # Run ob2 in server mode.
         #
         # First, we clean up our resumable queues by re-enqueuing any half-completed transactions.
-        # Then, we reset the state of the local Docker daemon.
+        # Then, we re-queue interrupted builds and reset the state of the local Docker daemon.
         # Then, we start all our worker threads.
         # Finally, the main thread goes to sleep until we receive a signal.
 
@@ -67,24 +74,41 @@ def main():
         if not config.github_read_only_mode:
             repomanager_queue.recover()
 
-        # Clears out stray Docker containers and images
+        # Recovers the resumable queue used for GitHub pushes that have not been turned into builds
+        pushhook_queue.recover()
+
+        # Puts interrupted builds back in the dockergrader queue, and clears out stray Docker
+        # containers and images
         reset_grader()
 
         # Start background threads for all the apps
         # Warning: Do not try to start more than 1 web thread. The web server is already threaded.
-        apps = [(ob2.dockergrader, 3),
+        # The dockergrader thread manages its own pool of worker threads (see dockergrader_workers).
+        apps = [(ob2.dockergrader, 1),
+                (ob2.pushhook, config.pushhook_workers),
                 (ob2.web, 1)]
         if config.mailer_enabled:
             apps.append((ob2.mailer, 1))
         if not config.github_read_only_mode:
             # The GitHub repo manager thread is only needed if GitHub is NOT in read-only mode
-            apps.append((ob2.repomanager, 1))
+            apps.append((ob2.repomanager, config.repomanager_workers))
         for app, num_workers in apps:
             for _ in range(num_workers):
                 worker = Thread(target=app.main)
                 worker.daemon = True
                 worker.start()
 
+        # Deletes old completed jobs from the resumable queues once a day
+        compaction = Thread(target=run_compaction,
+                            args=([mailer_queue, repomanager_queue, pushhook_queue],))
+        compaction.daemon = True
+        compaction.start()
+
+        # Deletes identifier changes that the identifier index has already read, once a day
+        pruning = Thread(target=run_pruning)
+        pruning.daemon = True
+        pruning.start()
+
         # Wait until we're asked to quit
         while True:
             try:
@@ -1,15 +1,93 @@
 import apsw
+import logging
 import ob2.config as config
 import threading
 from ob2.config.assignment import Assignment
 from ob2.database.virtual import GenericReadOnlyVTModule
 from ob2.util.hooks import apply_filters
 
-# For low-traffic applications, a global Python-level lock is the recommended
-# way to prevent database lock conflicts.
+# SQLite only allows one writer at a time, so writers are serialized with a Python-level lock
+# instead of fighting over the database file lock (and retrying on BusyError). Read-only
+# transactions do not take this lock. The database runs in WAL mode, so readers see a consistent
+# snapshot and proceed in parallel with the writer.
 global_database_lock = threading.Lock()
 
 
+class _ConnectionPool(object):
+    """
+    Keeps idle database connections around, so they can be reused by later transactions. Opening a
+    connection is expensive (it has to open the file, read the schema, and register the virtual
+    table modules), so we only want to do it once per connection.
+
+    Connections are pooled separately for each (path, read_only) pair.
+
+    """
+    # The maximum number of idle connections to keep for each (path, read_only) pair. Extra
+    # connections are closed when they are released.
+    max_idle = 16
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path, read_only):
+        """
+        Returns an idle connection from the pool, or opens a new one if the pool is empty.
+
+        """
+        with self._lock:
+            idle = self._idle.get((path, read_only))
+            if idle:
+                return idle.pop()
+        return self._connect(path, read_only)
+
+    def release(self, path, read_only, connection):
+        """
+        Returns a connection to the pool. The connection must not be in a transaction.
+
+        """
+        with self._lock:
+            idle = self._idle.setdefault((path, read_only), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """
+        Closes all idle connections.
+
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _connect(self, path, read_only):
+        if read_only:
+            flags = apsw.SQLITE_OPEN_READONLY
+        else:
+            flags = apsw.SQLITE_OPEN_CREATE | apsw.SQLITE_OPEN_READWRITE
+        connection = apsw.Connection(path, flags)
+        try:
+            connection.setbusytimeout(5000)
+            if not read_only:
+                # WAL mode is persistent (it is stored in the database file), but setting it again
+                # is harmless and makes sure that new databases get it too.
+                connection.cursor().execute("PRAGMA journal_mode = WAL").fetchall()
+            vtmodules = [DbCursor.get_assignments_vtmodule()]
+            for module in apply_filters("database-vtmodules", vtmodules):
+                module.registerWithConnection(connection)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+
+_connection_pool = _ConnectionPool()
+
+
 class DbCursor(object):
     """
     Creates a database handle with transaction semantics. Usage:
@@ -18,9 +96,12 @@ class DbCursor(object):
             c.execute("...")
             c.fetchall()
 
-    A DbCursor cannot be used more than once, since we close and flush the connection once the first
-    transaction completes. You should try to keep blocking operations (disk or network) out of the
-    transaction.
+    A DbCursor cannot be used more than once, since we return the connection to the pool once the
+    first transaction completes. You should try to keep blocking operations (disk or network) out of
+    the transaction.
+
+    If the transaction does not write anything, use DbCursor(read_only=True). Read-only transactions
+    do not wait for the global database lock, so they can run while another thread is writing.
 
     For daemon threads, you should catch apsw.Error and retry the transaction when it fails. Make
     sure that your retries are idempotent.
@@ -29,24 +110,22 @@ class DbCursor(object):
     def __init__(self, path=None, read_only=False):
         if path is None:
             path = config.database_path
-        if read_only:
-            flags = apsw.SQLITE_OPEN_READONLY
-        else:
-            flags = apsw.SQLITE_OPEN_CREATE | apsw.SQLITE_OPEN_READWRITE
+        self.path = path
+        self.read_only = read_only
+        self.after_commit_callbacks = []
 
-        # The global lock is acquired in the constructor, so you must never instantiate a DbCursor
-        # object without actually using it.
-        global_database_lock.acquire()
+        # The global lock is acquired in the constructor, so you must never instantiate a writable
+        # DbCursor object without actually using it.
+        if not read_only:
+            global_database_lock.acquire()
 
         try:
             # The connection setup must be done in the constructor, NOT in __enter__.
             # If __enter__ raises an exception, then the __exit__ method will also be called.
-            self.connection = apsw.Connection(path, flags)
-            self.connection.setbusytimeout(5000)
-            for module in apply_filters("database-vtmodules", [self.get_assignments_vtmodule()]):
-                module.registerWithConnection(self.connection)
+            self.connection = _connection_pool.acquire(path, read_only)
         except Exception:
-            global_database_lock.release()
+            if not read_only:
+                global_database_lock.release()
             raise
 
     def __enter__(self):
@@ -58,20 +137,47 @@ class DbCursor(object):
         return self
 
     def __exit__(self, *args):
+        connection = self.connection
+        del self.connection
         try:
-            self.connection.__exit__(*args)
-
-            # We need to explicitly call the destructor in order to make sure locks are freed.
-            # Otherwise, Python is free to delay the destructor until a future point in time, which may
-            # cause deadlock.
-            del self.cursor
-            del self.connection
+            try:
+                connection.__exit__(*args)
+            finally:
+                # We need to explicitly call the destructor in order to make sure locks are freed.
+                # Otherwise, Python is free to delay the destructor until a future point in time,
+                # which may cause deadlock.
+                del self.cursor
+        except Exception:
+            # We can't be sure what state the connection is in, so don't put it back in the pool.
+            connection.close(True)
+            raise
+        else:
+            _connection_pool.release(self.path, self.read_only, connection)
         finally:
-            global_database_lock.release()
+            if not self.read_only:
+                global_database_lock.release()
+        if args[0] is None:
+            for callback in self.after_commit_callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logging.exception("Error occurred in after-commit callback")
+
+    def after_commit(self, callback):
+        """
+        Registers a function (without arguments) to be called once the transaction has committed.
+        It is not called if the transaction is rolled back. Callbacks run after the global database
+        lock is released, so they should only update in-memory state.
+
+        """
+        self.after_commit_callbacks.append(callback)
 
     def execute(self, *args):
         return self.cursor.execute(*args)
 
+    def executemany(self, *args):
+        return self.cursor.executemany(*args)
+
     def fetchone(self):
         return self.cursor.fetchone()
 
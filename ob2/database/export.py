@@ -15,7 +15,7 @@ def register_export(fn):
 
 @register_export
 def student_roster_with_grades():
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute("SELECT id, name, sid, login, github, email, super FROM users")
         students = [list(student) + [None] * (2 * len(config.assignments))
                     for student in c.fetchall()]
@@ -44,7 +44,7 @@ def student_roster_with_grades():
 
 @register_export
 def repo_best_builds():
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute('''SELECT build_name, source, `commit`, message, job, status, score
                      FROM builds ORDER BY started ASC''')
         builds = c.fetchall()
@@ -65,7 +65,7 @@ def repo_best_builds():
 if config.groups_enabled:
     @register_export
     def group_names_and_emails():
-        with DbCursor() as c:
+        with DbCursor(read_only=True) as c:
             c.execute("""SELECT groupsusers.`group`, GROUP_CONCAT(users.id, "|"),
                          GROUP_CONCAT(users.name, "|"), GROUP_CONCAT(users.sid, "|"),
                          GROUP_CONCAT(users.login, "|"), GROUP_CONCAT(users.github, "|"),
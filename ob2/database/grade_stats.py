@@ -0,0 +1,170 @@
+"""
+An in-memory cache of grade statistics for each assignment (count, mean, standard deviation, rank,
+and the score histogram), so that assignment pages do not scan the grades table on every view.
+
+Triggers on the grades and users tables increment a version number for the assignment whenever its
+grades change (see migration 17). Cached statistics are only used if their version matches the
+version in the database. When grades are assigned with assign_grade_batch or assign_grades_bulk, the
+cache is updated incrementally once the transaction commits. Any other change (for example, from the
+sqlite3 shell) makes the cache rebuild the statistics for that assignment the next time they are
+needed.
+
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from math import sqrt
+from threading import Lock
+
+
+class _AssignmentStats(object):
+    def __init__(self, version):
+        self.version = version
+        # These only include non-null scores, of all users (including staff)
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.scores = []
+        # The scores of students only (not staff), for the histogram
+        self.student_scores = []
+        # Histograms computed from student_scores, which are thrown away when the scores change
+        self.histograms = {}
+
+    def add(self, score, is_student):
+        self.count += 1
+        self.total += score
+        self.total_squares += score * score
+        insort(self.scores, score)
+        if is_student:
+            insort(self.student_scores, score)
+
+    def remove(self, score, is_student):
+        self.count -= 1
+        self.total -= score
+        self.total_squares -= score * score
+        del self.scores[bisect_left(self.scores, score)]
+        if is_student:
+            del self.student_scores[bisect_left(self.student_scores, score)]
+
+
+class _GradeStatsCache(object):
+    # The maximum number of ids to put in one "IN (...)" clause (SQLite allows 999 parameters)
+    chunk_size = 500
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}
+
+    def _get_version(self, c, assignment):
+        c.execute("SELECT version FROM gradesversions WHERE assignment = ?", [assignment])
+        row = c.fetchone()
+        return row[0] if row else 0
+
+    def _get_stats(self, c, assignment):
+        """
+        Returns up-to-date statistics for ASSIGNMENT, as seen by the transaction of C. Must be
+        called with the lock held.
+
+        """
+        version = self._get_version(c, assignment)
+        stats = self._stats.get(assignment)
+        if stats is not None and stats.version == version:
+            return stats
+        stats = _AssignmentStats(version)
+        c.execute('''SELECT grades.score, users.super
+                     FROM grades LEFT JOIN users ON grades.user = users.id
+                     WHERE grades.assignment = ? AND grades.score IS NOT NULL''', [assignment])
+        for score, super_ in c.fetchall():
+            stats.add(score, super_ == 0)
+        # An older transaction may be rebuilding an older version, which should not replace the
+        # newer one in the cache.
+        cached = self._stats.get(assignment)
+        if cached is None or cached.version <= version:
+            self._stats[assignment] = stats
+        return stats
+
+    def get_summary(self, c, assignment):
+        """
+        Returns (count, mean, standard deviation) of the scores for ASSIGNMENT. The mean and the
+        standard deviation are None if there are no scores.
+
+        """
+        with self._lock:
+            stats = self._get_stats(c, assignment)
+            if stats.count == 0:
+                return 0, None, None
+            mean = stats.total / stats.count
+            variance = max(stats.total_squares / stats.count - mean * mean, 0.0)
+            return stats.count, mean, sqrt(variance)
+
+    def get_rank(self, c, assignment, score):
+        """
+        Returns the rank of SCORE among the scores for ASSIGNMENT (1 plus the number of higher
+        scores).
+
+        """
+        with self._lock:
+            stats = self._get_stats(c, assignment)
+            return len(stats.scores) - bisect_right(stats.scores, score) + 1
+
+    def get_histogram(self, c, assignment, key, compute):
+        """
+        Returns COMPUTE(student_scores), where STUDENT_SCORES is a sorted list of the scores of
+        students (not staff) for ASSIGNMENT. The result is remembered under KEY until the scores
+        change, so COMPUTE should not modify its argument.
+
+        """
+        with self._lock:
+            stats = self._get_stats(c, assignment)
+            if key not in stats.histograms:
+                stats.histograms[key] = compute(stats.student_scores)
+            return stats.histograms[key]
+
+    def _get_scores(self, c, assignment, users):
+        scores = {}
+        for i in range(0, len(users), self.chunk_size):
+            chunk = users[i:i + self.chunk_size]
+            c.execute('''SELECT grades.user, grades.score, users.super
+                         FROM grades LEFT JOIN users ON grades.user = users.id
+                         WHERE grades.assignment = ? AND grades.user IN (%s)''' %
+                      ",".join(["?"] * len(chunk)), [assignment] + chunk)
+            scores.update((user, (score, super_ == 0)) for user, score, super_ in c.fetchall())
+        return scores
+
+    def begin_update(self, c, assignment, users):
+        """
+        Remembers the current scores of USERS, before they are changed in the transaction of C.
+        Returns an opaque object, which should be passed to finish_update() after the change.
+
+        """
+        users = list(users)
+        return (assignment, users, self._get_version(c, assignment),
+                self._get_scores(c, assignment, users))
+
+    def finish_update(self, c, update):
+        """
+        Updates the cache with the new scores once the transaction of C commits.
+
+        """
+        assignment, users, old_version, old_scores = update
+        new_version = self._get_version(c, assignment)
+        new_scores = self._get_scores(c, assignment, users)
+        c.after_commit(lambda: self._apply(assignment, old_version, new_version, old_scores,
+                                           new_scores))
+
+    def _apply(self, assignment, old_version, new_version, old_scores, new_scores):
+        with self._lock:
+            stats = self._stats.get(assignment)
+            # If the cache missed some other change, it will be rebuilt the next time it is used.
+            if stats is None or stats.version != old_version:
+                return
+            for score, is_student in old_scores.values():
+                if score is not None:
+                    stats.remove(score, is_student)
+            for score, is_student in new_scores.values():
+                if score is not None:
+                    stats.add(score, is_student)
+            stats.version = new_version
+            stats.histograms = {}
+
+
+grade_stats = _GradeStatsCache()
@@ -6,13 +6,16 @@ ensuring the proper transaction semantics are preserved and lock starvation is m
 
 """
 
+import zlib
 from collections import Counter
 
-from ob2.util.time import now_str
+from ob2.database.grade_stats import grade_stats
+from ob2.util.time import now_timestamp
 from ob2.util.assignments import get_assignment_name_set
 from ob2.util.build_constants import QUEUED
 from ob2.util.config_data import get_repo_type
 from ob2.util.group_constants import ACCEPTED
+from ob2.util.pubsub import publish_build_status
 
 
 def get_next_autoincrementing_value(c, option_name):
@@ -30,6 +33,73 @@ def get_next_autoincrementing_value(c, option_name):
     return next_value
 
 
+def get_next_autoincrementing_values(c, option_name, count):
+    """
+    Same as get_next_autoincrementing_value, but reserves COUNT values at once and returns them as a
+    list.
+
+    """
+    if count == 0:
+        return []
+    first_value = get_next_autoincrementing_value(c, option_name)
+    last_value = first_value + count - 1
+    c.execute('''UPDATE options SET value = ? WHERE key = ?''', [str(last_value), option_name])
+    return range(first_value, last_value + 1)
+
+
+def get_page(c, columns, table, order_column, page_size, joins="", where="", args=[],
+             after=None, before=None):
+    """
+    Runs a paginated query over TABLE, newest first, ordered by (ORDER_COLUMN, rowid). This is
+    keyset pagination: instead of an offset, a page starts right after (or right before) the row
+    with the rowid AFTER (or BEFORE). So, every page costs the same, no matter how deep it is, as
+    long as there is an index on ORDER_COLUMN (or on the columns in WHERE, followed by
+    ORDER_COLUMN).
+
+        columns      -- The columns to select, like "build_name, status"
+        joins        -- Added after the table name, like "LEFT JOIN users ON ..."
+        where        -- A condition, like "builds.job = ?", using ARGS for its parameters
+
+    Returns (rows, prev_cursor, next_cursor). The cursors should be passed as BEFORE or AFTER to get
+    the previous or next page. They are None if there is no such page. Raises ValueError if both
+    AFTER and BEFORE are given.
+
+    """
+    if after is not None and before is not None:
+        raise ValueError("Only one of after and before can be given")
+    key = "%s.%s" % (table, order_column)
+    rowid = "%s.rowid" % table
+    conditions = [where] if where else []
+    params = list(args)
+    cursor = after if after is not None else before
+    if cursor is not None:
+        op = "<" if after is not None else ">"
+        # Sqlite 3.9 has no row values, so the comparison of (key, rowid) is spelled out. The
+        # first half of it lets sqlite start searching the index at the cursor.
+        value = "(SELECT %s FROM %s WHERE rowid = ?)" % (order_column, table)
+        conditions.append("%s %s= %s AND (%s %s %s OR %s %s ?)" %
+                          (key, op, value, key, op, value, rowid, op))
+        params += [cursor, cursor, cursor]
+    direction = "ASC" if before is not None else "DESC"
+    c.execute('''SELECT %s, %s FROM %s %s %s
+                 ORDER BY %s %s, %s %s LIMIT ?''' %
+              (columns, rowid, table, joins,
+               "WHERE " + " AND ".join(conditions) if conditions else "",
+               key, direction, rowid, direction),
+              params + [page_size + 1])
+    rows = c.fetchall()
+    more_rows = len(rows) > page_size
+    rows = rows[:page_size]
+    if before is not None:
+        rows.reverse()
+        has_prev, has_next = more_rows, True
+    else:
+        has_prev, has_next = after is not None, more_rows
+    prev_cursor = rows[0][-1] if rows and has_prev else None
+    next_cursor = rows[-1][-1] if rows and has_next else None
+    return [row[:-1] for row in rows], prev_cursor, next_cursor
+
+
 def get_repo_owners(c, repo_name):
     """
     Given the name of a repository, return the list of users (user id's) that own the repository.
@@ -96,9 +166,15 @@ def get_user_by_id(c, user_id):
 
 
 def get_users_by_ids(c, user_ids):
-    c.execute('''SELECT id, name, sid, login, github, email FROM users
-                 WHERE id IN (%s)''' % (",".join(["?"] * len(user_ids))), user_ids)
-    return {row[0]: row for row in c.fetchall()}
+    user_ids = list(user_ids)
+    users = {}
+    # Stays well under SQLite's limit on the number of parameters in one statement
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        c.execute('''SELECT id, name, sid, login, github, email FROM users
+                     WHERE id IN (%s)''' % (",".join(["?"] * len(chunk))), chunk)
+        users.update((row[0], row) for row in c.fetchall())
+    return users
 
 
 def get_user_by_github(c, github):
@@ -123,7 +199,7 @@ def get_users_by_identifier(c, identifier):
     """
     Looks up a list of users based on an identifier, for the enter-grades script. If the identifier
     is ambiguous (see get_valid_ambiguous_identifiers), then the behavior of this function is
-    undefined.
+    undefined. To look up many identifiers, use identifier_index.resolve() instead.
 
     Always returns a list (but it may be empty).
 
@@ -173,16 +249,68 @@ def get_photo(c, user_id):
         pass
 
 
+def commit_has_build(c, job_name, source, commit):
+    """
+    Returns whether the commit has been built for the job before (regardless of the result).
+
+    """
+    c.execute('''SELECT 1 FROM builds WHERE job = ? AND source = ? AND `commit` = ?
+                 LIMIT 1''', [job_name, source, commit])
+    return c.fetchone() is not None
+
+
+def get_build_for_commit(c, job_name, source, commit, statuses):
+    """
+    Returns the name of the most recent build of the commit for the job, whose status is one of
+    STATUSES. Returns None if there is no such build.
+
+    """
+    c.execute('''SELECT build_name FROM builds
+                 WHERE job = ? AND source = ? AND `commit` = ? AND status IN (%s)
+                 ORDER BY started DESC LIMIT 1''' % (",".join(["?"] * len(statuses))),
+              [job_name, source, commit] + list(statuses))
+    try:
+        build_name, = c.fetchone()
+        return build_name
+    except TypeError:
+        pass
+
+
 def create_build(c, job_name, source, commit, message):
     build_number = get_next_autoincrementing_value(c, "dockergrader_last_build_number")
     build_name = "%s-build-%d" % (job_name, build_number)
     c.execute('''INSERT INTO builds (build_name, source, `commit`, message, job, status, score,
                  started, updated, log) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              [build_name, source, commit, message, job_name, QUEUED, 0.0, now_str(),
-               now_str(), None])
+              [build_name, source, commit, message, job_name, QUEUED, 0.0, now_timestamp(),
+               now_timestamp(), None])
+    c.after_commit(lambda: publish_build_status(source, build_name, job_name, QUEUED))
     return build_name
 
 
+def get_build_log(c, build_name):
+    """
+    Returns the log of a build (as a byte string), or None if the build does not have a log yet.
+
+    """
+    c.execute("SELECT log FROM buildlogs WHERE build_name = ?", [build_name])
+    row = c.fetchone()
+    if row is None:
+        return None
+    return zlib.decompress(row[0])
+
+
+def set_build_log(c, build_name, log):
+    """
+    Saves the log of a build. Logs are kept compressed in the buildlogs table, so that the builds
+    table stays small and quick to scan.
+
+    """
+    if isinstance(log, unicode):
+        log = log.encode("utf-8")
+    c.execute("INSERT OR REPLACE INTO buildlogs (build_name, log) VALUES (?, ?)",
+              [build_name, buffer(zlib.compress(str(log)))])
+
+
 def assign_grade_batch(c, users, assignment, score, slipunits, transaction_name, description,
                        source, manual=False, dont_lower=False):
     """
@@ -200,7 +328,7 @@ def assign_grade_batch(c, users, assignment, score, slipunits, transaction_name,
         return []
     if score is None and slipunits is None:
         return []
-    timestamp = now_str()
+    timestamp = now_timestamp()
 
     if dont_lower:
         if score is None:
@@ -219,6 +347,7 @@ def assign_grade_batch(c, users, assignment, score, slipunits, transaction_name,
         if not users:
             return []
 
+    stats_update = grade_stats.begin_update(c, assignment, users)
     c.execute('''SELECT users.id FROM grades LEFT JOIN users
                  ON grades.user = users.id WHERE grades.assignment = ? AND users.id IN (%s)''' %
               (','.join(["?"] * len(users))), [assignment] + users)
@@ -247,4 +376,61 @@ def assign_grade_batch(c, users, assignment, score, slipunits, transaction_name,
               [field for entry in [[transaction_name, description, source, timestamp, user,
                                     assignment, score, slipunits]
                                    for user in users] for field in entry])
+    grade_stats.finish_update(c, stats_update)
     return users
+
+
+def assign_grades_bulk(c, entries, assignment, transaction_name, description, source,
+                       manual=False, dont_lower=False):
+    """
+    Assigns grades to many students at once, where every student can get a different score. This
+    works like assign_grade_batch, but ENTRIES is a list of (user, score, slipunits) tuples. Either
+    score or slipunits can be `None` to keep the current value.
+
+    Each statement is prepared once and run for all of the entries (with executemany), so this
+    takes a constant number of statements, no matter how many entries there are.
+
+    Returns a list of user ids whose grades were affected.
+
+    """
+    if assignment not in get_assignment_name_set():
+        raise ValueError("Assignment %s is not known" % assignment)
+    entries = [(user, score, slipunits) for user, score, slipunits in entries
+               if score is not None or slipunits is not None]
+    if not entries:
+        return []
+    timestamp = now_timestamp()
+
+    if dont_lower:
+        if any(score is None for _, score, _ in entries):
+            raise ValueError("You can not use both dont_lower=True and have a score of None, if " +
+                             "slipunits is not None.")
+
+        # Like in assign_grade_batch, the old score and the new score MUST be compared in Sqlite.
+        c.executemany('''SELECT user FROM grades
+                         WHERE assignment = ? AND user = ? AND score >= ?''',
+                      [(assignment, user, score) for user, score, _ in entries])
+        higher = {user for user, in c.fetchall()}
+        entries = [entry for entry in entries if entry[0] not in higher]
+        if not entries:
+            return []
+
+    stats_update = grade_stats.begin_update(c, assignment, [user for user, _, _ in entries])
+
+    # Sqlite 3.9 does not support UPSERT, so we insert dummy values for users that don't have a
+    # grade yet, and then update everybody.
+    c.executemany("INSERT OR IGNORE INTO grades (user, assignment) VALUES (?, ?)",
+                  [(user, assignment) for user, _, _ in entries])
+    c.executemany('''UPDATE grades SET updated = ?, manual = ?, score = COALESCE(?, score),
+                                       slipunits = COALESCE(?, slipunits)
+                     WHERE assignment = ? AND user = ?''',
+                  [(timestamp, int(manual), score, slipunits, assignment, user)
+                   for user, score, slipunits in entries])
+    c.executemany('''INSERT INTO gradeslog (transaction_name, description, source, updated, user,
+                                            assignment, score, slipunits)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [(transaction_name, description, source, timestamp, user, assignment, score,
+                    slipunits)
+                   for user, score, slipunits in entries])
+    grade_stats.finish_update(c, stats_update)
+    return [user for user, _, _ in entries]
@@ -0,0 +1,220 @@
+"""
+An in-memory index of the identifiers (SIDs, logins, names, and group names) that TAs can use to
+refer to students when entering grades.
+
+The users and groupsusers tables are usually edited by hand, with the sqlite3 shell. So, instead of
+invalidating the index from our own code, triggers on both tables record every change in the
+identifierchanges table (see migration 16). Before each use, the index reads the changes that it has
+not seen yet, and only reloads the affected users and groups. Changes that the index has already
+read are deleted once a day (see run_pruning).
+
+"""
+
+import logging
+from collections import Counter
+from threading import Lock
+from time import sleep
+
+from ob2.database import DbCursor
+
+USER_FIELDS = "id, name, sid, login, github, email"
+
+
+class _IdentifierIndex(object):
+    # If more than this many changes are waiting, it is cheaper to rebuild the whole index
+    max_incremental_changes = 1000
+
+    # The maximum number of ids to put in one "IN (...)" clause (SQLite allows 999 parameters)
+    chunk_size = 500
+
+    def __init__(self):
+        self._lock = Lock()
+        self._last_change = None
+        # user id -> (id, name, sid, login, github, email)
+        self._users = {}
+        # group name -> set of user ids
+        self._groups = {}
+        # identifier -> list of user ids (for sid, login, and name)
+        self._user_identifiers = {}
+        # identifier -> number of users and groups that use it
+        self._counter = Counter()
+
+    def refresh(self):
+        """
+        Brings the index up to date with the database. The index is read in its own transaction, so
+        it only ever contains committed data.
+
+        """
+        with self._lock:
+            with DbCursor(read_only=True) as c:
+                if self._last_change is None:
+                    self._rebuild(c)
+                    return
+                c.execute('''SELECT COUNT(*), (SELECT MIN(id) FROM identifierchanges)
+                             FROM identifierchanges WHERE id > ?''', [self._last_change])
+                count, first_change = c.fetchone()
+                # If changes that we have not seen were pruned (by another process), the index has
+                # to be rebuilt.
+                missed_changes = first_change is not None and first_change > self._last_change + 1
+                if missed_changes or count > self.max_incremental_changes:
+                    self._rebuild(c)
+                elif count:
+                    self._apply_changes(c)
+
+    def _rebuild(self, c):
+        c.execute("SELECT MAX(id) FROM identifierchanges")
+        last_change, = c.fetchone()
+        self._last_change = last_change or 0
+        self._users = {}
+        self._groups = {}
+        self._user_identifiers = {}
+        self._counter = Counter()
+        c.execute("SELECT %s FROM users" % USER_FIELDS)
+        for user in c.fetchall():
+            self._add_user(user)
+        c.execute("SELECT `group`, user FROM groupsusers")
+        for group, user_id in c.fetchall():
+            self._add_group_member(group, user_id)
+
+    def _apply_changes(self, c):
+        c.execute('''SELECT id, user, `group` FROM identifierchanges
+                     WHERE id > ? ORDER BY id''', [self._last_change])
+        user_ids, groups = set(), set()
+        for change_id, user_id, group in c.fetchall():
+            if user_id is not None:
+                user_ids.add(user_id)
+            if group is not None:
+                groups.add(group)
+            self._last_change = change_id
+        user_ids, groups = list(user_ids), list(groups)
+
+        for user_id in user_ids:
+            self._remove_user(user_id)
+        for i in range(0, len(user_ids), self.chunk_size):
+            chunk = user_ids[i:i + self.chunk_size]
+            c.execute("SELECT %s FROM users WHERE id IN (%s)" %
+                      (USER_FIELDS, ",".join(["?"] * len(chunk))), chunk)
+            for user in c.fetchall():
+                self._add_user(user)
+
+        for group in groups:
+            self._remove_group(group)
+        for i in range(0, len(groups), self.chunk_size):
+            chunk = groups[i:i + self.chunk_size]
+            c.execute("SELECT `group`, user FROM groupsusers WHERE `group` IN (%s)" %
+                      ",".join(["?"] * len(chunk)), chunk)
+            for group, user_id in c.fetchall():
+                self._add_group_member(group, user_id)
+
+    def _add_user(self, user):
+        user_id, name, sid, login, _, _ = user
+        self._users[user_id] = user
+        for identifier in (sid, login, name):
+            if identifier:
+                self._counter[identifier] += 1
+                self._user_identifiers.setdefault(identifier, []).append(user_id)
+
+    def _remove_user(self, user_id):
+        user = self._users.pop(user_id, None)
+        if user is None:
+            return
+        _, name, sid, login, _, _ = user
+        for identifier in (sid, login, name):
+            if identifier:
+                self._decrement(identifier)
+                user_ids = self._user_identifiers[identifier]
+                user_ids.remove(user_id)
+                if not user_ids:
+                    del self._user_identifiers[identifier]
+
+    def _add_group_member(self, group, user_id):
+        if not group:
+            return
+        if group not in self._groups:
+            self._groups[group] = set()
+            self._counter[group] += 1
+        self._groups[group].add(user_id)
+
+    def _remove_group(self, group):
+        if self._groups.pop(group, None) is not None:
+            self._decrement(group)
+
+    def _decrement(self, identifier):
+        self._counter[identifier] -= 1
+        if self._counter[identifier] <= 0:
+            del self._counter[identifier]
+
+    def get_valid_ambiguous_identifiers(self):
+        """
+        Returns (valid_identifiers, ambiguous_identifiers). An identifier is valid if it refers to
+        exactly one student or group, and ambiguous if it refers to more than one.
+
+        """
+        self.refresh()
+        with self._lock:
+            valid_identifiers = [identifier for identifier, count in self._counter.iteritems()
+                                 if count == 1]
+            ambiguous_identifiers = [identifier for identifier, count in self._counter.iteritems()
+                                     if count > 1]
+        return valid_identifiers, ambiguous_identifiers
+
+    def resolve(self, identifiers):
+        """
+        Looks up many identifiers at once, for the enter-grades script. Returns a dictionary that
+        maps each identifier to a list of users (which may be empty). The behavior is undefined for
+        ambiguous identifiers, just like get_users_by_identifier.
+
+        """
+        self.refresh()
+        result = {}
+        with self._lock:
+            for identifier in identifiers:
+                if identifier in result:
+                    continue
+                if identifier in self._user_identifiers:
+                    user_ids = self._user_identifiers[identifier][:1]
+                else:
+                    user_ids = sorted(self._groups.get(identifier, ()))
+                result[identifier] = [self._users[user_id] for user_id in user_ids
+                                      if user_id in self._users]
+        return result
+
+    def prune(self):
+        """
+        Deletes the changes that the index has already read, except for the last one (so that
+        other processes can tell that changes were deleted). Returns the number of deleted changes.
+
+        The ids of the changes only ever increase (the column is AUTOINCREMENT), so changes that
+        the triggers record after the index was refreshed are never deleted. An index in another
+        process that has not read some of the deleted changes rebuilds itself (see refresh).
+
+        This writes to the database, so it must not be called inside a transaction.
+
+        """
+        self.refresh()
+        with self._lock:
+            last_change = self._last_change
+        with DbCursor() as c:
+            c.execute("DELETE FROM identifierchanges WHERE id < ?", [last_change])
+            c.execute("SELECT changes()")
+            deleted, = c.fetchone()
+        return deleted
+
+
+identifier_index = _IdentifierIndex()
+
+
+def run_pruning(interval=86400):
+    """
+    Prunes the identifierchanges table once every INTERVAL seconds. This runs forever, so start it
+    on a background thread.
+
+    """
+    while True:
+        try:
+            deleted = identifier_index.prune()
+            if deleted:
+                logging.info("Deleted %d old identifier changes" % deleted)
+        except Exception:
+            logging.exception("Error occurred while pruning identifier changes")
+        sleep(interval)
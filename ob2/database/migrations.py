@@ -1,5 +1,8 @@
+import re
 import sys
+import zlib
 from ob2.database import DbCursor
+from ob2.util.time import to_timestamp
 
 
 def migrate():
@@ -102,3 +105,217 @@ def migrate():
             c.execute("ALTER TABLE users ADD COLUMN photo BLOB;")
             c.execute("UPDATE options SET value = '9' WHERE key = 'schema_version'")
             schema_version = "9"
+
+        # Migration 10: Add indexes for the most common queries
+        if schema_version == "9":
+            print "Running migration 10: Add indexes for the most common queries"
+            c.execute("CREATE INDEX builds_build_name ON builds (build_name)")
+            c.execute("CREATE INDEX builds_job_source_started ON builds (job, source, started)")
+            c.execute("CREATE INDEX builds_source_started ON builds (source, started)")
+            c.execute("CREATE INDEX gradeslog_user_updated ON gradeslog (user, updated)")
+            c.execute("CREATE INDEX grades_assignment_score ON grades (assignment, score)")
+            c.execute("CREATE INDEX groupsusers_group ON groupsusers (`group`)")
+            c.execute("CREATE INDEX invitations_user ON invitations (user)")
+            c.execute("UPDATE options SET value = '10' WHERE key = 'schema_version'")
+            schema_version = "10"
+
+        # Migration 11: Create dockergraderqueue table
+        if schema_version == "10":
+            print "Running migration 11: Create dockergraderqueue table"
+            c.execute('''CREATE TABLE dockergraderqueue (build_name TEXT PRIMARY KEY, source TEXT,
+                         `trigger` TEXT, priority INT, updated TEXT, worker TEXT)''')
+            c.execute("CREATE INDEX dockergraderqueue_source ON dockergraderqueue (source)")
+            c.execute("UPDATE options SET value = '11' WHERE key = 'schema_version'")
+            schema_version = "11"
+
+        # Migration 12: Add lease expiration to dockergraderqueue
+        if schema_version == "11":
+            print "Running migration 12: Add lease expiration to dockergraderqueue"
+            c.execute("ALTER TABLE dockergraderqueue ADD COLUMN lease_expires REAL")
+            c.execute("UPDATE options SET value = '12' WHERE key = 'schema_version'")
+            schema_version = "12"
+
+        # Migration 13: Create pushhookqueue table
+        if schema_version == "12":
+            print "Running migration 13: Create pushhookqueue table"
+            c.execute('''CREATE TABLE pushhookqueue (id INT PRIMARY KEY, operation TEXT,
+                         payload TEXT, updated TEXT, completed INT)''')
+            c.execute("UPDATE options SET value = '13' WHERE key = 'schema_version'")
+            schema_version = "13"
+
+        # Migration 14: Add 'attempts' field to resumable queues
+        if schema_version == "13":
+            print "Running migration 14: Add 'attempts' field to resumable queues"
+            for table in ("repomanager", "mailerqueue", "pushhookqueue"):
+                c.execute("ALTER TABLE %s ADD COLUMN attempts INT DEFAULT 0" % table)
+            c.execute("UPDATE options SET value = '14' WHERE key = 'schema_version'")
+            schema_version = "14"
+
+        # Migration 15: Add indexes on resumable queue status
+        if schema_version == "14":
+            print "Running migration 15: Add indexes on resumable queue status"
+            for table in ("repomanager", "mailerqueue", "pushhookqueue"):
+                c.execute("CREATE INDEX %s_completed ON %s (completed, id)" % (table, table))
+            c.execute("UPDATE options SET value = '15' WHERE key = 'schema_version'")
+            schema_version = "15"
+
+        # Migration 16: Create identifierchanges table and triggers
+        if schema_version == "15":
+            print "Running migration 16: Create identifierchanges table and triggers"
+            c.execute('''CREATE TABLE identifierchanges (
+                         id INTEGER PRIMARY KEY AUTOINCREMENT, user INT, `group` TEXT)''')
+            c.execute('''CREATE TRIGGER users_insert_identifierchanges AFTER INSERT ON users
+                         BEGIN
+                             INSERT INTO identifierchanges (user) VALUES (NEW.id);
+                         END''')
+            c.execute('''CREATE TRIGGER users_update_identifierchanges
+                         AFTER UPDATE OF id, name, sid, login, github, email ON users
+                         BEGIN
+                             INSERT INTO identifierchanges (user) VALUES (OLD.id);
+                             INSERT INTO identifierchanges (user) VALUES (NEW.id);
+                         END''')
+            c.execute('''CREATE TRIGGER users_delete_identifierchanges AFTER DELETE ON users
+                         BEGIN
+                             INSERT INTO identifierchanges (user) VALUES (OLD.id);
+                         END''')
+            c.execute('''CREATE TRIGGER groupsusers_insert_identifierchanges
+                         AFTER INSERT ON groupsusers
+                         BEGIN
+                             INSERT INTO identifierchanges (`group`) VALUES (NEW.`group`);
+                         END''')
+            c.execute('''CREATE TRIGGER groupsusers_update_identifierchanges
+                         AFTER UPDATE ON groupsusers
+                         BEGIN
+                             INSERT INTO identifierchanges (`group`) VALUES (OLD.`group`);
+                             INSERT INTO identifierchanges (`group`) VALUES (NEW.`group`);
+                         END''')
+            c.execute('''CREATE TRIGGER groupsusers_delete_identifierchanges
+                         AFTER DELETE ON groupsusers
+                         BEGIN
+                             INSERT INTO identifierchanges (`group`) VALUES (OLD.`group`);
+                         END''')
+            c.execute("UPDATE options SET value = '16' WHERE key = 'schema_version'")
+            schema_version = "16"
+
+        # Migration 17: Create gradesversions table and triggers
+        if schema_version == "16":
+            print "Running migration 17: Create gradesversions table and triggers"
+            c.execute('''CREATE TABLE gradesversions (
+                         assignment TEXT PRIMARY KEY, version INT)''')
+            # Increments the version of each assignment in (%s), which is a SELECT statement
+            bump = '''INSERT OR IGNORE INTO gradesversions (assignment, version)
+                          SELECT assignment, 0 FROM (%s);
+                      UPDATE gradesversions SET version = version + 1
+                          WHERE assignment IN (%s);'''
+            for name, event, assignments in [
+                    ("grades_insert", "INSERT ON grades", "SELECT NEW.assignment AS assignment"),
+                    ("grades_update", "UPDATE OF user, assignment, score ON grades",
+                     "SELECT OLD.assignment AS assignment UNION SELECT NEW.assignment"),
+                    ("grades_delete", "DELETE ON grades", "SELECT OLD.assignment AS assignment"),
+                    # The histograms do not include staff, so they change with users.super
+                    ("users_insert", "INSERT ON users",
+                     "SELECT assignment FROM grades WHERE user = NEW.id"),
+                    ("users_update", "UPDATE OF id, super ON users",
+                     "SELECT assignment FROM grades WHERE user IN (OLD.id, NEW.id)"),
+                    ("users_delete", "DELETE ON users",
+                     "SELECT assignment FROM grades WHERE user = OLD.id")]:
+                c.execute("CREATE TRIGGER %s_gradesversions AFTER %s BEGIN %s END" %
+                          (name, event, bump % (assignments, assignments)))
+            c.execute("UPDATE options SET value = '17' WHERE key = 'schema_version'")
+            schema_version = "17"
+
+        # Migration 18: Move build logs to the buildlogs table
+        if schema_version == "17":
+            print "Running migration 18: Move build logs to the buildlogs table"
+            c.execute("CREATE TABLE buildlogs (build_name TEXT PRIMARY KEY, log BLOB)")
+            # The logs are moved a few at a time, so they don't all have to fit in memory.
+            last_rowid = -1
+            while True:
+                c.execute('''SELECT rowid, build_name, log FROM builds
+                             WHERE rowid > ? AND log IS NOT NULL ORDER BY rowid LIMIT 100''',
+                          [last_rowid])
+                rows = c.fetchall()
+                if not rows:
+                    break
+                for _, build_name, log in rows:
+                    if isinstance(log, unicode):
+                        log = log.encode("utf-8")
+                    c.execute("INSERT OR REPLACE INTO buildlogs (build_name, log) VALUES (?, ?)",
+                              [build_name, buffer(zlib.compress(str(log)))])
+                last_rowid = rows[-1][0]
+            # Sqlite can't drop columns, so the old column is just emptied. Run VACUUM afterwards to
+            # shrink the database file.
+            c.execute("UPDATE builds SET log = NULL")
+            c.execute("UPDATE options SET value = '18' WHERE key = 'schema_version'")
+            schema_version = "18"
+
+        # Migration 19: Add indexes for the paginated builds and gradeslog listings
+        if schema_version == "18":
+            print "Running migration 19: Add indexes for paginated listings"
+            c.execute("CREATE INDEX builds_started ON builds (started)")
+            c.execute("CREATE INDEX builds_job_started ON builds (job, started)")
+            c.execute("CREATE INDEX gradeslog_updated ON gradeslog (updated)")
+            c.execute("UPDATE options SET value = '19' WHERE key = 'schema_version'")
+            schema_version = "19"
+
+        # Migration 20: Store timestamps as seconds since the epoch
+        if schema_version == "19":
+            print "Running migration 20: Store timestamps as seconds since the epoch"
+            for table, columns in [("gradeslog", ["updated"]),
+                                   ("grades", ["updated"]),
+                                   ("builds", ["started", "updated"]),
+                                   ("repomanager", ["updated"]),
+                                   ("mailerqueue", ["updated"]),
+                                   ("dockergraderqueue", ["updated"]),
+                                   ("pushhookqueue", ["updated"])]:
+                _convert_timestamps(c, table, columns)
+            c.execute("UPDATE options SET value = '20' WHERE key = 'schema_version'")
+            schema_version = "20"
+
+
+def _convert_timestamps(c, table, columns):
+    """
+    Changes the type of COLUMNS in TABLE from TEXT to INT, and converts their values from serialized
+    datetimes to seconds since the epoch. Sqlite can't change the type of a column (and a TEXT
+    column would turn the integers back into strings), so the table is copied into a new one,
+    keeping its rowids, indexes, and triggers.
+
+    """
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", [table])
+    create_table, = c.fetchone()
+    for column in columns:
+        create_table, count = re.subn(r"\b%s TEXT\b" % column, "%s INT" % column, create_table)
+        assert count == 1, "Could not find column %s.%s" % (table, column)
+    c.execute('''SELECT sql FROM sqlite_master
+                 WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL''',
+              [table])
+    create_others = [sql for sql, in c.fetchall()]
+    c.execute("PRAGMA table_info(%s)" % table)
+    names = [name for _, name, _, _, _, _ in c.fetchall()]
+    positions = [names.index(column) for column in columns]
+
+    c.execute("CREATE TEMP TABLE migration_copy AS SELECT rowid AS old_rowid, * FROM %s" % table)
+    c.execute("DROP TABLE %s" % table)
+    c.execute(create_table)
+    insert = "INSERT INTO %s (rowid, %s) VALUES (?, %s)" % (
+        table, ", ".join("`%s`" % name for name in names), ", ".join(["?"] * len(names)))
+    # The rows are copied a few at a time, so they don't all have to fit in memory.
+    last_rowid = 0
+    while True:
+        c.execute('''SELECT rowid, * FROM migration_copy
+                     WHERE rowid > ? ORDER BY rowid LIMIT 1000''', [last_rowid])
+        rows = c.fetchall()
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            row = list(row[1:])
+            for position in positions:
+                if row[position + 1] is not None:
+                    row[position + 1] = to_timestamp(row[position + 1])
+            values.append(row)
+        c.executemany(insert, values)
+        last_rowid = rows[-1][0]
+    c.execute("DROP TABLE migration_copy")
+    for sql in create_others:
+        c.execute(sql)
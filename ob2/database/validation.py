@@ -3,6 +3,7 @@ Validation that can be run at initilization time to ensure logical constraints o
 
 """
 
+import logging
 from os.path import exists
 
 import ob2.config as config
@@ -18,6 +19,78 @@ def validate_database_constraints():
         _validate_grades(c)
 
 
+# Queries that run on hot paths (page views and dockergrader jobs). At startup, we ask SQLite how it
+# plans to run each of these, and complain if any of them requires a full table scan.
+_HOT_QUERIES = [
+    # ResumableQueue.recover
+    '''SELECT id, operation, payload, attempts FROM mailerqueue
+       WHERE completed = ? AND id > ? ORDER BY id LIMIT ?''',
+    # dashboard.assignments_one
+    '''SELECT build_name, source, status, score, `commit`, message, started
+       FROM builds WHERE job = ? AND source IN (?, ?) ORDER BY started DESC''',
+    '''SELECT COUNT(*) + 1 FROM grades WHERE assignment = ? AND score > ?''',
+    # dashboard.builds (see get_page)
+    '''SELECT build_name, source, status, score, `commit`, message, job, started, builds.rowid
+       FROM builds WHERE builds.source IN (?, ?)
+       AND builds.started <= (SELECT started FROM builds WHERE rowid = ?)
+       AND (builds.started < (SELECT started FROM builds WHERE rowid = ?) OR builds.rowid < ?)
+       ORDER BY builds.started DESC, builds.rowid DESC LIMIT ?''',
+    # ta.builds
+    '''SELECT build_name, source, status, score, `commit`, message, job, started, builds.rowid
+       FROM builds WHERE builds.started <= (SELECT started FROM builds WHERE rowid = ?)
+       AND (builds.started < (SELECT started FROM builds WHERE rowid = ?) OR builds.rowid < ?)
+       ORDER BY builds.started DESC, builds.rowid DESC LIMIT ?''',
+    # ta.assignments_one
+    '''SELECT build_name, source, status, score, `commit`, message, started, builds.rowid
+       FROM builds WHERE builds.job = ?
+       AND builds.started <= (SELECT started FROM builds WHERE rowid = ?)
+       AND (builds.started < (SELECT started FROM builds WHERE rowid = ?) OR builds.rowid < ?)
+       ORDER BY builds.started DESC, builds.rowid DESC LIMIT ?''',
+    # ta.gradeslog
+    '''SELECT gradeslog.transaction_name, users.name, gradeslog.rowid
+       FROM gradeslog LEFT JOIN users ON gradeslog.user = users.id
+       WHERE gradeslog.updated <= (SELECT updated FROM gradeslog WHERE rowid = ?)
+       AND (gradeslog.updated < (SELECT updated FROM gradeslog WHERE rowid = ?)
+            OR gradeslog.rowid < ?)
+       ORDER BY gradeslog.updated DESC, gradeslog.rowid DESC LIMIT ?''',
+    # dashboard.group
+    '''SELECT invitation_id FROM invitations WHERE user = ? AND status = ?''',
+    # dockergrader start_build
+    '''SELECT job, source, `commit` FROM builds
+       WHERE build_name = ? AND status = ? LIMIT 1''',
+    # create_build_job
+    '''SELECT build_name FROM builds
+       WHERE job = ? AND source = ? AND `commit` = ? AND status IN (?, ?, ?)
+       ORDER BY started DESC LIMIT 1''',
+    # ta.students_one
+    '''SELECT transaction_name, source, assignment, score, slipunits, updated, description
+       FROM gradeslog WHERE user = ? ORDER BY updated DESC''',
+    # get_repo_owners
+    '''SELECT users.id FROM groupsusers LEFT JOIN users ON groupsusers.user = users.id
+       WHERE groupsusers.`group` = ?''',
+]
+
+
+def check_query_plans():
+    """
+    Logs a warning for every hot query that SQLite would answer with a full table scan. This usually
+    means that an index is missing.
+
+    """
+    with DbCursor(read_only=True) as c:
+        for query in _HOT_QUERIES:
+            for detail in _get_query_plan(c, query):
+                if detail.startswith("SCAN ") and "USING" not in detail:
+                    logging.warning("Slow query plan (%s) for query: %s" %
+                                    (detail, " ".join(query.split())))
+
+
+def _get_query_plan(c, query):
+    c.execute("EXPLAIN QUERY PLAN %s" % query, [None] * query.count("?"))
+    # The human-readable description of each step is always in the last column.
+    return [row[-1] for row in c.fetchall()]
+
+
 def _validate_accounts(c):
     c.execute("SELECT id, name, sid, login, github, email FROM users")
     for user_id, name, sid, login, github, email in c.fetchall():
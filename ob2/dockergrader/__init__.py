@@ -1,20 +1,83 @@
+import logging
+
 from ob2.database import DbCursor
-from ob2.dockergrader.job import Job
+from ob2.database.helpers import commit_has_build, create_build, get_build_for_commit
+from ob2.dockergrader.job import Job, PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+from ob2.dockergrader.pool import worker_pool
 from ob2.dockergrader.queue import dockergrader_queue
 from ob2.dockergrader.rpc import DockerClient
-from ob2.dockergrader.worker import Worker
-from ob2.util.build_constants import FAILED, IN_PROGRESS, QUEUED
+from ob2.util.build_constants import FAILED, IN_PROGRESS, QUEUED, SUCCESS
+from ob2.util.hooks import apply_filters
+
+__all__ = ["Job", "create_build_job", "dockergrader_queue", "worker_pool"]
+
+
+def create_build_job(c, job_name, source, commit, message, trigger, staff=False):
+    """
+    Creates a new build and adds it to the dockergrader queue, as part of the transaction.
+
+    If the same commit is already queued or in progress for this job, the request is attached to
+    that build instead of creating a new one. If the commit has already been built successfully,
+    that result is reused. (Staff can always force a rebuild of a finished commit.)
+
+    Builds requested by staff go to the front of the queue. Rebuilds of a commit that has already
+    been built go behind new commits.
+
+    Returns (build_name, job). The job is None if the request was attached to an existing build.
+    Otherwise, it should be passed to dockergrader_queue.enqueue() once the transaction commits.
+
+    """
+    if staff:
+        priority = PRIORITY_HIGH
+    elif commit and commit_has_build(c, job_name, source, commit):
+        priority = PRIORITY_LOW
+    else:
+        priority = PRIORITY_NORMAL
+
+    # This is a useful hook to use, if you want to add custom logic to decide which builds run
+    # first. Jobs with lower priority values are run first.
+    #
+    # Arguments:
+    #   priority -- The original priority (see PRIORITY_* in ob2.dockergrader.job)
+    #   job_name -- The name of the job (e.g. "hw0")
+    #   source   -- The name of the repo being built
+    #   trigger  -- A description of what caused the build (e.g. "GitHub push")
+    #
+    # Returns:
+    #   An integer priority value.
+    priority = apply_filters("dockergrader-job-priority", priority, job_name, source, trigger)
+
+    if commit:
+        if staff:
+            statuses = [QUEUED, IN_PROGRESS]
+        else:
+            statuses = [QUEUED, IN_PROGRESS, SUCCESS]
+        build_name = get_build_for_commit(c, job_name, source, commit, statuses)
+        if build_name:
+            logging.info("Attached build request for %s (%s) to %s" %
+                         (source, trigger, build_name))
+            dockergrader_queue.promote(c, build_name, priority)
+            return build_name, None
 
-__all__ = ["Job", "dockergrader_queue"]
+    build_name = create_build(c, job_name, source, commit, message)
+    return build_name, dockergrader_queue.create(c, build_name, source, trigger, priority)
 
 
 def reset_grader():
     with DbCursor() as c:
-        c.execute("UPDATE builds SET status = ? WHERE status in (?, ?)",
+        # Builds that were interrupted by the last shutdown are still in the queue, so they go back
+        # in line. Any other unfinished builds can never run, so they are marked as failed.
+        dockergrader_queue.reset(c)
+        c.execute('''UPDATE builds SET status = ?
+                     WHERE status = ? AND
+                           build_name IN (SELECT build_name FROM dockergraderqueue)''',
+                  [QUEUED, IN_PROGRESS])
+        c.execute('''UPDATE builds SET status = ?
+                     WHERE status IN (?, ?) AND
+                           build_name NOT IN (SELECT build_name FROM dockergraderqueue)''',
                   [FAILED, QUEUED, IN_PROGRESS])
     DockerClient().clean()
 
 
 def main():
-    worker = Worker()
-    worker.run()
+    worker_pool.run()
@@ -0,0 +1,54 @@
+"""
+Runs dockergrader workers on a separate grading host.
+
+    python -m ob2.dockergrader -C /path/to/config
+
+The workers take builds from the queue of the ob2 server at `dockergrader_remote_server`, and run
+them against the local Docker daemon. The grading host needs the same configuration (and the same
+job handlers in functions.py) as the server.
+
+"""
+import logging
+import signal
+import sys
+
+import ob2.config as config
+from ob2.dockergrader.pool import WorkerPool
+from ob2.dockergrader.remote import RemoteWorker, remote_server
+from ob2.dockergrader.rpc import DockerClient
+from ob2.util.config_data import validate_config
+
+
+def main():
+    # Runs code in "functions.py" files, provided in configuration directories. (This is where the
+    # job handlers come from.)
+    config.exec_custom_functions()
+
+    if config.debug_mode:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("Setting log level to DEBUG (debug_mode is enabled)")
+
+    def handle_sigterm(*args):
+        logging.warn("Exiting due to SIGTERM")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    validate_config()
+    assert config.dockergrader_remote_server, \
+        "Set dockergrader_remote_server to the URL of the ob2 server"
+
+    # Clears out stray Docker containers and images. Builds that were running here before a restart
+    # are given to another worker once their leases run out.
+    DockerClient().clean()
+
+    worker_pool = WorkerPool(worker_class=RemoteWorker,
+                              count_waiting=remote_server.count_waiting)
+    try:
+        worker_pool.run()
+    except (KeyboardInterrupt, SystemExit):
+        logging.warn("Shutting down.. Goodbye world.")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,8 @@ import shutil
 from contextlib import contextmanager
 from tempfile import mkdtemp
 
-import ob2.util.github_api as github_api
 from ob2.dockergrader.job import JobFailedError
+from ob2.util.archive_cache import archive_cache
 
 
 @contextmanager
@@ -34,10 +34,10 @@ def get_working_directory():
 def download_repository(*args, **kwargs):
     """
     Downloads a repository to a local directory. Raises JobFailedError if the download was not
-    successful.
+    successful. Archives of full commit hashes are cached (see archive_cache_max_size).
 
     """
-    if not github_api.download_archive(*args, **kwargs):
+    if not archive_cache.download_archive(*args, **kwargs):
         raise JobFailedError("I tried to download your code from GitHub, but was unable to do " +
                              "so. This might be caused by a temporary problem with my " +
                              "connection to GitHub, or it might be caused by a misconfiguration " +
@@ -1,8 +1,13 @@
-from ob2.util.time import now
+from ob2.util.time import now_timestamp
+
+# Jobs with a lower priority value are run first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
 
 
 class Job(object):
-    def __init__(self, build_name, source, trigger):
+    def __init__(self, build_name, source, trigger, priority=PRIORITY_NORMAL, updated=None):
         """
         Creates a new dockergrader job to be added to the queue.
 
@@ -10,7 +15,8 @@ class Job(object):
         self.build_name = build_name
         self.source = source
         self.trigger = trigger
-        self.updated = now()
+        self.priority = priority
+        self.updated = updated if updated is not None else now_timestamp()
 
 
 class JobFailedError(Exception):
@@ -0,0 +1,151 @@
+"""
+The output of builds that are still running, so that students and TAs can watch a build without
+waiting for it to finish.
+
+Job handlers stream the output of a command by passing the log sink of the current build to
+run_command() or bash(). For example:
+
+    from ob2.dockergrader.live_output import get_log_sink
+
+    output = container.bash("make test", timeout=300, log_sink=get_log_sink())
+
+Only pass the log sink to commands whose output the students are allowed to see. The output is kept
+in memory, and it is thrown away shortly after the build finishes (the complete log is saved in the
+database, as usual).
+
+"""
+
+import threading
+from contextlib import contextmanager
+from time import time
+
+import ob2.config as config
+
+
+class _BuildOutput(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.finished = None
+
+
+class _LiveOutput(object):
+    # The maximum amount of output (in bytes) to keep for each build
+    max_size = 512 * 1024
+
+    # How long (in seconds) to keep the output of a finished build, so that viewers can catch up
+    keep_finished = 60
+
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._builds = {}
+        # Each waiting reader holds a web server thread, so only a third of them may wait at once.
+        self.max_waiters = max(1, config.web_server_threads // 3)
+        self._waiters = 0
+
+    def start(self, build_name):
+        with self._cv:
+            current_time = time()
+            for name, output in self._builds.items():
+                if output.finished and output.finished + self.keep_finished < current_time:
+                    del self._builds[name]
+            self._builds[build_name] = _BuildOutput()
+            self._cv.notify_all()
+
+    def write(self, build_name, data, offset=None):
+        """
+        Appends DATA to the output of a running build. If OFFSET is given, DATA is placed at that
+        offset, and any part that was already written is skipped.
+
+        """
+        with self._cv:
+            output = self._builds.get(build_name)
+            if output is None or output.finished:
+                return
+            if offset is not None:
+                if offset > len(output.data):
+                    return
+                data = data[len(output.data) - offset:]
+            data = data[:self.max_size - len(output.data)]
+            if data:
+                output.data.extend(data)
+                self._cv.notify_all()
+
+    def finish(self, build_name):
+        with self._cv:
+            output = self._builds.get(build_name)
+            if output is not None and not output.finished:
+                output.finished = time()
+                self._cv.notify_all()
+
+    def read(self, build_name, offset, timeout=0):
+        """
+        Returns (data, next_offset, finished), where DATA is the output of the build after OFFSET.
+        If there is no new output, waits up to TIMEOUT seconds for some (unless max_waiters readers
+        are already waiting). Builds that have not started (or that were forgotten) have no output.
+
+        """
+        deadline = time() + timeout
+        waiting = False
+        with self._cv:
+            try:
+                while True:
+                    output = self._builds.get(build_name)
+                    if output is not None:
+                        offset = min(offset, len(output.data))
+                        if offset < len(output.data) or output.finished:
+                            return (str(output.data[offset:]), len(output.data),
+                                    bool(output.finished))
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return "", offset, False
+                    if not waiting:
+                        if self._waiters >= self.max_waiters:
+                            return "", offset, False
+                        waiting = True
+                        self._waiters += 1
+                    self._cv.wait(remaining)
+            finally:
+                if waiting:
+                    self._waiters -= 1
+
+
+live_output = _LiveOutput()
+
+_current = threading.local()
+
+
+class LogSink(object):
+    """
+    A file-like object that adds everything written to it to the live output of a build.
+
+    """
+    def __init__(self, build_name):
+        self.build_name = build_name
+
+    def write(self, data):
+        live_output.write(self.build_name, data)
+
+
+def get_log_sink():
+    """
+    Returns the log sink of the build that is running on this thread, or None.
+
+    """
+    return getattr(_current, "log_sink", None)
+
+
+@contextmanager
+def capture(build_name):
+    """
+    Makes a log sink for BUILD_NAME available to job handlers on this thread (see get_log_sink).
+
+    This does not mark the output as finished, because the result of the build has not been saved
+    yet. finish_build() and fail_build() do that after their transaction commits.
+
+    """
+    live_output.start(build_name)
+    _current.log_sink = LogSink(build_name)
+    try:
+        yield
+    finally:
+        _current.log_sink = None
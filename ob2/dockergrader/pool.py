@@ -0,0 +1,131 @@
+import logging
+import os
+from multiprocessing import cpu_count
+from threading import Lock, Thread
+from time import sleep
+
+import ob2.config as config
+from ob2.dockergrader.queue import dockergrader_queue
+from ob2.dockergrader.worker import Worker
+
+
+def _get_available_memory():
+    """
+    Returns the amount of memory (in MB) that is available for new processes, or None if we can't
+    tell.
+
+    """
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                key, value = line.split(":", 1)
+                if key == "MemAvailable":
+                    return int(value.split()[0]) / 1024
+    except (IOError, ValueError):
+        pass
+
+
+def _has_headroom():
+    """
+    Returns whether the machine has enough spare CPU and memory to run another worker.
+
+    """
+    load_per_cpu = os.getloadavg()[0] / cpu_count()
+    if load_per_cpu > config.dockergrader_autoscale_max_load:
+        return False
+    available_memory = _get_available_memory()
+    if available_memory is not None and \
+            available_memory < config.dockergrader_autoscale_min_free_memory:
+        return False
+    return True
+
+
+class WorkerPool(object):
+    """
+    Manages the dockergrader worker threads. The pool starts with `dockergrader_workers` workers,
+    and TAs can change its size at runtime. If `dockergrader_autoscale` is enabled, the pool adds
+    workers while jobs are waiting (as long as the machine has headroom), and removes them again
+    once the queue is empty. Autoscaling never shrinks the pool below the size that was asked for.
+
+    The server uses worker_pool (below). Grading hosts make their own pool of RemoteWorkers (see
+    ob2.dockergrader.__main__).
+
+    """
+    # How often (in seconds) the autoscaler looks at the queue
+    autoscale_interval = 10
+
+    def __init__(self, worker_class=Worker, count_waiting=dockergrader_queue.count_waiting):
+        self._worker_class = worker_class
+        self._count_waiting = count_waiting
+        self._lock = Lock()
+        self._workers = []
+        self._size = 0
+
+    def get_size(self):
+        """
+        Returns (size, running), where SIZE is the number of workers that was asked for and RUNNING
+        is the number of workers that are currently running (including autoscaled workers).
+
+        """
+        with self._lock:
+            return self._size, len(self._workers)
+
+    def set_size(self, size):
+        """
+        Sets the number of workers. Extra workers finish their current job before they exit.
+
+        """
+        assert size >= 0
+        with self._lock:
+            self._size = size
+            self._resize(size)
+
+    def _resize(self, size):
+        # Must be called with self._lock held.
+        while len(self._workers) < size:
+            worker = self._worker_class()
+            thread = Thread(target=self._run_worker, args=(worker,))
+            thread.daemon = True
+            thread.start()
+            self._workers.append(worker)
+        if len(self._workers) > size:
+            # Retire idle workers first, so that running builds are not held up.
+            by_idleness = sorted(self._workers, key=lambda worker: not worker.is_idle())
+            for worker in by_idleness[:len(self._workers) - size]:
+                worker.retire()
+                self._workers.remove(worker)
+
+    def _run_worker(self, worker):
+        try:
+            worker.run()
+        finally:
+            dockergrader_queue.unregister_worker(worker)
+
+    def _autoscale(self):
+        waiting = self._count_waiting()
+        with self._lock:
+            running = len(self._workers)
+            idle = len([worker for worker in self._workers if worker.is_idle()])
+            if waiting > idle and running < config.dockergrader_max_workers and _has_headroom():
+                logging.info("Adding a dockergrader worker (%d jobs waiting)" % waiting)
+                self._resize(running + 1)
+            elif waiting == 0 and idle > 0 and running > self._size:
+                logging.info("Removing an idle dockergrader worker")
+                self._resize(running - 1)
+
+    def run(self):
+        """
+        Starts the workers, and then runs the autoscaler forever.
+
+        """
+        self.set_size(config.dockergrader_workers)
+        while True:
+            sleep(self.autoscale_interval)
+            if config.dockergrader_autoscale:
+                try:
+                    self._autoscale()
+                except Exception:
+                    logging.exception("Error occurred while autoscaling dockergrader workers")
+
+
+worker_pool = WorkerPool()
@@ -1,42 +1,204 @@
-from collections import deque
+import apsw
+import logging
 from threading import Condition, Lock
+from time import time
+
+from ob2.database import DbCursor
+from ob2.dockergrader.job import Job, PRIORITY_NORMAL
+from ob2.util.build_constants import IN_PROGRESS, QUEUED
+
+# Waiting jobs, in the order that they should be run. Jobs are ordered by priority first. Within a
+# priority, jobs from different repos take turns: a job's place in line is the number of jobs from
+# the same repo that are already running or ahead of it in the queue. So, one repo with 40 pushes
+# does not hold up everybody else's builds.
+_WAITING_JOBS_QUERY = '''
+    SELECT build_name, source, `trigger`, priority, updated FROM dockergraderqueue AS q
+    WHERE worker IS NULL
+    ORDER BY priority,
+             (SELECT COUNT(*) FROM dockergraderqueue AS r
+              WHERE r.source = q.source AND (r.worker IS NOT NULL OR r.rowid < q.rowid)),
+             rowid'''
 
 
 class _DockergraderQueue(object):
+    """
+    The queue of dockergrader jobs. Jobs are stored in the dockergraderqueue table, so they survive
+    a restart of the server. A job stays in the table until its build is finished, so builds that
+    were interrupted by a restart can be run again (see reset_grader).
+
+    """
+    # How long (in seconds) an idle worker waits before checking the database for new jobs, in case
+    # it missed a notification.
+    poll_interval = 5
+
     def __init__(self):
-        self._queue = deque()
         self._queue_cv = Condition()
-        self._workers = []
+        self._generation = 0
+        self._workers = {}
+        self._last_worker_id = 0
         self._workers_lock = Lock()
 
+    def create(self, c, build_name, source, trigger, priority=PRIORITY_NORMAL):
+        """
+        Adds a job to the queue as part of the transaction. If the transaction is rolled back, the
+        job will disappear too.
+
+        Returns a Job. Once the transaction is committed, you should pass it to enqueue(), so that
+        an idle worker can pick it up right away.
+
+        """
+        job = Job(build_name, source, trigger, priority)
+        c.execute('''INSERT INTO dockergraderqueue (build_name, source, `trigger`, priority,
+                                                    updated, worker)
+                     VALUES (?, ?, ?, ?, ?, NULL)''',
+                  [build_name, source, trigger, priority, job.updated])
+        return job
+
     def enqueue(self, job):
         """
-        Adds a job to the queue.
+        Notifies the workers about a job that was previously added with create().
 
         """
         with self._queue_cv:
-            self._queue.append(job)
-            self._queue_cv.notify()
+            self._generation += 1
+            self._queue_cv.notify_all()
 
-    def dequeue(self):
+    def dequeue(self, worker_name, timeout=None, lease=None):
         """
-        Takes a job from the queue, or blocks until a job is ready to go.
+        Claims the next job in the queue for WORKER_NAME, or blocks until a job is ready to go. If
+        TIMEOUT (in seconds) is given, returns None if no job came in before the timeout.
+
+        If LEASE (in seconds) is given, the claim expires unless the worker calls renew() before
+        then. This is used for remote workers, which may disappear without telling us. When a lease
+        expires, the job is put back in line and its build is marked as queued again.
 
         """
-        with self._queue_cv:
-            while not self._queue:
-                self._queue_cv.wait()
-            return self._queue.popleft()
+        deadline = time() + timeout if timeout is not None else None
+        while True:
+            with self._queue_cv:
+                generation = self._generation
+            job = self._claim(worker_name, lease)
+            if job:
+                return job
+            with self._queue_cv:
+                # If a job was enqueued while we were looking, then don't go to sleep.
+                if generation == self._generation:
+                    wait = self.poll_interval
+                    if deadline is not None:
+                        wait = min(wait, deadline - time())
+                        if wait <= 0:
+                            return None
+                    self._queue_cv.wait(wait)
+
+    def _has_work(self):
+        """
+        Returns whether there is a job waiting in line, or a claim whose lease has expired. This
+        only reads, so idle workers can poll without taking the global database lock.
+
+        """
+        with DbCursor(read_only=True) as c:
+            c.execute('''SELECT 1 FROM dockergraderqueue
+                         WHERE worker IS NULL OR lease_expires < ? LIMIT 1''', [time()])
+            return c.fetchone() is not None
+
+    def _claim(self, worker_name, lease):
+        try:
+            # Most polls find nothing to do, so the write transaction is only started when there is
+            # something to claim.
+            if not self._has_work():
+                return None
+            with DbCursor() as c:
+                self._expire_leases(c)
+                c.execute(_WAITING_JOBS_QUERY + " LIMIT 1")
+                row = c.fetchone()
+                if row is None:
+                    return None
+                build_name, source, trigger, priority, updated = row
+                lease_expires = time() + lease if lease is not None else None
+                c.execute('''UPDATE dockergraderqueue SET worker = ?, lease_expires = ?
+                             WHERE build_name = ?''', [worker_name, lease_expires, build_name])
+                return Job(build_name, source, trigger, priority, updated)
+        except apsw.Error:
+            logging.exception("Failed to claim the next dockergrader job")
+
+    def _expire_leases(self, c):
+        c.execute('''SELECT build_name, worker FROM dockergraderqueue
+                     WHERE lease_expires IS NOT NULL AND lease_expires < ?''', [time()])
+        for build_name, worker_name in c.fetchall():
+            logging.warning("Lease on %s expired (worker %s)" % (build_name, worker_name))
+            c.execute('''UPDATE dockergraderqueue SET worker = NULL, lease_expires = NULL
+                         WHERE build_name = ?''', [build_name])
+            c.execute("UPDATE builds SET status = ? WHERE build_name = ? AND status = ?",
+                      [QUEUED, build_name, IN_PROGRESS])
+
+    def renew(self, build_name, worker_name, lease):
+        """
+        Extends the lease that WORKER_NAME holds on a job by LEASE seconds.
+
+        Returns False if the worker no longer holds the job (for example, because its lease already
+        expired and the job was given to someone else).
+
+        """
+        with DbCursor() as c:
+            if not self.is_claimed_by(c, build_name, worker_name):
+                return False
+            c.execute("UPDATE dockergraderqueue SET lease_expires = ? WHERE build_name = ?",
+                      [time() + lease, build_name])
+            return True
+
+    def is_claimed_by(self, c, build_name, worker_name):
+        """
+        Returns whether WORKER_NAME currently holds the job for BUILD_NAME.
+
+        """
+        c.execute("SELECT 1 FROM dockergraderqueue WHERE build_name = ? AND worker = ?",
+                  [build_name, worker_name])
+        return c.fetchone() is not None
+
+    def promote(self, c, build_name, priority):
+        """
+        Raises the priority of a waiting job to PRIORITY, if it is not already at least that high.
+
+        """
+        c.execute('''UPDATE dockergraderqueue SET priority = ?
+                     WHERE build_name = ? AND priority > ?''', [priority, build_name, priority])
+
+    def complete(self, c, build_name):
+        """
+        Removes a job from the queue as part of the transaction. This should happen in the same
+        transaction that records the result of the build.
+
+        """
+        c.execute("DELETE FROM dockergraderqueue WHERE build_name = ?", [build_name])
+
+    def reset(self, c):
+        """
+        Puts all claimed jobs back in line. This should only be used at startup, when we know that
+        no jobs are running.
+
+        """
+        c.execute('''UPDATE dockergraderqueue SET worker = NULL, lease_expires = NULL
+                     WHERE worker IS NOT NULL''')
+
+    def count_waiting(self):
+        """
+        Returns the number of jobs waiting in the queue.
+
+        """
+        with DbCursor(read_only=True) as c:
+            c.execute("SELECT COUNT(*) FROM dockergraderqueue WHERE worker IS NULL")
+            count, = c.fetchone()
+            return count
 
     def snapshot(self):
         """
-        Returns a list containing references to all jobs currently in the queue. Because of Python
-        GC semantics, we don't need to worry about synchronization after the list has been
-        constructed.
+        Returns a list of all jobs waiting in the queue, in the order they will run.
 
         """
-        with self._queue_cv:
-            return list(self._queue)
+        with DbCursor(read_only=True) as c:
+            c.execute(_WAITING_JOBS_QUERY)
+            return [Job(build_name, source, trigger, priority, updated)
+                    for build_name, source, trigger, priority, updated in c.fetchall()]
 
     def register_worker(self, worker):
         """
@@ -47,8 +209,17 @@ class _DockergraderQueue(object):
 
         """
         with self._workers_lock:
-            self._workers.append(worker)
-            return len(self._workers)
+            self._last_worker_id += 1
+            self._workers[self._last_worker_id] = worker
+            return self._last_worker_id
+
+    def unregister_worker(self, worker):
+        """
+        Removes a worker that has stopped running.
+
+        """
+        with self._workers_lock:
+            self._workers.pop(worker.identifier, None)
 
     def probe_worker(self, number, with_log=True):
         """
@@ -56,8 +227,8 @@ class _DockergraderQueue(object):
 
         """
         with self._workers_lock:
-            if 1 <= number <= len(self._workers):
-                return self._workers[number - 1].probe(with_log=with_log)
+            if number in self._workers:
+                return self._workers[number].probe(with_log=with_log)
 
     def probe_workers(self, with_log=False):
         """
@@ -65,7 +236,8 @@ class _DockergraderQueue(object):
 
         """
         with self._workers_lock:
-            return [worker.probe(with_log=with_log) for worker in self._workers]
+            return [self._workers[number].probe(with_log=with_log)
+                    for number in sorted(self._workers)]
 
 
 dockergrader_queue = _DockergraderQueue()
@@ -0,0 +1,148 @@
+import base64
+import json
+import logging
+import requests
+import socket
+from threading import Event, Thread
+from time import sleep, time
+
+import ob2.config as config
+from ob2.dockergrader.live_output import live_output
+from ob2.dockergrader.worker import Worker
+from ob2.util.security import get_worker_signature
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when the server says that a remote worker no longer holds the build it is working on.
+
+    """
+    pass
+
+
+class _RemoteServer(object):
+    """
+    Talks to the worker API of the ob2 web server (see ob2.web.blueprints.dockergrader). Requests
+    are signed with `dockergrader_remote_secret`.
+
+    """
+    # How long (in seconds) to wait for the server to respond
+    request_timeout = 60
+
+    def call(self, method, **kwargs):
+        """
+        Sends a request to the server. Returns the JSON response, or None if the response was
+        empty.
+
+        """
+        kwargs["time"] = time()
+        payload_bytes = json.dumps(kwargs)
+        url = "%s/dockergrader/%s/" % (config.dockergrader_remote_server.rstrip("/"), method)
+        response = requests.post(url, data=payload_bytes, timeout=self.request_timeout,
+                                 headers={"Content-Type": "application/json",
+                                          "X-Ob2-Worker-Signature":
+                                              get_worker_signature(payload_bytes)})
+        if response.status_code == 409:
+            raise LeaseLostError()
+        response.raise_for_status()
+        if response.status_code == 204:
+            return None
+        return response.json()
+
+    def count_waiting(self):
+        return self.call("status", worker=socket.gethostname())["waiting"]
+
+
+remote_server = _RemoteServer()
+
+
+class RemoteWorker(Worker):
+    """
+    A dockergrader worker that runs on a different machine than the web server. Builds run against
+    the local Docker daemon, but the queue and the database are only reached through the web
+    server. While a build is running, the worker renews its lease on the build. If the worker
+    disappears, the lease runs out and the build is given to another worker.
+
+    """
+    # How often (in seconds) to ask the server for a new job
+    poll_interval = 5
+
+    # How long (in seconds) to wait before retrying a request that failed
+    retry_interval = 10
+
+    # How often (in seconds) to send new output of the running build to the server
+    output_interval = 5
+
+    def __init__(self):
+        super(RemoteWorker, self).__init__()
+        self.name = "%s/%d" % (socket.gethostname(), self.identifier)
+        self.lease = None
+
+    def _claim_build(self, timeout):
+        try:
+            build = remote_server.call("claim", worker=self.name)
+        except Exception:
+            self._log("Exception raised while claiming a job", exc=True)
+            logging.exception("Failed to claim a job from %s" % config.dockergrader_remote_server)
+            sleep(self.retry_interval)
+            return None
+        if build is None:
+            sleep(min(self.poll_interval, timeout))
+            return None
+        self.lease = build["lease"]
+        return build["build_name"], build["job_name"], build["source"], build["commit"]
+
+    def _report(self, method, **kwargs):
+        # The result of a build is worth retrying for (for example, when the server could not save
+        # it and answered 503), until the server tells us that the build has been given to
+        # somebody else.
+        while True:
+            try:
+                remote_server.call(method, worker=self.name, **kwargs)
+                return
+            except LeaseLostError:
+                self._log("Lost the lease on %s. Dropping the result." % kwargs["build_name"])
+                return
+            except Exception:
+                self._log("Exception raised while reporting to the server. Retrying...",
+                          exc=True)
+                logging.exception("Failed to report build result")
+                sleep(self.retry_interval)
+
+    def _fail_build(self, build_name, error_message, internal_error=False):
+        self._report("fail", build_name=build_name, error_message=error_message,
+                     internal_error=internal_error)
+
+    def _finish_build(self, build_name, score, build_log):
+        self._report("finish", build_name=build_name, score=score,
+                     log=base64.b64encode(str(build_log)))
+
+    def _heartbeat(self, build_name, done):
+        # New output is sent along with the heartbeat. If there is no new output, the heartbeat is
+        # still sent several times per lease period.
+        offset = 0
+        last_sent = time()
+        while not done.wait(self.output_interval):
+            output, next_offset, _ = live_output.read(build_name, offset)
+            if not output and time() - last_sent < self.lease / 4.0:
+                continue
+            try:
+                remote_server.call("heartbeat", worker=self.name, build_name=build_name,
+                                   output=base64.b64encode(output), output_offset=offset)
+                offset = next_offset
+                last_sent = time()
+            except LeaseLostError:
+                self._log("Lost the lease on %s" % build_name)
+                return
+            except Exception:
+                self._log("Exception raised while renewing lease", exc=True)
+
+    def _process_build(self, build):
+        done = Event()
+        heartbeat = Thread(target=self._heartbeat, args=(build[0], done))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            super(RemoteWorker, self)._process_build(build)
+        finally:
+            done.set()
@@ -1,16 +1,24 @@
 import docker
+import logging
+import os
+import shutil
 from docker.utils import create_host_config
 from docker.utils.types import Ulimit
 from requests.exceptions import ConnectionError, ReadTimeout
+from tempfile import mkdtemp
+from threading import Condition, Thread
+from time import sleep, time
 
 import ob2.config as config
 
 
 class DockerClient(object):
     def __init__(self, sock="unix://var/run/docker.sock"):
+        self.sock = sock
         self.client = docker.Client(base_url=sock, version="auto")
 
     def clean(self):
+        container_pool.clear(self.sock)
         containers = self.client.containers(quiet=True, all=True)
         for container in containers:
             self.client.remove_container(container=container, v=True, force=True)
@@ -31,7 +39,22 @@ class DockerClient(object):
         max_procs  -- The ulimit nproc
         max_files  -- The ulimit nofile
 
+        The container is taken from the pool of warm containers when one is ready (see
+        dockergrader_warm_containers). Warm containers are started with empty directories mounted
+        at the same remote paths, and the contents of each local path are moved into them.
+
         """
+        key = (self.sock, image, mem_limit, memswap_limit, tuple(labels), max_procs, max_files,
+               tuple(sorted(volumes.values())))
+        container_id = container_pool.take(self, key, volumes)
+        if container_id:
+            return Container(self, container_id)
+        container_id = self._create_and_start(image, mem_limit, memswap_limit, labels, volumes,
+                                              max_procs, max_files)
+        return Container(self, container_id)
+
+    def _create_and_start(self, image, mem_limit, memswap_limit, labels, volumes, max_procs,
+                          max_files):
         host_config = {"mem_limit": mem_limit,
                        "memswap_limit": memswap_limit,
                        "network_mode": "none",
@@ -55,7 +78,7 @@ class DockerClient(object):
         #     isolation, memory limits, etc (huge problems).
         self.client.start(container_id)
 
-        return Container(self, container['Id'])
+        return container_id
 
     def stop(self, container_id, v=True, force=True):
         """
@@ -67,14 +90,31 @@ class DockerClient(object):
         """
         self.client.remove_container(container_id, v=v, force=force)
 
-    def run_command(self, container_id, command, timeout=10):
+    def run_command(self, container_id, command, timeout=10, log_sink=None):
+        """
+        Runs a command in the container and returns its output (stdout and stderr).
+
+        If a LOG_SINK is given (see ob2.dockergrader.live_output), the output is also written to it
+        while the command is running.
+
+        """
         instance = self.client.exec_create(container=container_id, cmd=command, stdout=True,
                                            stderr=True, tty=False)
         old_timeout = self.client.timeout
         self.client.timeout = timeout
         try:
-            output = self.client.exec_start(exec_id=instance['Id'], tty=False, stream=False)
-            return output
+            if log_sink is None:
+                output = self.client.exec_start(exec_id=instance['Id'], tty=False, stream=False)
+                return output
+            # The client timeout only limits how long we wait for each chunk of output.
+            deadline = time() + timeout
+            output = []
+            for chunk in self.client.exec_start(exec_id=instance['Id'], tty=False, stream=True):
+                output.append(chunk)
+                log_sink.write(chunk)
+                if time() > deadline:
+                    raise TimeoutError()
+            return "".join(output)
         except (ConnectionError, ReadTimeout):
             # For forward-compatibility with whatever decision they make next
             # https://github.com/kennethreitz/requests/issues/2392
@@ -82,9 +122,9 @@ class DockerClient(object):
         finally:
             self.client.timeout = old_timeout
 
-    def bash(self, container_id, payload, user="root", timeout=10):
+    def bash(self, container_id, payload, user="root", timeout=10, log_sink=None):
         return self.run_command(container_id, ["su", "-c", payload, "-s", "/bin/bash", user],
-                                timeout)
+                                timeout, log_sink)
 
 
 class Container(object):
@@ -111,3 +151,140 @@ class Container(object):
 
 class TimeoutError(Exception):
     pass
+
+
+class _ContainerPool(object):
+    """
+    Keeps containers started ahead of time, so that job handlers don't have to wait for Docker to
+    create and start a new container. Containers are pooled separately for each combination of
+    docker socket, image and resource limits, and the pool learns these combinations from the calls
+    to DockerClient.start(). Each container is only used once. When one is taken, a background
+    thread starts a replacement.
+
+    The volumes of a job are only known when it asks for a container, so each warm container gets a
+    new empty directory (next to the job's working directories) for each remote path. When a job
+    takes the container, the files in its local path are moved into that directory, and then the
+    directory is renamed to the local path. Docker keeps the bind mount on the directory itself,
+    not on its old name, so the job and the container share the same files, just like a container
+    that was started with the job's volumes.
+
+    """
+    # How long (in seconds) to wait after failing to start a container
+    failure_delay = 5
+
+    def __init__(self):
+        self._ready = {}
+        self._cv = Condition()
+        self._filler = None
+
+    def take(self, docker_client, key, volumes):
+        """
+        Returns the ID of a warm container for KEY, with VOLUMES moved into its mounts, or None if
+        none is ready.
+
+        """
+        if not config.dockergrader_warm_containers:
+            return None
+        with self._cv:
+            ready = self._ready.setdefault(key, [])
+            container_id, image_id, mounts = ready.pop(0) if ready else (None, None, None)
+            if self._filler is None:
+                self._filler = Thread(target=self._fill)
+                self._filler.daemon = True
+                self._filler.start()
+            self._cv.notify()
+        if container_id is None:
+            return None
+        try:
+            # The image may have been rebuilt since this container was started, and we never want
+            # to run a job against an old version of the image.
+            state = docker_client.client.inspect_container(container_id)
+            current_image_id = docker_client.client.inspect_image(key[1])["Id"]
+            if (state["State"]["Running"] and image_id == current_image_id and
+                    self._move_volumes(volumes, mounts)):
+                return container_id
+        except Exception:
+            logging.exception("Failed to prepare warm container %s" % container_id)
+        try:
+            docker_client.stop(container_id)
+        except Exception:
+            logging.exception("Failed to remove stale warm container %s" % container_id)
+        self._remove_mounts(mounts)
+        return None
+
+    def clear(self, sock):
+        """
+        Forgets all warm containers on the docker daemon at SOCK. (Use this when the containers
+        themselves have been removed.)
+
+        """
+        with self._cv:
+            for key in self._ready.keys():
+                if key[0] == sock:
+                    for _, _, mounts in self._ready.pop(key):
+                        self._remove_mounts(mounts)
+
+    @staticmethod
+    def _move_volumes(volumes, mounts):
+        """
+        Moves the contents of each local path in VOLUMES into the directory that is mounted at its
+        remote path (MOUNTS maps remote paths to directories), and then puts that directory in
+        place of the local path. Returns False (without changing anything) if this is not possible.
+
+        """
+        for local_path, remote_path in volumes.items():
+            if (not os.path.isdir(local_path) or
+                    os.stat(local_path).st_dev != os.stat(mounts[remote_path]).st_dev):
+                return False
+        for local_path, remote_path in volumes.items():
+            mount_path = mounts[remote_path]
+            os.chmod(mount_path, os.stat(local_path).st_mode)
+            for name in os.listdir(local_path):
+                os.rename(os.path.join(local_path, name), os.path.join(mount_path, name))
+            # The local path is empty now, so rename() replaces it.
+            os.rename(mount_path, local_path)
+        return True
+
+    @staticmethod
+    def _remove_mounts(mounts):
+        for mount_path in mounts.values():
+            shutil.rmtree(mount_path, ignore_errors=True)
+
+    def _next_key(self):
+        # Must be called with self._cv held.
+        for key, ready in self._ready.items():
+            if len(ready) < config.dockergrader_warm_containers:
+                return key
+
+    def _fill(self):
+        docker_clients = {}
+        while True:
+            with self._cv:
+                key = self._next_key()
+                while key is None:
+                    self._cv.wait()
+                    key = self._next_key()
+            sock, image, mem_limit, memswap_limit, labels, max_procs, max_files, remote_paths = key
+            mounts = {remote_path: mkdtemp(prefix="ob2-warm-") for remote_path in remote_paths}
+            try:
+                docker_client = docker_clients.get(sock)
+                if docker_client is None:
+                    docker_client = docker_clients[sock] = DockerClient(sock)
+                volumes = {mount_path: remote_path for remote_path, mount_path in mounts.items()}
+                container_id = docker_client._create_and_start(image, mem_limit, memswap_limit,
+                                                               list(labels), volumes, max_procs,
+                                                               max_files)
+                image_id = docker_client.client.inspect_container(container_id)["Image"]
+            except Exception:
+                logging.exception("Failed to start a warm container for %s" % image)
+                self._remove_mounts(mounts)
+                with self._cv:
+                    # Stop trying until a job asks for this kind of container again.
+                    self._ready.pop(key, None)
+                sleep(self.failure_delay)
+                continue
+            with self._cv:
+                self._ready.setdefault(key, []).append((container_id, image_id, mounts))
+
+
+container_pool = _ContainerPool()
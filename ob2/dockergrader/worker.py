@@ -11,24 +11,242 @@ from ob2.database.helpers import (
     assign_grade_batch,
     get_repo_owners,
     get_users_by_ids,
+    set_build_log,
 )
 from ob2.dockergrader.job import JobFailedError
+from ob2.dockergrader.live_output import capture, live_output
 from ob2.dockergrader.queue import dockergrader_queue
 from ob2.mailer import send_template
 from ob2.util.build_constants import QUEUED, IN_PROGRESS, SUCCESS, FAILED
 from ob2.util.config_data import get_assignment_by_name
 from ob2.util.hooks import get_job
-from ob2.util.time import now, now_str, slip_units
+from ob2.util.pubsub import publish_build_status
+from ob2.util.time import now, now_timestamp, slip_units
+
+# The number of times to try saving the result of a build before giving up
+SAVE_RESULT_ATTEMPTS = 3
+
+
+def _log_to_logging(message, exc=False):
+    if exc:
+        logging.exception(message)
+    else:
+        logging.info(message)
+
+
+def _get_owner_emails(c, source):
+    owners = get_repo_owners(c, source)
+    owner_emails = {owner: email for owner, (_, _, _, _, _, email)
+                    in get_users_by_ids(c, owners).items()}
+    return owners, owner_emails
+
+
+def start_build(build_name, log=_log_to_logging):
+    """
+    Marks a queued build as in progress. This runs on the server, even for remote workers.
+
+    Returns (job_name, source, commit), or None if the build does not exist anymore (in which case
+    the job is removed from the queue).
+
+    """
+    while True:
+        try:
+            with DbCursor() as c:
+                c.execute('''SELECT job, source, `commit` FROM builds
+                             WHERE build_name = ? AND status = ? LIMIT 1''',
+                          [build_name, QUEUED])
+                row = c.fetchone()
+                if row is None:
+                    log("Build %s was missing from the database. Skipping." % build_name)
+                    dockergrader_queue.complete(c, build_name)
+                    return None
+                c.execute("UPDATE builds SET status = ?, updated = ? WHERE build_name = ?",
+                          [IN_PROGRESS, now_timestamp(), build_name])
+            live_output.start(build_name)
+            job_name, source, _ = row
+            publish_build_status(source, build_name, job_name, IN_PROGRESS)
+            return row
+        except apsw.Error:
+            log("Exception raised while setting status to IN_PROGRESS. Retrying...", exc=True)
+            logging.exception("Failed to retrieve next dockergrader job")
+
+
+def run_build(job_name, source, commit):
+    """
+    Runs the job handler for a build. This does not touch the database, so remote workers can call
+    it too.
+
+    Returns (log, score). Raises JobFailedError if the job handler reports a failure, and any other
+    exception if something went wrong inside the grader.
+
+    """
+    # if the job doesn't exist for some reason, the resulting TypeError will be caught
+    # and logged
+    assignment = get_assignment_by_name(job_name)
+    job_handler = get_job(job_name)
+    log, score = job_handler(source, commit)
+    # Ignore any special encoding inside the log, and just treat it as a bytes
+    log = buffer(log)
+    min_score, max_score = assignment.min_score, assignment.max_score
+    if score < min_score or score > max_score:
+        raise ValueError("A score of %s is not in the acceptable range of %f to %f" %
+                         (str(score), min_score, max_score))
+    return log, score
+
+
+def fail_build(build_name, error_message, internal_error=False, log=_log_to_logging,
+               worker=None):
+    """
+    Records that a build failed, and emails the owners of the repo (unless the failure was an
+    internal error). This runs on the server, even for remote workers.
+
+    If WORKER is given, the failure is only recorded if that worker still holds the job. Returns
+    whether the failure was recorded. Raises apsw.Error if the database could not be updated.
+
+    """
+    try:
+        with DbCursor() as c:
+            # Checked in the same transaction as the update, so a worker whose lease expired can't
+            # overwrite the build of the worker that took over the job.
+            if worker is not None and not dockergrader_queue.is_claimed_by(c, build_name, worker):
+                return False
+            if internal_error:
+                error_message = "Build failed due to an internal error."
+            c.execute("UPDATE builds SET status = ?, updated = ? WHERE build_name = ?",
+                      [FAILED, now_timestamp(), build_name])
+            set_build_log(c, build_name, error_message)
+            dockergrader_queue.complete(c, build_name)
+            c.execute('''SELECT source, `commit`, message, job FROM builds
+                         WHERE build_name = ?''', [build_name])
+            source, commit, message, job_name = c.fetchone()
+            owners, owner_emails = _get_owner_emails(c, source)
+    except apsw.Error:
+        # Same as finish_build
+        live_output.finish(build_name)
+        raise
+    live_output.finish(build_name)
+    publish_build_status(source, build_name, job_name, FAILED)
+    if config.mailer_enabled and not internal_error:
+        try:
+            for owner in owners:
+                email = owner_emails.get(owner)
+                if not email:
+                    continue
+                subject = "%s failed to complete" % build_name
+                send_template("build_failed", email, subject, build_name=build_name,
+                              job_name=job_name, source=source, commit=commit,
+                              message=message, error_message=error_message)
+        except Exception:
+            log("Exception raised while reporting JobFailedError", exc=True)
+            logging.exception("Exception raised while reporting JobFailedError")
+        else:
+            log("JobFailedError successfully reported via email")
+    return True
+
+
+def finish_build(build_name, score, build_log, log=_log_to_logging, worker=None):
+    """
+    Records the result of a successful build, assigns grades, and emails the owners of the repo.
+    This runs on the server, even for remote workers.
+
+    If WORKER is given, the result is only recorded if that worker still holds the job. Returns
+    whether the result was recorded. Raises apsw.Error if the result still could not be saved after
+    SAVE_RESULT_ATTEMPTS tries.
+
+    """
+    attempts = 0
+    while True:
+        try:
+            with DbCursor() as c:
+                # See fail_build
+                if worker is not None and not dockergrader_queue.is_claimed_by(c, build_name,
+                                                                               worker):
+                    return False
+                c.execute('''SELECT source, `commit`, message, job, started FROM builds
+                             WHERE build_name = ?''', [build_name])
+                source, commit, message, job_name, started = c.fetchone()
+                owners, owner_emails = _get_owner_emails(c, source)
+                assignment = get_assignment_by_name(job_name)
+                c.execute('''UPDATE builds SET status = ?, score = ?, updated = ?
+                             WHERE build_name = ?''',
+                          [SUCCESS, score, now_timestamp(), build_name])
+                set_build_log(c, build_name, build_log)
+                dockergrader_queue.complete(c, build_name)
+                slipunits = slip_units(assignment.due_date, started)
+                affected_users = assign_grade_batch(c, owners, job_name, float(score),
+                                                    slipunits, build_name, "Automatic build.",
+                                                    "autograder", dont_lower=True)
+                break
+        except apsw.Error:
+            log("Exception raised while assigning grades", exc=True)
+            logging.exception("Failed to update build %s after build completed" % build_name)
+            attempts += 1
+            if attempts >= SAVE_RESULT_ATTEMPTS:
+                live_output.finish(build_name)
+                raise
+    live_output.finish(build_name)
+    publish_build_status(source, build_name, job_name, SUCCESS, score)
+
+    if config.mailer_enabled:
+        try:
+            for owner in owners:
+                email = owner_emails.get(owner)
+                if not email:
+                    continue
+                subject = "%s complete - score %s / %s" % (build_name, str(score),
+                                                           str(assignment.full_score))
+                if owner not in affected_users:
+                    subject += " (no effect on grade)"
+                else:
+                    if slipunits == 1:
+                        subject += " (1 %s used)" % config.slip_unit_name_singular
+                    elif slipunits > 0:
+                        subject += " (%s slip %s used)" % (str(slipunits),
+                                                           config.slip_unit_name_plural)
+                send_template("build_finished", email, subject, build_name=build_name,
+                              job_name=job_name, score=score,
+                              full_score=str(assignment.full_score), slipunits=slipunits,
+                              log=build_log, source=source, commit=commit, message=message,
+                              affected=(owner in affected_users))
+        except Exception:
+            log("Exception raised while reporting grade", exc=True)
+            logging.exception("Exception raised while reporting grade")
+        else:
+            log("Grade successfully reported via email")
+    return True
 
 
 class Worker(object):
+    """
+    A dockergrader worker thread. It claims builds from the queue, runs them, and records the
+    results. The claim, start and finish steps talk to the database directly. RemoteWorker (see
+    ob2.dockergrader.remote) overrides them to go through the web server instead, so that it can run
+    on another machine.
+
+    """
+    # How often (in seconds) an idle worker checks whether it has been retired
+    retire_check_interval = 5
+
     def __init__(self):
         self.lock = threading.Lock()
         self.log = deque(maxlen=100)
         self.status = None
         self.updated = now()
+        self.retired = False
         self.identifier = dockergrader_queue.register_worker(self)
 
+    def is_idle(self):
+        with self.lock:
+            return self.status is None
+
+    def retire(self):
+        """
+        Asks the worker to stop. A worker that is running a job finishes the job first.
+
+        """
+        with self.lock:
+            self.retired = True
+
     def probe(self, with_log=False):
         with self.lock:
             if with_log:
@@ -45,135 +263,78 @@ class Worker(object):
         with self.lock:
             self.log.append(payload)
 
-    def _dequeue_job(self):
+    def _dequeue_build(self):
         with self.lock:
             self.status = None
             self.updated = now()
         self._log("Waiting for a new job to run")
-        return dockergrader_queue.dequeue()
+        while not self.retired:
+            build = self._claim_build(timeout=self.retire_check_interval)
+            if build:
+                return build
 
     def _sanitize_name(self, name):
         return re.sub(r'[^a-zA-Z0-9]+', '_', name)
 
-    def _process_job(self, job):
-        build_name = job.build_name
+    def _claim_build(self, timeout):
+        """
+        Claims the next build and marks it as in progress. Returns (build_name, job_name, source,
+        commit), or None if there was nothing to do before the TIMEOUT (in seconds).
+
+        """
+        job = dockergrader_queue.dequeue(str(self.identifier), timeout=timeout)
+        if job:
+            build = start_build(job.build_name, log=self._log)
+            if build:
+                return (job.build_name,) + tuple(build)
+
+    def _fail_build(self, build_name, error_message, internal_error=False):
+        try:
+            fail_build(build_name, error_message, internal_error=internal_error, log=self._log)
+        except apsw.Error:
+            self._log("Exception raised while recording the failure of %s" % build_name, exc=True)
+            logging.exception("Failed to record the failure of build %s" % build_name)
+
+    def _finish_build(self, build_name, score, build_log):
+        try:
+            finish_build(build_name, score, build_log, log=self._log)
+        except apsw.Error:
+            # finish_build has already logged the errors
+            self._log("Giving up on the result of %s" % build_name)
+
+    def _process_build(self, build):
+        build_name, job_name, source, commit = build
         with self.lock:
             self.status = build_name
             self.updated = now()
 
-        # Mark the job as In Progress
-        while True:
-            try:
-                with DbCursor() as c:
-                    c.execute('''SELECT source, `commit`, message, job, started FROM builds
-                                 WHERE build_name = ? AND status = ? LIMIT 1''',
-                              [build_name, QUEUED])
-                    row = c.fetchone()
-                    if row is None:
-                        self._log("Build %s was missing from the database. Skipping." % build_name)
-                        return
-                    source, commit, message, job_name, started = row
-                    owners = get_repo_owners(c, source)
-                    owner_emails = {owner: email for owner, (_, _, _, _, _, email)
-                                    in get_users_by_ids(c, owners).items()}
-                    c.execute("UPDATE builds SET status = ?, updated = ? WHERE build_name = ?",
-                              [IN_PROGRESS, now_str(), build_name])
-                    break
-            except apsw.Error:
-                self._log("Exception raised while setting status to IN_PROGRESS. Retrying...",
-                          exc=True)
-                logging.exception("Failed to retrieve next dockergrader job")
-
         self._log("Started building %s" % build_name)
         try:
-            # if the job doesn't exist for some reason, the resulting TypeError will be caught
-            # and logged
-            assignment = get_assignment_by_name(job_name)
-            due_date = assignment.due_date
-            job_handler = get_job(job_name)
-            log, score = job_handler(source, commit)
-            # Ignore any special encoding inside the log, and just treat it as a bytes
-            log = buffer(log)
-            min_score, max_score = assignment.min_score, assignment.max_score
-            full_score = assignment.full_score
-            if score < min_score or score > max_score:
-                raise ValueError("A score of %s is not in the acceptable range of %f to %f" %
-                                 (str(score), min_score, max_score))
-        except JobFailedError as e:
-            self._log("Failed %s with JobFailedError" % build_name, exc=True)
-            with DbCursor() as c:
-                c.execute('''UPDATE builds SET status = ?, updated = ?, log = ?
-                             WHERE build_name = ?''', [FAILED, now_str(), str(e), build_name])
-            if config.mailer_enabled:
-                try:
-                    for owner in owners:
-                        email = owner_emails.get(owner)
-                        if not email:
-                            continue
-                        subject = "%s failed to complete" % build_name
-                        send_template("build_failed", email, subject, build_name=build_name,
-                                      job_name=job_name, source=source, commit=commit,
-                                      message=message, error_message=str(e))
-                except Exception:
-                    self._log("Exception raised while reporting JobFailedError", exc=True)
-                    logging.exception("Exception raised while reporting JobFailedError")
-                else:
-                    self._log("JobFailedError successfully reported via email")
-            return
-        except Exception as e:
-            self._log("Exception raised while building %s" % build_name, exc=True)
-            logging.exception("Internal error within build %s" % build_name)
-            with DbCursor() as c:
-                c.execute('''UPDATE builds SET status = ?, updated = ?, log = ?
-                             WHERE build_name = ?''',
-                          [FAILED, now_str(), "Build failed due to an internal error.", build_name])
-            return
-
-        self._log("Autograder build %s complete (score: %s)" % (build_name, str(score)))
-
-        while True:
             try:
-                with DbCursor() as c:
-                    c.execute('''UPDATE builds SET status = ?, score = ?, updated = ?,
-                                 log = ? WHERE build_name = ?''',
-                              [SUCCESS, score, now_str(), log, build_name])
-                    slipunits = slip_units(due_date, started)
-                    affected_users = assign_grade_batch(c, owners, job_name, float(score),
-                                                        slipunits, build_name, "Automatic build.",
-                                                        "autograder", dont_lower=True)
-                    break
-            except apsw.Error:
-                self._log("Exception raised while assigning grades", exc=True)
-                logging.exception("Failed to update build %s after build completed" % build_name)
+                # Job handlers can stream their output to get_log_sink() while the build runs.
+                with capture(build_name):
+                    build_log, score = run_build(job_name, source, commit)
+            except JobFailedError as e:
+                self._log("Failed %s with JobFailedError" % build_name, exc=True)
+                self._fail_build(build_name, str(e))
                 return
-
-        if config.mailer_enabled:
-            try:
-                for owner in owners:
-                    email = owner_emails.get(owner)
-                    if not email:
-                        continue
-                    subject = "%s complete - score %s / %s" % (build_name, str(score),
-                                                               str(full_score))
-                    if owner not in affected_users:
-                        subject += " (no effect on grade)"
-                    else:
-                        if slipunits == 1:
-                            subject += " (1 %s used)" % config.slip_unit_name_singular
-                        elif slipunits > 0:
-                            subject += " (%s slip %s used)" % (str(slipunits),
-                                                               config.slip_unit_name_plural)
-                    send_template("build_finished", email, subject, build_name=build_name,
-                                  job_name=job_name, score=score, full_score=str(full_score),
-                                  slipunits=slipunits, log=log, source=source, commit=commit,
-                                  message=message, affected=(owner in affected_users))
             except Exception:
-                self._log("Exception raised while reporting grade", exc=True)
-                logging.exception("Exception raised while reporting grade")
-            else:
-                self._log("Grade successfully reported via email")
+                self._log("Exception raised while building %s" % build_name, exc=True)
+                logging.exception("Internal error within build %s" % build_name)
+                self._fail_build(build_name, None, internal_error=True)
+                return
+
+            self._log("Autograder build %s complete (score: %s)" % (build_name, str(score)))
+            self._finish_build(build_name, score, build_log)
+        finally:
+            # fail_build and finish_build mark the output as finished once the result is saved. If
+            # they raise, this still releases the output and the readers that are waiting on it.
+            live_output.finish(build_name)
 
     def run(self):
         while True:
-            job = self._dequeue_job()
-            self._process_job(job)
+            build = self._dequeue_build()
+            if build is None:
+                self._log("Worker retired")
+                return
+            self._process_build(build)
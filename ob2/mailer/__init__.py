@@ -1,13 +1,15 @@
 import logging
 import smtplib
+import socket
+import threading
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import make_msgid
-from flask import url_for
+from flask import has_app_context
 from jinja2 import Environment, PackageLoader
 from os.path import basename
-from werkzeug.urls import url_unparse
+from time import sleep, time
 
 import ob2.config as config
 from ob2.database import DbCursor
@@ -19,6 +21,9 @@ from ob2.util.resumable_queue import ResumableQueue
 jinja_environment = None
 app = None
 
+# The URL adapter of the batch of emails that is being rendered on this thread (see render_emails)
+_batch = threading.local()
+
 
 def send_template(*args, **kwargs):
     """
@@ -30,7 +35,7 @@ def send_template(*args, **kwargs):
         raise RuntimeError("Cannot send mail while mailer is disabled")
     email = create_email(*args, **kwargs)
     with DbCursor() as c:
-        job = mailer_queue.create(c, "send", email)
+        job = mailer_queue.create(c, "send_template", email)
     mailer_queue.enqueue(job)
 
 
@@ -50,55 +55,139 @@ def create_email(_template_name, _to, _subject, _from=None, _attachments=[],
         _message_id      -- If this message is a REPLY, then specify the message ID(s) of the
                             previous messages in this chain.
 
-    Returns an opaque object (spoiler: it's a tuple) which should be passed directly to
-    mailer_queue.enqueue().
+    The email is not rendered yet. Only the template name, the parameters and the paths of the
+    attachments are stored, and render_emails() builds the message when it is sent. So, the
+    parameters must be JSON-serializable (byte strings are decoded as UTF-8), and the attachments
+    must still exist when the email is sent.
+
+    Returns an opaque object (spoiler: it's a dictionary) which should be passed directly to
+    mailer_queue.create() with the "send_template" operation.
 
     """
     if not config.mailer_enabled:
         raise RuntimeError("Cannot create mail while mailer is disabled")
     if _from is None:
         _from = config.mailer_from
+    for attachment_type, _ in _attachments:
+        if attachment_type != "pdf":
+            raise ValueError("Unsupported attachment type: %s" % attachment_type)
+    return {"template_name": _template_name,
+            "to": _to,
+            "subject": _subject,
+            "from": _from,
+            "attachments": [list(attachment) for attachment in _attachments],
+            "message_id": _message_id,
+            # Generated now, so that the message keeps its ID if sending it has to be retried
+            "msgid": make_msgid(),
+            "kwargs": _make_json_safe(kwargs)}
+
+
+def render_email(email):
+    """
+    Renders an email that was prepared by create_email(). Returns (from, to, message).
+
+    """
     msg = MIMEMultipart('alternative')
-    msg['Subject'] = _subject
-    msg['From'] = _from
-    msg['To'] = _to
-    msg['Message-Id'] = make_msgid()
-    if _message_id:
-        msg['References'] = _message_id
-        msg['In-Reply-To'] = _message_id
-    body_plain = render_template("%s.txt" % _template_name, **kwargs)
-    body_html = render_template("%s.html" % _template_name, **kwargs)
+    msg['Subject'] = email["subject"]
+    msg['From'] = email["from"]
+    msg['To'] = email["to"]
+    msg['Message-Id'] = email["msgid"]
+    if email["message_id"]:
+        msg['References'] = email["message_id"]
+        msg['In-Reply-To'] = email["message_id"]
+    kwargs = email["kwargs"]
+    body_plain = render_template("%s.txt" % email["template_name"], **kwargs)
+    body_html = render_template("%s.html" % email["template_name"], **kwargs)
     msg.attach(MIMEText(body_plain, 'plain', 'utf-8'))
     msg.attach(MIMEText(body_html, 'html', 'utf-8'))
-    for attachment_type, attachment_path in _attachments:
+    for attachment_type, attachment_path in email["attachments"]:
         attachment_name = basename(attachment_path)
         with open(attachment_path, "rb") as attachment_file:
-            attachment_bytes = attachment_file.read()
-        if attachment_type == "pdf":
-            attachment = MIMEApplication(attachment_bytes, _subtype="pdf")
-            attachment.add_header("Content-Disposition", "attachment", filename=attachment_name)
-            msg.attach(attachment)
-        else:
-            raise ValueError("Unsupported attachment type: %s" % attachment_type)
-    return _from, _to, msg.as_string()
+            attachment = MIMEApplication(attachment_file.read(), _subtype=attachment_type)
+        attachment.add_header("Content-Disposition", "attachment", filename=attachment_name)
+        msg.attach(attachment)
+    return email["from"], email["to"], msg.as_string()
+
+
+def render_emails(emails):
+    """
+    Renders many emails that were prepared by create_email(), in one application context and with
+    one URL adapter. Returns a list with (from, to, message) for each email, or None for each email
+    that could not be rendered.
+
+    """
+    if app is None:
+        raise RuntimeError("No web application registered with mailer")
+    _batch.url_adapter = get_url_adapter()
+    try:
+        with app.app_context():
+            rendered = []
+            for email in emails:
+                try:
+                    rendered.append(render_email(email))
+                except Exception:
+                    logging.exception("Error occurred while rendering email to %s" % email["to"])
+                    rendered.append(None)
+            return rendered
+    finally:
+        _batch.url_adapter = None
+
+
+def _make_json_safe(value):
+    if isinstance(value, (buffer, bytearray)):
+        value = str(value)
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    elif isinstance(value, dict):
+        return {key: _make_json_safe(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_make_json_safe(item) for item in value]
+    return value
 
 
 def get_jinja_environment():
     global jinja_environment
     if jinja_environment is None:
-        jinja_environment = Environment(loader=PackageLoader("ob2.mailer", "templates"))
+        # Compiled templates are cached by the environment. We don't check whether the template
+        # files have changed, because they only change when ob2 is upgraded.
+        jinja_environment = Environment(loader=PackageLoader("ob2.mailer", "templates"),
+                                        auto_reload=False)
         jinja_environment.globals.update(JINJA_EXPORTS)
-        jinja_environment.globals["url_for"] = url_for
+        jinja_environment.globals["url_for"] = _url_for
     return jinja_environment
 
 
+def get_url_adapter():
+    """
+    Returns a URL adapter for building external URLs to the web interface, so that rendering an
+    email does not need a fake request context. While render_emails() is running, this is the
+    adapter of its batch.
+
+    """
+    url_adapter = getattr(_batch, "url_adapter", None)
+    if url_adapter is None:
+        if app is None:
+            raise RuntimeError("No web application registered with mailer")
+        url_adapter = app.url_map.bind(config.web_public_host, script_name="/",
+                                       url_scheme="https" if config.web_https else "http")
+    return url_adapter
+
+
+def _url_for(endpoint, **values):
+    # A replacement for flask.url_for in email templates
+    external = values.pop("_external", False)
+    app.inject_url_defaults(endpoint, values)
+    return get_url_adapter().build(endpoint, values, force_external=external)
+
+
 def render_template(template_file_name, **kwargs):
     if app is None:
         raise RuntimeError("No web application registered with mailer")
     template = get_jinja_environment().get_template(template_file_name)
-    base_url = url_unparse(("https" if config.web_https else "http",
-                            config.web_public_host, "/", "", ""))
-    with app.test_request_context(base_url=base_url):
+    if has_app_context():
+        return template.render(**kwargs)
+    # Templates and hooks may use Flask features that need an application context.
+    with app.app_context():
         return template.render(**kwargs)
 
 
@@ -118,26 +207,106 @@ class MailerQueue(ResumableQueue):
     queue_name = "mailerqueue"
     database_table = "mailerqueue"
 
+    def __init__(self):
+        super(MailerQueue, self).__init__()
+        self.smtp_server = None
+        self.last_sent = 0
+
+    @property
+    def batch_size(self):
+        return config.mailer_batch_size
+
+    def connect(self):
+        """
+        Connects to the configured SMTP server, using the connect-to-smtp filter.
+
+        """
+        # This is a useful hook for changing the SMTP server that is used by the mail queue. You
+        # can, for example, connect to a 3rd party email relay to send emails. You can also just
+        # connect to 127.0.0.1 (there's a mail server running on most of the INST servers).
+        #
+        # Arguments:
+        #   smtp_server -- A smtplib.SMTP() object.
+        #
+        # Returns:
+        #   An smtplib.SMTP() object (or compatible) that can be used to send mail.
+        return apply_filters("connect-to-smtp", smtplib.SMTP())
+
+    def disconnect(self):
+        if self.smtp_server is not None:
+            try:
+                self.smtp_server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp_server = None
+
+    def check_connection(self):
+        """
+        Closes the SMTP connection if it is not alive anymore. The connection is kept open between
+        batches, but SMTP servers drop idle connections after a while.
+
+        """
+        if self.smtp_server is not None:
+            try:
+                status, _ = self.smtp_server.noop()
+            except (smtplib.SMTPException, socket.error):
+                status = None
+            if status != 250:
+                self.disconnect()
+
+    def get_smtp_server(self):
+        if self.smtp_server is None:
+            self.smtp_server = self.connect()
+        return self.smtp_server
+
+    def wait_for_rate_limit(self):
+        if config.mailer_rate_limit > 0:
+            delay = self.last_sent + 1.0 / config.mailer_rate_limit - time()
+            if delay > 0:
+                sleep(delay)
+        self.last_sent = time()
+
+    def send(self, payload):
+        """
+        Sends an email over the shared SMTP connection. If the connection fails, reconnects and
+        tries once more.
+
+        """
+        self.wait_for_rate_limit()
+        try:
+            self.get_smtp_server().sendmail(*payload)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            logging.warning("Lost connection to the SMTP server. Reconnecting...")
+            self.disconnect()
+            self.get_smtp_server().sendmail(*payload)
+
+    def process_jobs(self, jobs):
+        self.check_connection()
+        # The templated emails of the whole batch are rendered at once, and then they are sent like
+        # emails that were already rendered. An email that can't be rendered fails on its own.
+        rendered = iter(render_emails([payload for _, operation, payload in jobs
+                                       if operation == "send_template"]))
+        rendered_jobs = []
+        for transaction_id, operation, payload in jobs:
+            if operation == "send_template":
+                payload = next(rendered)
+                if payload is None:
+                    continue
+                operation = "send"
+            rendered_jobs.append((transaction_id, operation, payload))
+        return super(MailerQueue, self).process_jobs(rendered_jobs)
+
     def process_job(self, operation, payload):
         """
-        Connects to the configured SMTP server using connect_to_smtp defined in config/algorithms
-        and sends an email.
+        Sends an email. Emails are processed in batches of mailer_batch_size, and they all share
+        one SMTP connection.
 
         """
-        if operation == "send":
-            # This is a useful hook for changing the SMTP server that is used by the mail queue. You
-            # can, for example, connect to a 3rd party email relay to send emails. You can also just
-            # connect to 127.0.0.1 (there's a mail server running on most of the INST servers).
-            #
-            # Arguments:
-            #   smtp_server -- A smtplib.SMTP() object.
-            #
-            # Returns:
-            #   An smtplib.SMTP() object (or compatible) that can be used to send mail.
-            smtp_server = apply_filters("connect-to-smtp", smtplib.SMTP())
-
-            smtp_server.sendmail(*payload)
-            smtp_server.quit()
+        if operation == "send_template":
+            self.send(render_email(payload))
+        elif operation == "send":
+            # Emails that were queued before emails were rendered at send time
+            self.send(payload)
         else:
             logging.warning("Unknown operation requested in mailerqueue: %s" % operation)
 
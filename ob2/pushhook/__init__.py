@@ -0,0 +1,106 @@
+import apsw
+import logging
+
+import ob2.config as config
+from ob2.database import DbCursor
+from ob2.dockergrader import create_build_job, dockergrader_queue, worker_pool
+from ob2.util.archive_cache import archive_cache
+from ob2.util.github_api import get_commit_message, get_diff_file_list
+from ob2.util.hooks import apply_filters
+from ob2.util.pushhook_payload import parse_push_payload
+from ob2.util.resumable_queue import ResumableQueue
+
+
+def ingest_push(payload):
+    """
+    Creates builds for a GitHub push. PAYLOAD is the push hook payload, as it was stored by the
+    push hook endpoint.
+
+    This is safe to run more than once for the same push, because build requests for a commit that
+    is already queued or built are attached to the existing build (see create_build_job).
+
+    """
+    ref = payload["ref"]
+    before = payload["before"]
+    after = payload["after"]
+    repo_name = payload["repository"]["name"]
+    # The payload usually has everything we need. We only ask the GitHub API if it doesn't.
+    file_list, message = parse_push_payload(payload)
+    if file_list is None:
+        file_list = get_diff_file_list(repo_name, before, after)
+    if not file_list:
+        file_list = []
+
+    # This is a useful hook to use, if you want to add custom logic to determine which jobs get
+    # run on a Git push.
+    #
+    # Arguments:
+    #   jobs           -- The original list of jobs (default: empty list)
+    #   repo_name      -- The name of the repo that caused the pushhook
+    #   ref            -- The name of the ref that was pushed (e.g. "refs/heads/master")
+    #   modified_files -- A list of files that were changed in the push, relative to repo root
+    #
+    # Returns:
+    #   A list of job names. (e.g. ["hw0", "hw0-style-check"])
+    jobs_to_run = apply_filters("pushhooks-jobs-to-run", [], repo_name, ref, file_list)
+
+    if not jobs_to_run:
+        return
+
+    if message is None:
+        message = get_commit_message(repo_name, after)
+
+    # Starts downloading the code now, so it is ready by the time a worker picks up the build. The
+    # cache is on this server's disk, so only local workers can use it. Remote workers download the
+    # code themselves.
+    size, running = worker_pool.get_size()
+    if size or running or config.dockergrader_autoscale:
+        archive_cache.prefetch(repo_name, after)
+
+    # All the builds for this push are created in one transaction.
+    for attempt in range(PushhookQueue.max_transaction_attempts):
+        try:
+            with DbCursor() as c:
+                jobs = [create_build_job(c, job_to_run, repo_name, after, message,
+                                         "GitHub push")[1]
+                        for job_to_run in jobs_to_run]
+            break
+        except apsw.Error:
+            if attempt + 1 == PushhookQueue.max_transaction_attempts:
+                raise
+            logging.exception("Failed to create builds, retrying...")
+    for job in jobs:
+        if job:
+            dockergrader_queue.enqueue(job)
+
+
+class PushhookQueue(ResumableQueue):
+    queue_name = "pushhookqueue"
+    database_table = "pushhookqueue"
+
+    # How many times to try the transaction that creates the builds for a push. If it still fails,
+    # the job fails, and the queue tries it again later with exponential backoff. After
+    # max_attempts failures, the push is marked as dead and left in the pushhookqueue table.
+    max_transaction_attempts = 5
+
+    def get_job_key(self, operation, payload):
+        # Pushes to the same repo are ingested in order
+        return payload["repository"]["name"]
+
+    def process_job(self, operation, payload):
+        """
+        Turns GitHub pushes into builds. The push hook endpoint only stores the payload, so that it
+        can answer GitHub right away. The GitHub API requests and the build creation happen here.
+
+        """
+        if operation == "ingest":
+            ingest_push(payload)
+        else:
+            logging.warning("Unknown operation requested in pushhookqueue: %s" % operation)
+
+
+pushhook_queue = PushhookQueue()
+
+
+def main():
+    pushhook_queue.run()
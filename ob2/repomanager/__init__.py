@@ -9,6 +9,11 @@ class Repomanager(ResumableQueue):
     queue_name = "repomanager"
     database_table = "repomanager"
 
+    def get_job_key(self, operation, payload):
+        # Changes to the same repo are made in order
+        if operation == "assign_repo":
+            return payload[0]
+
     def process_job(self, operation, payload):
         """
         Processes API requests for GitHub that are NOT read-only.
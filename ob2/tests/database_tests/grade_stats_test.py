@@ -0,0 +1,79 @@
+from unittest2 import TestCase
+
+from ob2.database import DbCursor
+from ob2.database.grade_stats import _GradeStatsCache, grade_stats
+from ob2.database.helpers import assign_grade_batch, assign_grades_bulk
+
+USERS = [990101, 990102, 990103, 990104]
+
+
+class GradeStatsTest(TestCase):
+    def setUp(self):
+        with DbCursor() as c:
+            c.executemany('''INSERT INTO users (id, name, sid, login, github, email, super)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          [(user, "Test", str(user), "test%d" % user, "test%d" % user,
+                            "test%d@example.com" % user, int(user == USERS[-1]))
+                           for user in USERS])
+        self.addCleanup(self._delete_users)
+
+    def _delete_users(self):
+        placeholders = ",".join(["?"] * len(USERS))
+        with DbCursor() as c:
+            c.execute("DELETE FROM grades WHERE user IN (%s)" % placeholders, USERS)
+            c.execute("DELETE FROM gradeslog WHERE user IN (%s)" % placeholders, USERS)
+            c.execute("DELETE FROM users WHERE id IN (%s)" % placeholders, USERS)
+
+    def _assign(self, users, score):
+        with DbCursor() as c:
+            assign_grade_batch(c, users, "midterm", score, 0, "t1", "Test", "test")
+
+    def _assert_matches_recompute(self):
+        """
+        Checks that the cached statistics are the same as statistics computed from scratch.
+
+        """
+        with DbCursor(read_only=True) as c:
+            cache = _GradeStatsCache()
+            count, mean, stddev = grade_stats.get_summary(c, "midterm")
+            expected_count, expected_mean, expected_stddev = cache.get_summary(c, "midterm")
+            self.assertEqual(expected_count, count)
+            self.assertAlmostEqual(expected_mean, mean)
+            self.assertAlmostEqual(expected_stddev, stddev, places=5)
+            for score in [0.0, 4.0, 7.5, 100.0]:
+                self.assertEqual(cache.get_rank(c, "midterm", score),
+                                 grade_stats.get_rank(c, "midterm", score))
+            self.assertEqual(cache.get_histogram(c, "midterm", "scores", list),
+                             grade_stats.get_histogram(c, "midterm", "scores", list))
+
+    def test_incremental_update(self):
+        self._assign(USERS[:2], 5.0)
+        with DbCursor(read_only=True) as c:
+            grade_stats.get_summary(c, "midterm")
+        stats = grade_stats._stats["midterm"]
+
+        self._assign(USERS, 7.5)
+        self._assign(USERS[1:3], 4.0)
+        with DbCursor() as c:
+            assign_grades_bulk(c, [(USERS[0], 10.0, None), (USERS[3], 2.0, 1)], "midterm", "t2",
+                               "Test", "test")
+        self._assert_matches_recompute()
+        # The cached statistics were updated, not rebuilt.
+        self.assertIs(stats, grade_stats._stats["midterm"])
+
+    def test_missed_change(self):
+        self._assign(USERS[:2], 5.0)
+        with DbCursor(read_only=True) as c:
+            grade_stats.get_summary(c, "midterm")
+        stats = grade_stats._stats["midterm"]
+
+        # A change that does not go through the helpers (like an edit in the sqlite3 shell) bumps
+        # the version, so the cache can't apply the next update on top of its old statistics.
+        with DbCursor() as c:
+            c.execute("UPDATE grades SET score = 1.0 WHERE assignment = 'midterm' AND user = ?",
+                      [USERS[0]])
+        self._assign(USERS[2:], 6.0)
+        self.assertIs(stats, grade_stats._stats["midterm"])
+        # So, the statistics are rebuilt (including the missed change) the next time they are used.
+        self._assert_matches_recompute()
+        self.assertIsNot(stats, grade_stats._stats["midterm"])
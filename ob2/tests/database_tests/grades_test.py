@@ -0,0 +1,77 @@
+from unittest2 import TestCase
+
+from ob2.database import DbCursor
+from ob2.database.helpers import assign_grade_batch, assign_grades_bulk
+
+USERS = [990001, 990002, 990003, 990004]
+
+
+class _Rollback(Exception):
+    pass
+
+
+class GradesTest(TestCase):
+    def _run(self, assign):
+        """
+        Runs ASSIGN(c) against a few test users (two of whom already have grades), and returns its
+        result with the resulting grades and log entries. The transaction is always rolled back.
+
+        """
+        result = []
+        with self.assertRaises(_Rollback):
+            with DbCursor() as c:
+                c.executemany('''INSERT INTO users (id, name, sid, login, github, email, super)
+                                 VALUES (?, ?, ?, ?, ?, ?, 0)''',
+                              [(user, "Test", str(user), "test%d" % user, "test%d" % user,
+                                "test%d@example.com" % user) for user in USERS])
+                c.executemany('''INSERT INTO grades (user, assignment, score, slipunits, manual)
+                                 VALUES (?, 'hw0', ?, ?, 0)''',
+                              [(USERS[0], 5.0, 1), (USERS[1], 9.0, 0)])
+                affected = assign(c)
+                c.execute('''SELECT user, score, slipunits, manual FROM grades
+                             WHERE assignment = 'hw0' AND user IN (%s) ORDER BY user''' %
+                          ",".join(["?"] * len(USERS)), USERS)
+                grades = c.fetchall()
+                c.execute('''SELECT transaction_name, source, user, score, slipunits FROM gradeslog
+                             WHERE user IN (%s) ORDER BY user''' % ",".join(["?"] * len(USERS)),
+                          USERS)
+                log = c.fetchall()
+                result.append((sorted(affected), grades, log))
+                raise _Rollback()
+        return result[0]
+
+    def _assign_one_at_a_time(self, entries, **kwargs):
+        def assign(c):
+            affected = []
+            for user, score, slipunits in entries:
+                affected += assign_grade_batch(c, [user], "hw0", score, slipunits, "t1", "Test",
+                                               "test", **kwargs)
+            return affected
+        return self._run(assign)
+
+    def _assign_bulk(self, entries, **kwargs):
+        return self._run(lambda c: assign_grades_bulk(c, entries, "hw0", "t1", "Test", "test",
+                                                      **kwargs))
+
+    def test_assign_grades_bulk(self):
+        entries = [(USERS[0], 7.0, None), (USERS[1], 8.0, 2), (USERS[2], 6.0, 1),
+                   (USERS[3], None, 3)]
+        expected = self._assign_one_at_a_time(entries, manual=True)
+        self.assertEqual(expected, self._assign_bulk(entries, manual=True))
+        affected, grades, _ = expected
+        self.assertEqual(USERS, affected)
+        self.assertEqual([(USERS[0], 7.0, 1, 1), (USERS[1], 8.0, 2, 1), (USERS[2], 6.0, 1, 1),
+                          (USERS[3], None, 3, 1)], grades)
+
+    def test_assign_grades_bulk_dont_lower(self):
+        entries = [(USERS[0], 7.0, None), (USERS[1], 8.0, 2), (USERS[2], 6.0, 1)]
+        expected = self._assign_one_at_a_time(entries, dont_lower=True)
+        self.assertEqual(expected, self._assign_bulk(entries, dont_lower=True))
+        affected, grades, _ = expected
+        # The second user already has a higher grade, so it is kept.
+        self.assertEqual([USERS[0], USERS[2]], affected)
+        self.assertEqual([(USERS[0], 7.0, 1, 0), (USERS[1], 9.0, 0, 0), (USERS[2], 6.0, 1, 0)],
+                         grades)
+
+        with self.assertRaises(ValueError):
+            self._assign_bulk([(USERS[3], None, 3)], dont_lower=True)
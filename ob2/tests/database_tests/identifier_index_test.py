@@ -0,0 +1,79 @@
+from mock import patch
+from unittest2 import TestCase
+
+from ob2.database import DbCursor
+from ob2.database.identifier_index import _IdentifierIndex
+
+USERS = [990201, 990202]
+
+
+class IdentifierIndexTest(TestCase):
+    def setUp(self):
+        with DbCursor() as c:
+            c.executemany('''INSERT INTO users (id, name, sid, login, github, email, super)
+                             VALUES (?, ?, ?, ?, ?, ?, 0)''',
+                          [(user, "Test Name %d" % user, "sid%d" % user, "login%d" % user,
+                            "github%d" % user, "test%d@example.com" % user) for user in USERS])
+        self.addCleanup(self._delete_users)
+
+    def _delete_users(self):
+        placeholders = ",".join(["?"] * len(USERS))
+        with DbCursor() as c:
+            c.execute("DELETE FROM groupsusers WHERE user IN (%s)" % placeholders, USERS)
+            c.execute("DELETE FROM users WHERE id IN (%s)" % placeholders, USERS)
+
+    def _resolve_ids(self, index, identifier):
+        return [user[0] for user in index.resolve([identifier])[identifier]]
+
+    def test_changes(self):
+        index = _IdentifierIndex()
+        self.assertEqual([USERS[0]], self._resolve_ids(index, "login%d" % USERS[0]))
+
+        # From now on, the index must only apply the changes, not rebuild itself.
+        with patch.object(index, "_rebuild", side_effect=AssertionError("Rebuilt the index")):
+            with DbCursor() as c:
+                c.execute("UPDATE users SET login = ? WHERE id = ?", ["renamed990201", USERS[0]])
+                c.executemany("INSERT INTO groupsusers (user, `group`) VALUES (?, ?)",
+                              [(user, "group990201") for user in USERS])
+            self.assertEqual([], self._resolve_ids(index, "login%d" % USERS[0]))
+            self.assertEqual([USERS[0]], self._resolve_ids(index, "renamed990201"))
+            self.assertEqual(USERS, self._resolve_ids(index, "group990201"))
+            valid, _ = index.get_valid_ambiguous_identifiers()
+            self.assertIn("group990201", valid)
+            self.assertNotIn("login%d" % USERS[0], valid)
+
+            with DbCursor() as c:
+                c.execute("DELETE FROM groupsusers WHERE user = ?", [USERS[1]])
+                c.execute("DELETE FROM users WHERE id = ?", [USERS[1]])
+            self.assertEqual([], self._resolve_ids(index, "sid%d" % USERS[1]))
+            self.assertEqual([USERS[0]], self._resolve_ids(index, "group990201"))
+
+    def test_prune(self):
+        index = _IdentifierIndex()
+        index.refresh()
+        with DbCursor() as c:
+            c.execute("UPDATE users SET sid = ? WHERE id = ?", ["newsid990201", USERS[0]])
+
+        # Another index (like one in another process) has not read these changes yet.
+        other_index = _IdentifierIndex()
+        other_index.refresh()
+        with DbCursor() as c:
+            c.execute("INSERT INTO groupsusers (user, `group`) VALUES (?, ?)",
+                      [USERS[1], "group990202"])
+            c.execute("UPDATE users SET sid = ? WHERE id = ?", ["newsid990202", USERS[1]])
+
+        # This change is made after prune() has refreshed the index, so the index has not read
+        # it when the old changes are deleted.
+        def refresh_and_change():
+            _IdentifierIndex.refresh(index)
+            with DbCursor() as c:
+                c.execute("UPDATE users SET login = ? WHERE id = ?", ["late990201", USERS[0]])
+
+        with patch.object(index, "refresh", side_effect=refresh_and_change):
+            self.assertGreater(index.prune(), 0)
+        self.assertEqual([USERS[0]], self._resolve_ids(index, "late990201"))
+
+        # The other index notices that changes were deleted before it read them, so it rebuilds.
+        self.assertEqual([USERS[1]], self._resolve_ids(other_index, "group990202"))
+        self.assertEqual([USERS[1]], self._resolve_ids(other_index, "newsid990202"))
+        self.assertEqual([USERS[0]], self._resolve_ids(other_index, "late990201"))
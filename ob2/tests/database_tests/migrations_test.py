@@ -0,0 +1,83 @@
+import os
+import shutil
+from calendar import timegm
+from mock import patch
+from tempfile import mkdtemp
+from unittest2 import TestCase
+
+import ob2.config as config
+import ob2.database.migrations
+from ob2.database import DbCursor, _connection_pool
+from ob2.database.migrations import migrate
+
+
+class TestTimestampMigration(TestCase):
+    def setUp(self):
+        directory = mkdtemp(prefix="ob2-migrations-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        for p in [patch.object(config, "database_path", os.path.join(directory, "test.sqlite3")),
+                  patch.object(config, "timezone", "US/Pacific"),
+                  patch("sys.stdin", **{"isatty.return_value": True}),
+                  patch("__builtin__.raw_input", return_value="y")]:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(_connection_pool.clear)
+
+        # Builds a database at schema version 19, where the timestamps are still TEXT.
+        with patch.object(ob2.database.migrations, "_convert_timestamps"):
+            migrate()
+        with DbCursor() as c:
+            c.execute("UPDATE options SET value = '19' WHERE key = 'schema_version'")
+
+    def get_schema(self, c, table):
+        c.execute('''SELECT type, name, sql FROM sqlite_master
+                     WHERE type IN ('index', 'trigger') AND tbl_name = ?''', [table])
+        return set(c.fetchall())
+
+    def test_convert_timestamps(self):
+        with DbCursor() as c:
+            c.executemany('''INSERT INTO grades (rowid, user, assignment, score, slipunits, updated,
+                                                 manual)
+                             VALUES (?, ?, 'hw0', 1.0, 0, ?, 0)''',
+                          [(7, 1, "2015-01-02T03:04:05"),
+                           (3, 2, "2015-07-02T03:04:05.123456-07:00"),
+                           (5, 3, "2015-01-02T03:04:05+00:00"),
+                           (9, 4, None)])
+            c.execute('''INSERT INTO builds (build_name, source, `commit`, message, job, status,
+                                             score, started, updated)
+                         VALUES ('hw0-1', 'repo1', 'abc', '', 'hw0', 0, 0.0, ?, NULL)''',
+                      ["2015-01-02T03:04:05-08:00"])
+            c.execute("SELECT version FROM gradesversions WHERE assignment = 'hw0'")
+            version, = c.fetchone()
+            schemas = {table: self.get_schema(c, table) for table in ["grades", "builds"]}
+
+        migrate()
+
+        with DbCursor() as c:
+            c.execute("SELECT value FROM options WHERE key = 'schema_version'")
+            self.assertEqual(("20",), c.fetchone())
+            c.execute("SELECT rowid, user, updated, typeof(updated) FROM grades ORDER BY rowid")
+            # Naive timestamps are in the configured timezone (PST is UTC-8).
+            self.assertEqual([(3, 2, timegm((2015, 7, 2, 10, 4, 5)), "integer"),
+                              (5, 3, timegm((2015, 1, 2, 3, 4, 5)), "integer"),
+                              (7, 1, timegm((2015, 1, 2, 11, 4, 5)), "integer"),
+                              (9, 4, None, "null")],
+                             c.fetchall())
+            c.execute("SELECT started, updated FROM builds")
+            self.assertEqual([(timegm((2015, 1, 2, 11, 4, 5)), None)], c.fetchall())
+            c.execute("PRAGMA table_info(builds)")
+            types = {name: column_type for _, name, column_type, _, _, _ in c.fetchall()}
+            self.assertEqual(("INT", "INT", "TEXT"),
+                             (types["started"], types["updated"], types["job"]))
+
+            # The indexes and triggers are recreated, and the triggers still work.
+            for table, schema in schemas.items():
+                self.assertEqual(schema, self.get_schema(c, table))
+            names = [name for schema in schemas.values() for _, name, _ in schema]
+            self.assertIn("grades_update_gradesversions", names)
+            self.assertIn("builds_job_started", names)
+            c.execute("UPDATE grades SET score = 2.0 WHERE user = 1")
+            c.execute("SELECT version FROM gradesversions WHERE assignment = 'hw0'")
+            self.assertEqual((version + 1,), c.fetchone())
+            c.execute("SELECT name FROM sqlite_temp_master WHERE name = 'migration_copy'")
+            self.assertIsNone(c.fetchone())
@@ -0,0 +1,35 @@
+from unittest2 import TestCase
+
+from ob2.database import DbCursor
+from ob2.database.helpers import get_page
+
+
+class PaginationTest(TestCase):
+    def _get_page(self, c, after=None, before=None):
+        rows, prev_cursor, next_cursor = get_page(c, "name", "pagination_test", "started", 3,
+                                                  after=after, before=before)
+        return [name for name, in rows], prev_cursor, next_cursor
+
+    def test_get_page(self):
+        with DbCursor() as c:
+            c.execute("CREATE TEMP TABLE pagination_test (name TEXT, started INT)")
+            try:
+                # Rows 2-4 and rows 5-6 have the same order column, so their rowids break the tie.
+                c.executemany("INSERT INTO pagination_test (rowid, name, started) VALUES (?, ?, ?)",
+                              [(1, "a", 1), (2, "b", 2), (3, "c", 2), (4, "d", 2), (5, "e", 3),
+                               (6, "f", 3), (7, "g", 4)])
+
+                self.assertEqual((["g", "f", "e"], None, 5), self._get_page(c))
+                self.assertEqual((["d", "c", "b"], 4, 2), self._get_page(c, after=5))
+                self.assertEqual((["a"], 1, None), self._get_page(c, after=2))
+                self.assertEqual(([], None, None), self._get_page(c, after=1))
+
+                # Going back from the last page
+                self.assertEqual((["d", "c", "b"], 4, 2), self._get_page(c, before=1))
+                self.assertEqual((["g", "f", "e"], None, 5), self._get_page(c, before=4))
+                self.assertEqual(([], None, None), self._get_page(c, before=7))
+
+                with self.assertRaises(ValueError):
+                    self._get_page(c, after=5, before=1)
+            finally:
+                c.execute("DROP TABLE pagination_test")
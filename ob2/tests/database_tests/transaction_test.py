@@ -61,3 +61,23 @@ class TransactionTest(TestCase):
             value, = c.fetchone()
             c.execute("DELETE FROM options WHERE key = ?", ["test_value1"])
             self.assertEqual("oky", value)
+
+    def test_read_only_during_write(self):
+        with DbCursor() as c:
+            c.execute("DELETE FROM options WHERE key = ?", ["test_value2"])
+            c.execute("INSERT INTO options (key, value) VALUES (?, ?)", ["test_value2", "old"])
+
+        # A read-only transaction should not wait for the writer, and it should not see the
+        # writer's uncommitted changes.
+        with DbCursor() as writer:
+            writer.execute("UPDATE options SET value = ? WHERE key = ?", ["new", "test_value2"])
+            with DbCursor(read_only=True) as reader:
+                reader.execute("SELECT value FROM options WHERE key = ?", ["test_value2"])
+                value, = reader.fetchone()
+                self.assertEqual(value, "old")
+
+        with DbCursor() as c:
+            c.execute("SELECT value FROM options WHERE key = ?", ["test_value2"])
+            value, = c.fetchone()
+            c.execute("DELETE FROM options WHERE key = ?", ["test_value2"])
+            self.assertEqual("new", value)
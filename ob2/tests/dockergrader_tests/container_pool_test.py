@@ -0,0 +1,55 @@
+import os
+from mock import MagicMock, patch
+from time import sleep
+from unittest2 import TestCase
+
+from ob2.dockergrader.helpers import get_working_directory
+from ob2.dockergrader.rpc import DockerClient, container_pool
+
+
+class TestContainerPool(TestCase):
+    def setUp(self):
+        # Records the inode of the directory that is mounted in each container, by container ID.
+        self.mounted = {}
+
+        def create_container(image, volumes, host_config, **kwargs):
+            container_id = "container%d" % (len(self.mounted) + 1)
+            local_path = host_config["Binds"][0].split(":")[0]
+            self.mounted[container_id] = os.stat(local_path).st_ino
+            return {"Id": container_id}
+
+        client = MagicMock()
+        client.create_container.side_effect = create_container
+        client.inspect_container.return_value = {"Image": "image1", "State": {"Running": True}}
+        client.inspect_image.return_value = {"Id": "image1"}
+        patcher = patch("ob2.dockergrader.rpc.docker.Client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(container_pool.clear, "unix://var/run/docker.sock")
+
+    def _wait_for_warm_container(self):
+        for _ in range(100):
+            if any(container_pool._ready.values()):
+                return
+            sleep(0.05)
+        self.fail("No warm container was started")
+
+    @patch("ob2.config.dockergrader_warm_containers", 1)
+    def test_job_with_volumes_takes_warm_container(self):
+        docker_client = DockerClient()
+        with get_working_directory() as wd:
+            container = docker_client.start("image1", volumes={wd: "/host"})
+            self.assertEqual("container1", container.container_id)
+        self._wait_for_warm_container()
+
+        with get_working_directory() as wd:
+            with open(os.path.join(wd, "archive.tar.gz"), "w") as f:
+                f.write("code")
+            container = docker_client.start("image1", volumes={wd: "/host"})
+            self.assertEqual("container2", container.container_id)
+
+            # The job's working directory is now the one that is mounted in the warm container,
+            # and it still has the job's code.
+            self.assertEqual(self.mounted["container2"], os.stat(wd).st_ino)
+            with open(os.path.join(wd, "archive.tar.gz")) as f:
+                self.assertEqual("code", f.read())
@@ -0,0 +1,54 @@
+import os
+import shutil
+from mock import patch
+from tempfile import mkdtemp
+from unittest2 import TestCase
+
+import ob2.config as config
+from ob2.database import DbCursor, _connection_pool
+from ob2.database.migrations import migrate
+from ob2.dockergrader.queue import dockergrader_queue
+
+
+class TestDequeue(TestCase):
+    def setUp(self):
+        # The queue is shared by the whole database, so each test gets a scratch database.
+        directory = mkdtemp(prefix="ob2-queue-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        for p in [patch.object(config, "database_path", os.path.join(directory, "test.sqlite3")),
+                  patch("sys.stdin", **{"isatty.return_value": True}),
+                  patch("__builtin__.raw_input", return_value="y")]:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(_connection_pool.clear)
+        migrate()
+
+        patcher = patch("ob2.dockergrader.queue.DbCursor", side_effect=DbCursor)
+        self.cursors = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_writes(self):
+        return [args for args in self.cursors.call_args_list if not args[1].get("read_only")]
+
+    def test_idle_poll_does_not_write(self):
+        self.assertIsNone(dockergrader_queue.dequeue("worker1", timeout=0))
+        self.assertTrue(self.cursors.called)
+        self.assertEqual([], self.get_writes())
+
+    def test_claim(self):
+        with DbCursor() as c:
+            dockergrader_queue.create(c, "hw0-990401", "repo1", "GitHub push")
+
+        job = dockergrader_queue.dequeue("worker1", timeout=0, lease=-1)
+        self.assertEqual("hw0-990401", job.build_name)
+        self.assertEqual(1, len(self.get_writes()))
+
+        # The lease has already expired, so the job goes to the next worker that asks.
+        job = dockergrader_queue.dequeue("worker2", timeout=0, lease=60)
+        self.assertEqual("hw0-990401", job.build_name)
+        with DbCursor(read_only=True) as c:
+            self.assertTrue(dockergrader_queue.is_claimed_by(c, "hw0-990401", "worker2"))
+
+        self.cursors.reset_mock()
+        self.assertIsNone(dockergrader_queue.dequeue("worker3", timeout=0))
+        self.assertEqual([], self.get_writes())
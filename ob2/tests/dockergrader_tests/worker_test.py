@@ -0,0 +1,21 @@
+from mock import patch
+from unittest2 import TestCase
+
+from ob2.dockergrader.live_output import live_output
+from ob2.dockergrader.queue import dockergrader_queue
+from ob2.dockergrader.worker import Worker
+
+
+class TestWorker(TestCase):
+    def setUp(self):
+        self.worker = Worker()
+        self.addCleanup(dockergrader_queue.unregister_worker, self.worker)
+
+    @patch("ob2.dockergrader.worker.fail_build", side_effect=RuntimeError("Mailer is broken"))
+    @patch("ob2.dockergrader.worker.run_build", side_effect=ValueError("Bad score"))
+    def test_output_finished_when_fail_build_raises(self, run_build, fail_build):
+        with self.assertRaises(RuntimeError):
+            self.worker._process_build(("hw0-990301", "hw0", "repo1", "abc"))
+        fail_build.assert_called_once_with("hw0-990301", None, internal_error=True,
+                                           log=self.worker._log)
+        self.assertEqual(("", 0, True), live_output.read("hw0-990301", 0))
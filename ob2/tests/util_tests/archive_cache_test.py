@@ -0,0 +1,120 @@
+import os
+import shutil
+import threading
+from hashlib import sha1
+from mock import patch
+from tempfile import mkdtemp
+from time import sleep
+from unittest2 import TestCase
+
+import ob2.config as config
+from ob2.util.archive_cache import _ArchiveCache
+
+
+def _ref(i):
+    return sha1(str(i)).hexdigest()
+
+
+class TestArchiveCache(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp(prefix="ob2-archive-cache-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_path = os.path.join(self.directory, "cache")
+        # Room for 2 archives of 400 bytes, but not 3
+        max_size = 1000.0 / (1024 * 1024)
+        for p in [patch.object(config, "archive_cache_path", self.cache_path),
+                  patch.object(config, "archive_cache_max_size", max_size),
+                  patch("ob2.util.github_api.download_archive", side_effect=self.download)]:
+            p.start()
+            self.addCleanup(p.stop)
+        self.downloads = []
+        self.downloads_lock = threading.Lock()
+        self.download_hook = None
+        self.archive_cache = _ArchiveCache()
+
+    def download(self, repo_name, ref, output_file, file_format):
+        with self.downloads_lock:
+            self.downloads.append(ref)
+        if self.download_hook:
+            self.download_hook(ref)
+        with open(output_file, "w") as f:
+            f.write(ref[0] * 400)
+        return True
+
+    def get(self, ref):
+        output_file = os.path.join(self.directory, "output")
+        self.assertTrue(self.archive_cache.download_archive("repo1", ref, output_file))
+        with open(output_file) as f:
+            self.assertEqual(ref[0] * 400, f.read())
+
+    def get_cache_file(self, ref):
+        return self.archive_cache._ensure_cached("repo1", ref, "tarball")
+
+    def test_lru_eviction(self):
+        self.get(_ref(1))
+        self.get(_ref(2))
+        self.assertEqual([_ref(1), _ref(2)], self.downloads)
+        os.utime(self.get_cache_file(_ref(1)), (100, 100))
+        os.utime(self.get_cache_file(_ref(2)), (200, 200))
+
+        # Using the first archive makes it the most recently used one, so the second one is evicted.
+        self.get(_ref(1))
+        self.get(_ref(3))
+        self.assertEqual([_ref(1), _ref(2), _ref(3)], self.downloads)
+        self.assertEqual(2, len(os.listdir(self.cache_path)))
+        self.get(_ref(1))
+        self.assertEqual(3, len(self.downloads))
+        self.get(_ref(2))
+        self.assertEqual(_ref(2), self.downloads[-1])
+
+        # Branch names are never cached.
+        self.get("master")
+        self.get("master")
+        self.assertEqual(["master", "master"], self.downloads[-2:])
+
+    def test_same_archive_downloaded_once(self):
+        self.download_hook = lambda ref: sleep(0.1)
+        errors = []
+
+        def worker():
+            try:
+                self.get_cache_file(_ref(1))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual([_ref(1)], self.downloads)
+
+    def test_different_archives_downloaded_concurrently(self):
+        # Finds two archives that use different locks
+        keys = {}
+        i = 0
+        while len(keys) < 2:
+            key = sha1("repo1/%s/tarball" % _ref(i)).hexdigest()
+            keys.setdefault(self.archive_cache._get_lock(key), _ref(i))
+            i += 1
+        ref1, ref2 = keys.values()
+
+        # The first download waits for the second one to start, which only works if the second one
+        # does not wait for the first one's lock.
+        started = threading.Event()
+        results = []
+
+        def download_hook(ref):
+            if ref == ref1:
+                results.append(started.wait(5))
+            else:
+                started.set()
+        self.download_hook = download_hook
+        thread = threading.Thread(target=self.get_cache_file, args=(ref1,))
+        thread.start()
+        while not self.downloads:
+            sleep(0.01)
+        self.get_cache_file(ref2)
+        thread.join()
+        self.assertEqual([True], results)
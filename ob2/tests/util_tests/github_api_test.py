@@ -0,0 +1,25 @@
+import github3
+from mock import Mock, patch
+from unittest2 import TestCase
+
+from ob2.util import github_api
+
+
+class TestGetRepository(TestCase):
+    def setUp(self):
+        self.addCleanup(github_api._repository_cache.clear)
+
+    def test_refresh_error(self):
+        response = Mock(status_code=404, **{"json.return_value": {"message": "Not Found"}})
+        repository = Mock(**{"refresh.side_effect": github3.GitHubError(response)})
+        github_api._repository_cache.set("repo1", (repository, 0))
+
+        # The repository is gone, so it is forgotten instead of being returned from the cache.
+        self.assertIsNone(github_api._get_repository("repo1"))
+        self.assertIsNone(github_api._repository_cache.get("repo1"))
+
+        new_repository = Mock()
+        github = Mock(**{"repository.return_value": new_repository})
+        with patch.object(github_api, "_get_github_admin", return_value=github):
+            self.assertIs(new_repository, github_api._get_repository("repo1"))
+        self.assertEqual(new_repository, github_api._repository_cache.get("repo1")[0])
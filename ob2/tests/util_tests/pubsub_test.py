@@ -0,0 +1,42 @@
+import threading
+from time import sleep
+from unittest2 import TestCase
+
+from ob2.util.pubsub import PubSub
+
+
+class TestPubSub(TestCase):
+    def test_subscription(self):
+        pubsub = PubSub()
+        subscription_id = pubsub.subscribe(1, ["repo1", "group1"])
+        self.assertEqual(frozenset(["repo1", "group1"]),
+                         pubsub.get_subscription(subscription_id, 1))
+        self.assertIsNone(pubsub.get_subscription(subscription_id, 2))
+        self.assertIsNone(pubsub.get_subscription("nope", 1))
+
+        seq = pubsub.publish("repo2", "ignored")
+        pubsub.publish("group1", "event")
+        events, last_seq, complete = pubsub.wait(pubsub.get_subscription(subscription_id, 1),
+                                                 seq, 0)
+        self.assertEqual([(seq + 1, "group1", "event")], events)
+        self.assertEqual(seq + 1, last_seq)
+        self.assertTrue(complete)
+
+    def test_max_waiters(self):
+        pubsub = PubSub()
+        pubsub.max_waiters = 1
+        results = []
+
+        def waiter():
+            results.append(pubsub.wait(["repo1"], 0, 10))
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        while not pubsub._waiters:
+            sleep(0.01)
+        # The second subscriber does not wait, because the first one already is.
+        self.assertEqual(([], 0, True), pubsub.wait(["repo1"], 0, 10))
+
+        pubsub.publish("repo1", "event")
+        thread.join()
+        self.assertEqual([([(1, "repo1", "event")], 1, True)], results)
@@ -0,0 +1,44 @@
+from unittest2 import TestCase
+
+from ob2.util.pushhook_payload import MAX_PAYLOAD_COMMITS, parse_push_payload
+
+
+def _commit(commit_id, message="Message", added=[], modified=[], removed=[]):
+    return {"id": commit_id, "message": message, "added": added, "modified": modified,
+            "removed": removed}
+
+
+class TestPushhookPayload(TestCase):
+    def test_parse_push_payload(self):
+        head = _commit("b" * 40, "Finish hw1", added=["hw1/b.c"], removed=["hw0/a.c"])
+        payload = {"before": "a" * 40,
+                   "after": "b" * 40,
+                   "forced": False,
+                   "commits": [_commit("c" * 40, modified=["hw1/a.c", "hw1/b.c"]), head],
+                   "head_commit": head}
+        self.assertEqual((["hw0/a.c", "hw1/a.c", "hw1/b.c"], "Finish hw1"),
+                         parse_push_payload(payload))
+
+    def test_fallback(self):
+        head = _commit("b" * 40, "Finish hw1", modified=["hw1/a.c"])
+        payload = {"before": "a" * 40,
+                   "after": "b" * 40,
+                   "forced": True,
+                   "commits": [head],
+                   "head_commit": head}
+        self.assertEqual((None, "Finish hw1"), parse_push_payload(payload))
+
+        payload["forced"] = False
+        payload["commits"] = [head] * MAX_PAYLOAD_COMMITS
+        self.assertEqual((None, "Finish hw1"), parse_push_payload(payload))
+
+        payload["commits"] = [{"id": "b" * 40}]
+        self.assertEqual((None, "Finish hw1"), parse_push_payload(payload))
+
+        payload["commits"] = [head]
+        payload["head_commit"] = None
+        self.assertEqual((["hw1/a.c"], None), parse_push_payload(payload))
+
+    def test_deleted_branch(self):
+        payload = {"before": "a" * 40, "after": "0" * 40, "commits": [], "head_commit": None}
+        self.assertEqual(([], None), parse_push_payload(payload))
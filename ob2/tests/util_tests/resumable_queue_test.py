@@ -0,0 +1,155 @@
+import os
+import shutil
+from mock import patch
+from tempfile import mkdtemp
+from unittest2 import TestCase
+
+import ob2.config as config
+from ob2.database import DbCursor, _connection_pool
+from ob2.util.resumable_queue import ResumableQueue, PENDING, COMPLETED, DEAD
+from ob2.util.time import now_timestamp
+
+
+class _TestQueue(ResumableQueue):
+    queue_name = "testqueue"
+    database_table = "testqueue"
+    batch_size = 10
+    max_attempts = 4
+    backoff_base = 10
+    backoff_max = 30
+
+    def __init__(self):
+        super(_TestQueue, self).__init__()
+        self.processed = []
+        self.failing = set()
+
+    def get_job_key(self, operation, payload):
+        return payload["key"]
+
+    def process_job(self, operation, payload):
+        self.processed.append(payload["name"])
+        if payload["name"] in self.failing:
+            raise ValueError("Job failed: %s" % payload["name"])
+
+
+class TestResumableQueue(TestCase):
+    def setUp(self):
+        # Each test gets its own scratch database, so the queue table starts out empty.
+        directory = mkdtemp(prefix="ob2-queue-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        database_path_patch = patch.object(config, "database_path",
+                                           os.path.join(directory, "test.sqlite3"))
+        database_path_patch.start()
+        self.addCleanup(database_path_patch.stop)
+        self.addCleanup(_connection_pool.clear)
+        with DbCursor() as c:
+            c.execute("CREATE TABLE options (key TEXT PRIMARY KEY, value TEXT)")
+            c.execute('''CREATE TABLE testqueue (id INT PRIMARY KEY, operation TEXT, payload TEXT,
+                                                 updated INT, completed INT,
+                                                 attempts INT DEFAULT 0)''')
+
+        self.now = 1000.0
+        time_patch = patch("ob2.util.resumable_queue.time", side_effect=lambda: self.now)
+        time_patch.start()
+        self.addCleanup(time_patch.stop)
+
+        self.queue = _TestQueue()
+
+    def enqueue(self, *jobs):
+        with DbCursor() as c:
+            job_objects = self.queue.create_batch(c, "test", [{"name": name, "key": key}
+                                                              for name, key in jobs])
+        self.queue.enqueue_batch(job_objects)
+        return [transaction_id for transaction_id, _, _ in job_objects]
+
+    def take_jobs(self):
+        with self.queue.queue_cv:
+            jobs, wait = self.queue._take_jobs()
+        return [job.payload["name"] for job in jobs], jobs, wait
+
+    def get_rows(self):
+        with DbCursor(read_only=True) as c:
+            c.execute("SELECT id, completed, attempts FROM testqueue ORDER BY id")
+            return c.fetchall()
+
+    def test_per_key_ordering(self):
+        self.enqueue(("a1", "a"), ("b1", "b"), ("a2", "a"), ("n1", None), ("n2", None))
+
+        # Only the first job for each key can run, but jobs without a key can all run.
+        names, jobs, _ = self.take_jobs()
+        self.assertEqual(["a1", "b1", "n1", "n2"], names)
+        self.assertEqual([], self.take_jobs()[0])
+
+        # When the first "a" job fails, the second one still has to wait for its retry.
+        self.queue.failing.add("a1")
+        self.queue._run_jobs(jobs)
+        self.assertEqual(([], 10), self.take_jobs()[::2])
+
+        self.queue.failing.clear()
+        self.now += 10
+        names, jobs, _ = self.take_jobs()
+        self.assertEqual(["a1"], names)
+        self.queue._run_jobs(jobs)
+        names, jobs, _ = self.take_jobs()
+        self.assertEqual(["a2"], names)
+        self.queue._run_jobs(jobs)
+
+        self.assertEqual(["a1", "b1", "n1", "n2", "a1", "a2"], self.queue.processed)
+        self.assertEqual([COMPLETED] * 5, [row[1] for row in self.get_rows()])
+
+    def test_backoff_and_dead_letters(self):
+        transaction_id, = self.enqueue(("a1", "a"))
+        self.queue.failing.add("a1")
+        waits = []
+        for attempt in range(1, self.queue.max_attempts):
+            _, jobs, _ = self.take_jobs()
+            self.assertEqual(1, len(jobs))
+            self.queue._run_jobs(jobs)
+            self.assertEqual([(transaction_id, PENDING, attempt)], self.get_rows())
+            _, _, wait = self.take_jobs()
+            waits.append(wait)
+            self.now += wait
+        # The delay doubles after each failure, until it reaches backoff_max.
+        self.assertEqual([10, 20, 30], waits)
+
+        # After max_attempts, the job is dead. It stays in the database, but it isn't retried.
+        _, jobs, _ = self.take_jobs()
+        self.queue._run_jobs(jobs)
+        self.assertEqual([(transaction_id, DEAD, self.queue.max_attempts)], self.get_rows())
+        self.assertEqual(([], None), self.take_jobs()[::2])
+        self.assertEqual([], self.queue.queue)
+
+    def test_recover(self):
+        transaction_ids = self.enqueue(*[("job%d" % i, "a") for i in range(7)])
+        self.queue.mark_as_complete(transaction_ids[1])
+        with DbCursor() as c:
+            c.execute("UPDATE testqueue SET completed = ?, attempts = 3 WHERE id = ?",
+                      [DEAD, transaction_ids[2]])
+            c.execute("UPDATE testqueue SET attempts = 2 WHERE id = ?", [transaction_ids[3]])
+
+        queue = _TestQueue()
+        queue.chunk_size = 2
+        queue.recover()
+        # Pending jobs are read in several chunks, and they come back in their original order.
+        self.assertEqual(["job0", "job3", "job4", "job5", "job6"],
+                         [job.payload["name"] for job in queue.queue])
+        self.assertEqual([0, 2, 0, 0, 0], [job.attempts for job in queue.queue])
+        self.assertEqual(["a"] * 5, [job.key for job in queue.queue])
+
+    def test_compact(self):
+        transaction_ids = self.enqueue(*[("job%d" % i, None) for i in range(8)])
+        self.queue.mark_as_complete(*transaction_ids[:6])
+        old = now_timestamp() - 8 * 86400
+        with DbCursor() as c:
+            c.execute("UPDATE testqueue SET updated = ? WHERE id IN (?, ?, ?, ?, ?)",
+                      [old] + transaction_ids[:5])
+            c.execute("UPDATE testqueue SET updated = ?, completed = ? WHERE id = ?",
+                      [old, DEAD, transaction_ids[6]])
+
+        self.queue.chunk_size = 2
+        self.assertEqual(5, self.queue.compact(7))
+        # Recently completed jobs, dead jobs and pending jobs are kept.
+        self.assertEqual([(transaction_ids[5], COMPLETED), (transaction_ids[6], DEAD),
+                          (transaction_ids[7], PENDING)],
+                         [row[:2] for row in self.get_rows()])
+        self.assertEqual(0, self.queue.compact(7))
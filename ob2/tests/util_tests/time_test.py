@@ -5,9 +5,13 @@ from unittest2 import TestCase
 
 from ob2.util.time import (
     now_str,
+    now_timestamp,
     format_time,
+    from_timestamp,
     parse_time,
     parse_to_relative,
+    slip_units,
+    to_timestamp,
 )
 
 
@@ -17,6 +21,20 @@ class TestTime(TestCase):
         timestamp_obj = parse_time(timestamp_str)
         self.assertEqual(timestamp_str, format_time(timestamp_obj))
 
+        timestamp = now_timestamp()
+        self.assertEqual(timestamp, to_timestamp(from_timestamp(timestamp)))
+        self.assertEqual(1435968000, to_timestamp("Jul 4 2015 00:00:00 UTC"))
+        self.assertEqual(1435968000, to_timestamp("2015-07-03T17:00:00-07:00"))
+
+    @patch("ob2.config.slip_grace_period", 0)
+    @patch("ob2.config.slip_seconds_per_unit", 86400)
+    def test_slip_units(self):
+        """Tests slip_units with timestamps from the database."""
+        due_date = "2015-07-03T17:00:00-07:00"
+        self.assertEqual(0, slip_units(due_date, 1435968000))
+        self.assertEqual(1, slip_units(due_date, 1435968001))
+        self.assertEqual(2, slip_units(due_date, 1435968000 + 86401))
+
     @patch("ob2.util.time.now",
            lambda: datetime.datetime(2015, 7, 4, 0, 0, 0).replace(tzinfo=pytz.utc))
     def test_parse_to_relative(self):
@@ -28,6 +46,9 @@ class TestTime(TestCase):
         self.assertEqual("Just now", parse_to_relative("Jul 4 2015 00:00:00 UTC"))
         self.assertEqual("1 second from now", parse_to_relative("Jul 4 2015 00:00:01 UTC"))
         self.assertEqual("5 seconds from now", parse_to_relative("Jul 4 2015 00:00:05 UTC"))
+        self.assertEqual("Just now", parse_to_relative(1435967999))
+        self.assertEqual("1 minute ago", parse_to_relative(1435967940))
+        self.assertEqual("1 hour from now", parse_to_relative(1435971600))
 
         self.assertEqual("Just now", parse_to_relative("Jul 3 2015 23:59:01 UTC"))
         self.assertEqual("1 minute ago", parse_to_relative("Jul 3 2015 23:59:00 UTC"))
@@ -0,0 +1,142 @@
+import errno
+import logging
+import os
+import re
+import shutil
+from hashlib import sha1
+from Queue import Queue
+from tempfile import mkstemp
+from threading import Lock, Thread
+
+import ob2.config as config
+import ob2.util.github_api as github_api
+
+_full_hash_matcher = re.compile(r"^[0-9a-f]{40}$")
+
+
+class _ArchiveCache(object):
+    """
+    An on-disk cache of repository archives downloaded from GitHub. Archives are stored under a hash
+    of (repo, commit, format), so only full commit hashes are cached (a branch name can point to a
+    different commit tomorrow). When the cache grows larger than `archive_cache_max_size`, the least
+    recently used archives are deleted.
+
+    """
+    # Downloads of the same archive are serialized by one of a fixed number of locks, chosen by the
+    # hash of the archive. Different archives rarely share a lock, and the locks never pile up.
+    lock_count = 64
+
+    def __init__(self):
+        self._locks = [Lock() for _ in range(self.lock_count)]
+        self._prefetch_lock = Lock()
+        self._prefetch_queue = Queue()
+        self._prefetch_thread = None
+
+    def _enabled(self):
+        return config.archive_cache_max_size > 0
+
+    def _get_lock(self, key):
+        return self._locks[int(key, 16) % self.lock_count]
+
+    def _get_cache_file(self, key):
+        return os.path.join(config.archive_cache_path, key)
+
+    def download_archive(self, repo_name, ref, output_file, file_format="tarball"):
+        """
+        Same as github_api.download_archive, but uses the cache if REF is a full commit hash.
+        Returns whether the download was successful.
+
+        """
+        if not self._enabled() or not _full_hash_matcher.match(ref):
+            return github_api.download_archive(repo_name, ref, output_file, file_format)
+        cache_file = self._ensure_cached(repo_name, ref, file_format)
+        if cache_file is None:
+            return False
+        try:
+            shutil.copyfile(cache_file, output_file)
+        except IOError as e:
+            # The archive was evicted in the meantime, which should be rare.
+            if e.errno != errno.ENOENT:
+                raise
+            return github_api.download_archive(repo_name, ref, output_file, file_format)
+        return True
+
+    def _ensure_cached(self, repo_name, ref, file_format):
+        key = sha1("%s/%s/%s" % (repo_name, ref, file_format)).hexdigest()
+        cache_file = self._get_cache_file(key)
+        with self._get_lock(key):
+            try:
+                # Marks the archive as recently used
+                os.utime(cache_file, None)
+                return cache_file
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            if self._fetch(repo_name, ref, file_format, cache_file):
+                return cache_file
+
+    def _fetch(self, repo_name, ref, file_format, cache_file):
+        if not os.path.isdir(config.archive_cache_path):
+            os.makedirs(config.archive_cache_path)
+        # Downloads to a temporary file first, so a partial download is never mistaken for a
+        # complete archive.
+        fd, temp_file = mkstemp(prefix=".tmp", dir=config.archive_cache_path)
+        os.close(fd)
+        try:
+            if not github_api.download_archive(repo_name, ref, temp_file, file_format):
+                return False
+            os.rename(temp_file, cache_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        self._evict()
+        return True
+
+    def _evict(self):
+        max_size = config.archive_cache_max_size * 1024 * 1024
+        entries = []
+        total_size = 0
+        for name in os.listdir(config.archive_cache_path):
+            if name.startswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(self._get_cache_file(name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total_size += stat.st_size
+        entries.sort()
+        for _, size, name in entries:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(self._get_cache_file(name))
+            except OSError:
+                continue
+            total_size -= size
+
+    def prefetch(self, repo_name, ref, file_format="tarball"):
+        """
+        Downloads an archive into the cache in the background, so that it is ready by the time a
+        worker needs it.
+
+        """
+        if not self._enabled() or not _full_hash_matcher.match(ref):
+            return
+        with self._prefetch_lock:
+            if self._prefetch_thread is None:
+                self._prefetch_thread = Thread(target=self._run_prefetch)
+                self._prefetch_thread.daemon = True
+                self._prefetch_thread.start()
+        self._prefetch_queue.put((repo_name, ref, file_format))
+
+    def _run_prefetch(self):
+        while True:
+            repo_name, ref, file_format = self._prefetch_queue.get()
+            try:
+                self._ensure_cached(repo_name, ref, file_format)
+            except Exception:
+                logging.exception("Failed to prefetch archive of %s at %s" % (repo_name, ref))
+
+
+archive_cache = _ArchiveCache()
@@ -72,6 +72,15 @@ def validate_config():
     if config.dockergrader_apparmor_profile:
         _validate_apparmor_config(config.dockergrader_apparmor_profile)
 
+    assert 0 <= config.dockergrader_workers <= config.dockergrader_max_workers
+    assert config.dockergrader_warm_containers >= 0
+    assert config.repomanager_workers >= 1
+    assert config.pushhook_workers >= 1
+    assert config.web_server_threads >= 1
+    if config.dockergrader_remote_server:
+        assert config.dockergrader_remote_secret, \
+            "Remote dockergrader workers need dockergrader_remote_secret"
+
     for assignment in config.assignments:
         if not assignment.manual_grading:
             assert get_job(assignment.name), "No job found for %s" % assignment.name
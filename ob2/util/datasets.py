@@ -1,8 +1,9 @@
 import numpy as np
 from math import ceil, floor
 
+from ob2.database.grade_stats import grade_stats
 from ob2.util.config_data import get_assignment_by_name
-from ob2.util.time import format_js_compatible_time, now, parse_time
+from ob2.util.time import format_js_compatible_time, from_timestamp, now_timestamp, to_timestamp
 from ob2.util.build_constants import SUCCESS
 
 
@@ -38,7 +39,14 @@ class Datasets(object):
         assignment = get_assignment_by_name(assignment_name)
         if not assignment:
             return
-        grade_set = cls._get_grade_set(c, assignment.name)
+        # The histogram is only computed again when the grades for the assignment change.
+        return grade_stats.get_histogram(
+            c, assignment.name, ("grade_distribution", max_bins),
+            lambda grade_set: cls._bin_grades(assignment, grade_set, max_bins))
+
+    @staticmethod
+    def _bin_grades(assignment, grade_set, max_bins):
+        """A helper function that sorts the grades in GRADE_SET into histogram bins."""
         if not grade_set:
             return []
         grade_set_min, grade_set_max = min(grade_set), max(grade_set)
@@ -119,53 +127,42 @@ class Datasets(object):
         assignment = get_assignment_by_name(assignment_name)
         if not assignment:
             return
-        # There is a slight problem that because of DST, ordering by "started" may not always
-        # produce the correct result. When the timezone changes, lexicographical order does not
-        # match the actual order of the times. However, this only happens once a year in the middle
-        # of the night, so fuck it.
         c.execute('''SELECT source, score, started FROM builds WHERE job = ? AND status = ?
                      ORDER BY started''', [assignment_name, SUCCESS])
         # XXX: There is no easy way to exclude builds started by staff ("super") groups.
         # But because this graph is to show the general trend, it's usually fine if staff builds
         # are included. Plus, the graph only shows up in the admin interface anyway.
-        builds = [(source, score, parse_time(started)) for source, score, started in c.fetchall()]
+        builds = c.fetchall()
         if not builds:
             return []
         source_set = map(lambda b: b[0], builds)
         started_time_set = map(lambda b: b[2], builds)
         min_started = min(started_time_set)
         max_started = max(started_time_set)
-        assignment_min_started = parse_time(assignment.not_visible_before)
-        assignment_max_started = parse_time(assignment.due_date)
+        assignment_min_started = to_timestamp(assignment.not_visible_before)
+        assignment_max_started = to_timestamp(assignment.due_date)
         data_min = min(min_started, assignment_min_started)
         data_max = max(max_started, assignment_max_started)
         data_points = []
         best_scores_so_far = {source: 0 for source in source_set}
-        time_delta = (data_max - data_min) / (num_points - 1)
+        time_delta = float(data_max - data_min) / (num_points - 1)
         current_time = data_min
         for source, score, started_time in builds:
             while current_time < started_time:
                 percentiles = np.percentile(best_scores_so_far.values(), data_keys)
-                data_points.append([format_js_compatible_time(current_time)] + list(percentiles))
+                data_points.append([format_js_compatible_time(from_timestamp(current_time))] +
+                                   list(percentiles))
                 current_time += time_delta
             if score is not None:
                 best_scores_so_far[source] = max(score, best_scores_so_far[source])
 
         percentiles = list(np.percentile(best_scores_so_far.values(), data_keys))
-        now_time = now()
+        now_time = now_timestamp()
         while current_time - (time_delta / 2) < data_max:
-            data_points.append([format_js_compatible_time(current_time)] + percentiles)
+            data_points.append([format_js_compatible_time(from_timestamp(current_time))] +
+                               percentiles)
             if current_time >= now_time:
                 percentiles = [None] * len(percentiles)
             current_time += time_delta
 
         return data_points
-
-    @staticmethod
-    def _get_grade_set(c, assignment_name):
-        """A helper function to get all the non-null grades for an assignment."""
-        c.execute('''SELECT grades.score FROM grades LEFT JOIN users ON grades.user = users.id
-                     WHERE grades.assignment = ? AND grades.score IS NOT NULL AND
-                     users.super = 0''',
-                  [assignment_name])
-        return [score for score, in c.fetchall()]
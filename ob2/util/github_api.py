@@ -1,10 +1,130 @@
+from __future__ import absolute_import
+
 import github3
+import re
+from collections import OrderedDict
+from threading import Lock
+from time import time
 
 import ob2.config as config
 
+_full_hash_matcher = re.compile(r"^[0-9a-f]{40}$")
+
+
+class _LRUCache(object):
+    """
+    A thread-safe dictionary that forgets its least recently used entries once it holds more than
+    MAX_SIZE of them.
+
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# How long (in seconds) to trust a cached repository object before checking with GitHub again. The
+# check is a conditional request, which does not count against the rate limit if nothing changed.
+REPOSITORY_TTL = 300
+
+_github_admin = None
+_github_admin_lock = Lock()
+
+# repo_name -> (repository, time of last check)
+_repository_cache = _LRUCache()
+
+# url -> (etag, JSON response)
+_conditional_cache = _LRUCache()
+
+# Commits and comparisons between two commits never change, so these are cached without expiring.
+_commit_message_cache = _LRUCache()
+_diff_file_list_cache = _LRUCache()
+
 
 def _get_github_admin():
-    return github3.login(token=config.github_admin_access_token)
+    """
+    Returns the shared GitHub client. All requests go through the same HTTP session, so connections
+    to GitHub are kept alive between requests.
+
+    """
+    global _github_admin
+    with _github_admin_lock:
+        if _github_admin is None:
+            _github_admin = github3.login(token=config.github_admin_access_token)
+        return _github_admin
+
+
+def _get_repository(repo_name):
+    """
+    Returns the repository object for REPO_NAME (or None if it does not exist), using a cached copy
+    if possible.
+
+    """
+    cached = _repository_cache.get(repo_name)
+    if cached:
+        repository, checked = cached
+        if time() - checked < REPOSITORY_TTL:
+            return repository
+        # github3 makes this a conditional request (based on the cached object), so this is free if
+        # the repository has not changed.
+        try:
+            repository = repository.refresh(conditional=True)
+        except github3.GitHubError:
+            # The repository was deleted, or we lost access to it (404 or 403).
+            _repository_cache.pop(repo_name)
+            return None
+    else:
+        github = _get_github_admin()
+        repository = github.repository(config.github_organization, repo_name)
+        if repository is None:
+            return None
+    _repository_cache.set(repo_name, (repository, time()))
+    return repository
+
+
+def _get_json_conditional(url):
+    """
+    Gets a JSON resource from the GitHub API. If we have seen the resource before, the request is
+    sent with the previous ETag, and GitHub answers with "304 Not Modified" (which does not count
+    against the rate limit) if it has not changed. Returns None if the resource was not found.
+
+    """
+    github = _get_github_admin()
+    cached = _conditional_cache.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    response = github._get(url, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    if response.status_code != 200:
+        return None
+    json = response.json()
+    etag = response.headers.get("ETag")
+    if etag:
+        _conditional_cache.set(url, (etag, json))
+    return json
 
 
 def get_branch_hash(repo_name, branch_name="master"):
@@ -12,11 +132,15 @@ def get_branch_hash(repo_name, branch_name="master"):
     Retrieves the commit hash of a branch.
 
     """
-    github = _get_github_admin()
+    repository = _get_repository(repo_name)
+    if repository is None:
+        return None
+    # Branches move all the time, so we always ask GitHub, but with a conditional request.
+    url = repository._build_url("branches", branch_name, base_url=repository._api)
+    branch = _get_json_conditional(url)
     try:
-        repository = github.repository(config.github_organization, repo_name)
-        return repository.branch(branch_name).commit.sha
-    except AttributeError:
+        return branch["commit"]["sha"]
+    except (KeyError, TypeError):
         pass
 
 
@@ -26,12 +150,17 @@ def get_commit_message(repo_name, commit_hash):
     be the unabbreviated hash.
 
     """
-    github = _get_github_admin()
+    key = (repo_name, commit_hash)
+    message = _commit_message_cache.get(key)
+    if message is not None:
+        return message
     try:
-        repository = github.repository(config.github_organization, repo_name)
-        return repository.git_commit(commit_hash).message
+        message = _get_repository(repo_name).git_commit(commit_hash).message
     except AttributeError:
-        pass
+        return None
+    if _full_hash_matcher.match(commit_hash):
+        _commit_message_cache.set(key, message)
+    return message
 
 
 def get_diff_file_list(repo_name, base_hash, head_hash):
@@ -39,14 +168,18 @@ def get_diff_file_list(repo_name, base_hash, head_hash):
     Gets a list of files that have changed between base_hash..head_hash in the particular repo.
 
     """
-    github = _get_github_admin()
+    key = (repo_name, base_hash, head_hash)
+    file_list = _diff_file_list_cache.get(key)
+    if file_list is not None:
+        return list(file_list)
     try:
-        repository = github.repository(config.github_organization, repo_name)
-        comparison = repository.compare_commits(base_hash, head_hash)
+        comparison = _get_repository(repo_name).compare_commits(base_hash, head_hash)
         file_list = [file_["filename"] for file_ in comparison.files]
-        return file_list
     except AttributeError:
-        pass
+        return None
+    if _full_hash_matcher.match(base_hash) and _full_hash_matcher.match(head_hash):
+        _diff_file_list_cache.set(key, file_list)
+    return list(file_list)
 
 
 def download_archive(repo_name, ref, output_file, file_format="tarball"):
@@ -54,8 +187,7 @@ def download_archive(repo_name, ref, output_file, file_format="tarball"):
     Downloads a repository to a local directory. Returns whether the download was successful.
 
     """
-    github = _get_github_admin()
-    repository = github.repository(config.github_organization, repo_name)
+    repository = _get_repository(repo_name)
     if repository is None:
         return False
     return repository.archive(file_format, output_file, ref)
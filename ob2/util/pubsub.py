@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+
+import os
+from collections import deque
+from threading import Condition
+from time import time
+
+import ob2.config as config
+
+
+class PubSub(object):
+    """
+    An in-process publish/subscribe channel. Publishers call publish() from any thread, and
+    subscribers wait for events on the channels that they are interested in.
+
+    Every event gets a sequence number. The most recent events are kept, so that a subscriber that
+    comes back with the last sequence number it has seen (for example, a browser that reconnects)
+    does not miss anything in between.
+
+    Subscribers that poll over HTTP can subscribe() once, so that each poll only has to look up the
+    channels of its subscription.
+
+    """
+    # The number of recent events to keep
+    history_size = 1000
+
+    # How long (in seconds) to keep a subscription that is not being used
+    subscription_timeout = 600
+
+    def __init__(self):
+        self._cv = Condition()
+        self._events = deque(maxlen=self.history_size)
+        self._last_seq = 0
+        self._subscriptions = {}
+        # Each waiting subscriber holds a web server thread, so only a third of them may wait at
+        # once.
+        self.max_waiters = max(1, config.web_server_threads // 3)
+        self._waiters = 0
+
+    def publish(self, channel, event):
+        """
+        Publishes EVENT (which should be JSON-serializable) on CHANNEL. Returns its sequence number.
+
+        """
+        with self._cv:
+            self._last_seq += 1
+            self._events.append((self._last_seq, channel, event))
+            self._cv.notify_all()
+            return self._last_seq
+
+    def get_last_seq(self):
+        with self._cv:
+            return self._last_seq
+
+    def subscribe(self, owner, channels):
+        """
+        Creates a subscription to CHANNELS for OWNER (for example, a user ID), and returns its ID.
+
+        """
+        subscription_id = os.urandom(16).encode("hex")
+        with self._cv:
+            current_time = time()
+            for other_id, (_, _, last_used) in self._subscriptions.items():
+                if last_used + self.subscription_timeout < current_time:
+                    del self._subscriptions[other_id]
+            self._subscriptions[subscription_id] = (owner, frozenset(channels), current_time)
+        return subscription_id
+
+    def get_subscription(self, subscription_id, owner):
+        """
+        Returns the channels of a subscription, or None if it does not exist (or if it has expired,
+        or if it belongs to someone else).
+
+        """
+        with self._cv:
+            subscription = self._subscriptions.get(subscription_id)
+            if subscription is None or subscription[0] != owner:
+                return None
+            _, channels, _ = subscription
+            self._subscriptions[subscription_id] = (owner, channels, time())
+            return channels
+
+    def wait(self, channels, after_seq, timeout):
+        """
+        Waits up to TIMEOUT seconds for events on any of CHANNELS with a sequence number greater
+        than AFTER_SEQ. If max_waiters subscribers are already waiting, returns right away.
+
+        Returns (events, last_seq, complete), where EVENTS is a list of (seq, channel, event) and
+        LAST_SEQ should be passed as AFTER_SEQ next time. COMPLETE is False if some of the events
+        after AFTER_SEQ have already been thrown away (or if AFTER_SEQ is from before a restart), in
+        which case the subscriber should reload whatever it is showing.
+
+        """
+        channels = set(channels)
+        deadline = time() + timeout
+        waiting = False
+        with self._cv:
+            try:
+                while True:
+                    if after_seq > self._last_seq:
+                        return [], self._last_seq, False
+                    oldest_seq = self._events[0][0] if self._events else self._last_seq + 1
+                    if after_seq < oldest_seq - 1:
+                        return [], self._last_seq, False
+                    events = [(seq, channel, event) for seq, channel, event in self._events
+                              if seq > after_seq and channel in channels]
+                    remaining = deadline - time()
+                    if events or remaining <= 0:
+                        return events, self._last_seq, True
+                    if not waiting:
+                        if self._waiters >= self.max_waiters:
+                            return [], self._last_seq, True
+                        waiting = True
+                        self._waiters += 1
+                    self._cv.wait(remaining)
+            finally:
+                if waiting:
+                    self._waiters -= 1
+
+
+# Build status changes. The channel is the name of the repo that was built, and the events are
+# dictionaries with the build_name, job, status, and score of the build.
+build_events = PubSub()
+
+
+def publish_build_status(source, build_name, job, status, score=None):
+    build_events.publish(source, {"build_name": build_name,
+                                  "job": job,
+                                  "status": status,
+                                  "score": score})
@@ -0,0 +1,43 @@
+# GitHub only includes this many commits in a push hook payload. Pushes with more commits than this
+# are truncated, so we can't tell which files they changed.
+MAX_PAYLOAD_COMMITS = 20
+
+_null_hash = "0" * 40
+
+
+def parse_push_payload(payload):
+    """
+    Reads the changed files and the head commit message out of a GitHub push hook payload, so that
+    we don't have to ask the GitHub API for them.
+
+    Returns (file_list, message). Either one is None if the payload doesn't have enough information,
+    in which case you should ask the GitHub API instead. This happens for forced pushes (the
+    payload only lists the new commits, not the ones that were removed) and for pushes with too
+    many commits.
+
+    """
+    after = payload.get("after")
+    if after == _null_hash:
+        # The branch was deleted, so nothing was built.
+        return [], None
+
+    message = None
+    head_commit = payload.get("head_commit")
+    if isinstance(head_commit, dict) and head_commit.get("id") == after:
+        message = head_commit.get("message")
+
+    file_list = None
+    commits = payload.get("commits")
+    if isinstance(commits, list) and len(commits) < MAX_PAYLOAD_COMMITS and \
+            not payload.get("forced"):
+        files = set()
+        for commit in commits:
+            try:
+                for key in ("added", "modified", "removed"):
+                    files.update(commit[key])
+            except (KeyError, TypeError):
+                break
+        else:
+            file_list = sorted(files)
+
+    return file_list, message
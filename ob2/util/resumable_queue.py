@@ -1,11 +1,32 @@
+from __future__ import absolute_import
+
 import json
 import logging
-from collections import deque
 from threading import Condition
+from time import sleep, time
 
+import ob2.config as config
 from ob2.database import DbCursor
-from ob2.database.helpers import get_next_autoincrementing_value
-from ob2.util.time import now_str
+from ob2.database.helpers import (
+    get_next_autoincrementing_value,
+    get_next_autoincrementing_values,
+)
+from ob2.util.time import now_timestamp
+
+# Values of the "completed" column
+PENDING = 0
+COMPLETED = 1
+DEAD = 2
+
+
+class _PendingJob(object):
+    def __init__(self, transaction_id, operation, payload, key, attempts=0):
+        self.transaction_id = transaction_id
+        self.operation = operation
+        self.payload = payload
+        self.key = key
+        self.attempts = attempts
+        self.not_before = 0
 
 
 class ResumableQueue(object):
@@ -13,15 +34,35 @@ class ResumableQueue(object):
     A generic implementation of a job queue that retries jobs until they succeed. Jobs are
     stored in the database so that they persist across crashes.
 
+    Any number of threads can call run() on the same queue. Jobs with the same key (see
+    get_job_key) are run one at a time, in the order they were enqueued. A job that fails is tried
+    again later, with exponential backoff. After max_attempts failures, it is marked as dead and
+    left in the database for somebody to look at.
+
     """
     queue_name = None
     database_table = None
 
+    # The maximum number of jobs that the queue runner takes at once (see process_jobs)
+    batch_size = 1
+
+    # The number of times to try a job before giving up on it
+    max_attempts = 8
+
+    # How long (in seconds) to wait before retrying a failed job. The delay doubles after each
+    # failure, up to backoff_max.
+    backoff_base = 10
+    backoff_max = 3600
+
+    # The number of rows to read (during recovery) or delete (during compaction) per transaction
+    chunk_size = 500
+
     def __init__(self):
         assert self.queue_name is not None
         assert self.database_table is not None
-        self.queue = deque()
+        self.queue = []
         self.queue_cv = Condition()
+        self.active_keys = set()
         self.recovered = False
 
     def get_transaction_id(self, c):
@@ -35,6 +76,14 @@ class ResumableQueue(object):
     def unserialize_arguments(self, serialized):
         return json.loads(serialized)
 
+    def get_job_key(self, operation, payload):
+        """
+        Returns a key for the job. Jobs with the same key never run at the same time, and they run
+        in the order they were enqueued. Jobs with a key of None can run in any order.
+
+        """
+        return None
+
     def create(self, c, operation, payload):
         """
         Creates a new queue job and returns an opaque object representing the job. The new job will
@@ -47,19 +96,46 @@ class ResumableQueue(object):
 
         """
         transaction_id = self.get_transaction_id(c)
-        c.execute('''INSERT INTO %s (id, operation, payload, updated, completed)
-                     VALUES (?, ?, ?, ?, ?)''' % self.database_table,
-                  [transaction_id, operation, self.serialize_arguments(payload), now_str(), 0])
+        c.execute('''INSERT INTO %s (id, operation, payload, updated, completed, attempts)
+                     VALUES (?, ?, ?, ?, ?, 0)''' % self.database_table,
+                  [transaction_id, operation, self.serialize_arguments(payload), now_timestamp(),
+                   PENDING])
         return (transaction_id, operation, payload)
 
+    def create_batch(self, c, operation, payloads):
+        """
+        Same as create(), but creates one job for each of PAYLOADS with a single batched insert.
+        Returns a list of opaque objects, which should be passed to enqueue_batch().
+
+        """
+        option_key = "%s_next_transaction_id" % self.queue_name
+        transaction_ids = get_next_autoincrementing_values(c, option_key, len(payloads))
+        updated = now_timestamp()
+        c.executemany('''INSERT INTO %s (id, operation, payload, updated, completed, attempts)
+                         VALUES (?, ?, ?, ?, ?, 0)''' % self.database_table,
+                      [(transaction_id, operation, self.serialize_arguments(payload), updated,
+                        PENDING)
+                       for transaction_id, payload in zip(transaction_ids, payloads)])
+        return [(transaction_id, operation, payload)
+                for transaction_id, payload in zip(transaction_ids, payloads)]
+
     def enqueue(self, job_object):
         """
         Enqueues a previously created job. The job will be processed by the queue runner.
 
+        """
+        self.enqueue_batch([job_object])
+
+    def enqueue_batch(self, job_objects):
+        """
+        Enqueues a list of jobs that were created with create_batch().
+
         """
         with self.queue_cv:
-            self.queue.append(job_object)
-            self.queue_cv.notify()
+            for transaction_id, operation, payload in job_objects:
+                key = self.get_job_key(operation, payload)
+                self.queue.append(_PendingJob(transaction_id, operation, payload, key))
+            self.queue_cv.notify_all()
 
     def recover(self):
         """
@@ -68,14 +144,46 @@ class ResumableQueue(object):
         """
         assert not self.recovered, "ResumableQueue should only be recovered from DB once"
         self.recovered = True
-        with DbCursor() as c:
-            c.execute('SELECT id, operation, payload FROM %s WHERE completed = 0' %
-                      self.database_table)
+        last_id = -1
+        while True:
+            # Reads in chunks, so we never hold a huge result set (or a long read transaction).
+            with DbCursor(read_only=True) as c:
+                c.execute('''SELECT id, operation, payload, attempts FROM %s
+                             WHERE completed = ? AND id > ? ORDER BY id LIMIT ?''' %
+                          self.database_table, [PENDING, last_id, self.chunk_size])
+                rows = c.fetchall()
+            if not rows:
+                break
             with self.queue_cv:
-                for transaction_id, operation, payload in c.fetchall():
+                for transaction_id, operation, payload, attempts in rows:
                     payload = self.unserialize_arguments(payload)
-                    self.queue.append((transaction_id, operation, payload))
-                self.queue_cv.notify()
+                    key = self.get_job_key(operation, payload)
+                    self.queue.append(_PendingJob(transaction_id, operation, payload, key,
+                                                  attempts or 0))
+                self.queue_cv.notify_all()
+            last_id = rows[-1][0]
+
+    def compact(self, retention_days):
+        """
+        Deletes completed jobs that finished more than RETENTION_DAYS ago. Dead jobs are kept.
+        Returns the number of jobs that were deleted.
+
+        """
+        cutoff = now_timestamp() - retention_days * 86400
+        deleted = 0
+        while True:
+            # Deletes in chunks, so that other writers don't have to wait for long.
+            with DbCursor() as c:
+                c.execute('''DELETE FROM %s WHERE id IN (SELECT id FROM %s
+                                                      WHERE completed = ? AND updated < ?
+                                                      LIMIT ?)''' %
+                          (self.database_table, self.database_table),
+                          [COMPLETED, cutoff, self.chunk_size])
+                c.execute("SELECT changes()")
+                changes, = c.fetchone()
+            deleted += changes
+            if changes < self.chunk_size:
+                return deleted
 
     def process_job(self, operation, payload):
         """
@@ -86,26 +194,144 @@ class ResumableQueue(object):
         """
         pass
 
-    def mark_as_complete(self, transaction_id):
+    def process_jobs(self, jobs):
+        """
+        Processes a batch of jobs, given as a list of (transaction_id, operation, payload). Returns
+        the transaction IDs of the jobs that succeeded. Jobs that failed will be retried later.
+
+        By default, this calls process_job() for each job. Override this if a batch of jobs can be
+        processed more efficiently than one job at a time.
+
+        """
+        succeeded = []
+        for transaction_id, operation, payload in jobs:
+            try:
+                self.process_job(operation, payload)
+            except Exception:
+                logging.exception("[%s] Error occurred while processing queue" % self.queue_name)
+            else:
+                succeeded.append(transaction_id)
+        return succeeded
+
+    def mark_as_complete(self, *transaction_ids):
+        updated = now_timestamp()
         while True:
             try:
                 with DbCursor() as c:
-                    c.execute("UPDATE %s SET completed = 1 WHERE id = ?" %
-                              self.database_table, [transaction_id])
+                    # Stays well under SQLite's limit on the number of parameters in one statement
+                    for i in range(0, len(transaction_ids), self.chunk_size):
+                        chunk = transaction_ids[i:i + self.chunk_size]
+                        c.execute("UPDATE %s SET completed = ?, updated = ? WHERE id IN (%s)" %
+                                  (self.database_table, ", ".join(["?"] * len(chunk))),
+                                  [COMPLETED, updated] + list(chunk))
                     break
             except Exception:
                 logging.exception("[%s] Error occurred while marking %s as done" %
-                                  (self.queue_name, transaction_id))
+                                  (self.queue_name, ", ".join(map(str, transaction_ids))))
+
+    def mark_as_failed(self, job):
+        """
+        Records a failed attempt at JOB. Returns whether the job should be tried again.
+
+        """
+        job.attempts += 1
+        dead = job.attempts >= self.max_attempts
+        try:
+            with DbCursor() as c:
+                c.execute("UPDATE %s SET attempts = ?, completed = ?, updated = ? WHERE id = ?" %
+                          self.database_table,
+                          [job.attempts, DEAD if dead else PENDING, now_timestamp(),
+                           job.transaction_id])
+        except Exception:
+            logging.exception("[%s] Error occurred while recording failure of %s" %
+                              (self.queue_name, job.transaction_id))
+        if dead:
+            logging.error("[%s] Giving up on %s after %d attempts" %
+                          (self.queue_name, job.transaction_id, job.attempts))
+        return not dead
+
+    def _take_jobs(self):
+        """
+        Removes up to batch_size jobs from the queue that are ready to run. Returns (jobs, wait),
+        where WAIT is how long (in seconds) until a job that is waiting for a retry becomes ready,
+        or None if no jobs are waiting.
+
+        Must be called with queue_cv held.
+
+        """
+        current_time = time()
+        blocked_keys = set(self.active_keys)
+        jobs = []
+        wait = None
+        for job in self.queue:
+            if len(jobs) >= self.batch_size:
+                break
+            if job.key is not None and job.key in blocked_keys:
+                continue
+            if job.not_before > current_time:
+                job_wait = job.not_before - current_time
+                wait = job_wait if wait is None else min(wait, job_wait)
+            else:
+                jobs.append(job)
+            if job.key is not None:
+                blocked_keys.add(job.key)
+        for job in jobs:
+            self.queue.remove(job)
+            if job.key is not None:
+                self.active_keys.add(job.key)
+        return jobs, wait
+
+    def _run_jobs(self, jobs):
+        """
+        Processes JOBS (which were taken with _take_jobs). Each job is marked as complete, or it is
+        put back in the queue to be retried later (unless it is dead).
+
+        """
+        succeeded = set(self.process_jobs([(job.transaction_id, job.operation, job.payload)
+                                           for job in jobs]))
+        if succeeded:
+            self.mark_as_complete(*[job.transaction_id for job in jobs
+                                    if job.transaction_id in succeeded])
+        retries = []
+        for job in jobs:
+            if job.transaction_id not in succeeded and self.mark_as_failed(job):
+                delay = min(self.backoff_base * 2 ** (job.attempts - 1), self.backoff_max)
+                job.not_before = time() + delay
+                retries.append(job)
+        with self.queue_cv:
+            for job in jobs:
+                self.active_keys.discard(job.key)
+            if retries:
+                # Retries go back in their original place, so jobs with the same key stay in
+                # order.
+                self.queue.extend(retries)
+                self.queue.sort(key=lambda job: job.transaction_id)
+            self.queue_cv.notify_all()
 
     def run(self):
         while True:
             with self.queue_cv:
-                while not self.queue:
-                    self.queue_cv.wait()
-                transaction_id, operation, payload = self.queue.popleft()
-            try:
-                self.process_job(operation, payload)
-            except Exception:
-                logging.exception("[%s] Error occurred while processing queue" % self.queue_name)
-            else:
-                self.mark_as_complete(transaction_id)
+                jobs, wait = self._take_jobs()
+                while not jobs:
+                    self.queue_cv.wait(wait)
+                    jobs, wait = self._take_jobs()
+            self._run_jobs(jobs)
+
+
+def run_compaction(queues, interval=86400):
+    """
+    Compacts the tables of QUEUES once every INTERVAL seconds, according to
+    resumable_queue_retention_days. This runs forever, so start it on a background thread.
+
+    """
+    while True:
+        if config.resumable_queue_retention_days > 0:
+            for queue in queues:
+                try:
+                    deleted = queue.compact(config.resumable_queue_retention_days)
+                    if deleted:
+                        logging.info("[%s] Deleted %d old jobs" % (queue.queue_name, deleted))
+                except Exception:
+                    logging.exception("[%s] Error occurred while compacting queue" %
+                                      queue.queue_name)
+        sleep(interval)
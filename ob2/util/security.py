@@ -13,7 +13,32 @@ def generate_shitty_random_string(N=30):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(N))
 
 
+def get_worker_signature(payload_bytes):
+    """
+    Signs a request from a remote dockergrader worker with the shared secret.
+
+    """
+    digest = hmac.new(config.dockergrader_remote_secret, payload_bytes, sha1).hexdigest()
+    return "sha1=%s" % digest
+
+
+def has_valid_worker_signature():
+    """
+    Returns whether the current request was signed by a remote dockergrader worker.
+
+    """
+    worker_signature = request.headers.get("X-Ob2-Worker-Signature")
+    if not worker_signature or not config.dockergrader_remote_secret:
+        return False
+    if isinstance(worker_signature, unicode):
+        worker_signature = worker_signature.encode("utf-8")
+    return hmac.compare_digest(get_worker_signature(request.get_data()), worker_signature)
+
+
 def get_request_validity():
+    # Remote dockergrader workers sign their requests instead
+    if has_valid_worker_signature():
+        return True
     # GitHub signature will suffice for CSRF check
     github_signature = request.headers.get("X-Hub-Signature")
     if github_signature:
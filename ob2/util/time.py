@@ -1,3 +1,4 @@
+import calendar
 import pytz
 from datetime import datetime
 from dateutil import parser as DateParser
@@ -13,10 +14,29 @@ def now():
 
 
 def now_str():
-    """Gets the current datetime in a serializable format (for database)."""
+    """Gets the current datetime in a serializable format."""
     return format_time(now())
 
 
+def now_timestamp():
+    """Gets the current time as an integer number of seconds since the epoch (for database)."""
+    return to_timestamp(now())
+
+
+def to_timestamp(s):
+    """Converts a datetime object (or a serialized datetime) to seconds since the epoch."""
+    if isinstance(s, basestring):
+        s = parse_time(s)
+    if s.tzinfo is None:
+        s = pytz.timezone(config.timezone).localize(s)
+    return calendar.timegm(s.utctimetuple())
+
+
+def from_timestamp(s):
+    """Converts seconds since the epoch to a datetime object (with timezone)."""
+    return datetime.fromtimestamp(s, pytz.timezone(config.timezone))
+
+
 def format_time(s):
     """Converts a datetime object to serializable format."""
     return s.isoformat()
@@ -32,12 +52,19 @@ def parse_time(s):
     return DateParser.parse(s)
 
 
+def _to_datetime(s):
+    """Accepts a datetime object, a serialized datetime, or seconds since the epoch."""
+    if isinstance(s, basestring):
+        return parse_time(s)
+    if isinstance(s, (int, long, float)):
+        return from_timestamp(s)
+    return s
+
+
 def slip_units(due_date, submit_date):
     """Computes the number of slip units (see ob2.config) between the due date and submit_date."""
-    if isinstance(due_date, basestring):
-        due_date = parse_time(due_date)
-    if isinstance(submit_date, basestring):
-        submit_date = parse_time(submit_date)
+    due_date = _to_datetime(due_date)
+    submit_date = _to_datetime(submit_date)
     lateness = submit_date - due_date
     total_seconds = lateness.total_seconds() - config.slip_grace_period
     if total_seconds <= 0:
@@ -60,12 +87,10 @@ def now_compare(start_date, end_date=None):
     If end_date is ommitted, it takes the same value as start_date.
 
     """
-    if isinstance(start_date, basestring):
-        start_date = parse_time(start_date)
+    start_date = _to_datetime(start_date)
     if end_date is None:
         end_date = start_date
-    if isinstance(end_date, basestring):
-        end_date = parse_time(end_date)
+    end_date = _to_datetime(end_date)
     current_date = now()
     if current_date < start_date:
         return -1
@@ -81,8 +106,7 @@ def parse_to_relative(target, past_relative_cutoff=86400, future_relative_cutoff
     or more than Z seconds in the future, then express TARGET in an absolute way.
 
     """
-    if isinstance(target, basestring):
-        target = parse_time(target)
+    target = _to_datetime(target)
     delta = now() - target
     total_seconds = delta.total_seconds()
     # Example: Jul 9 8:00PM
@@ -39,7 +39,8 @@ cache_buster_hash = generate_shitty_random_string(8)
 for blueprint in ("onboarding",
                   "dashboard",
                   "ta",
-                  "pushhook"):
+                  "pushhook",
+                  "dockergrader"):
     module = import_module("ob2.web.blueprints.%s" % blueprint)
     app.register_blueprint(module.blueprint, url_prefix=config.web_public_root)
 
@@ -90,5 +91,6 @@ def main():
         dispatcher = wsgiserver.WSGIPathInfoDispatcher({"/": app})
         web_server = wsgiserver.CherryPyWSGIServer((config.web_host, config.web_port),
                                                    dispatcher,
+                                                   numthreads=config.web_server_threads,
                                                    server_name=config.web_public_host)
         web_server.start()
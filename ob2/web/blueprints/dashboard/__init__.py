@@ -1,37 +1,48 @@
 import json
 from collections import OrderedDict
-from flask import (Blueprint, Response, abort, g, redirect, render_template, request, session,
-                   url_for)
+from flask import (Blueprint, Response, abort, g, jsonify, redirect, render_template, request,
+                   session, url_for)
 from functools import wraps
-from math import sqrt
 
 import ob2.config as config
 from ob2.database import DbCursor
+from ob2.database.grade_stats import grade_stats
 from ob2.database.helpers import (
-    create_build,
     finalize_group_if_ready,
+    get_build_log,
     get_groups,
     get_grouplimit,
     get_next_autoincrementing_value,
+    get_page,
     get_user_by_id,
     get_user_by_github,
     modify_grouplimit,
 )
-from ob2.dockergrader import dockergrader_queue, Job
+from ob2.dockergrader import create_build_job, dockergrader_queue
+from ob2.dockergrader.live_output import live_output
 from ob2.mailer import create_email, mailer_queue
 from ob2.repomanager import repomanager_queue
 from ob2.util.authentication import user_id
+from ob2.util.build_constants import IN_PROGRESS, QUEUED
 from ob2.util.config_data import get_assignment_by_name
 from ob2.util.datasets import Datasets
 from ob2.util.github_api import get_branch_hash, get_commit_message
 from ob2.util.github_login import is_ta
 from ob2.util.group_constants import ACCEPTED, INVITED, REJECTED
+from ob2.util.pubsub import build_events
 from ob2.util.security import require_csrf_token
+from ob2.util.templating import ansi_to_html
 from ob2.util.time import now_compare, slip_units_now
 from ob2.util.validation import fail_validation, ValidationError, redirect_with_error
 
 blueprint = Blueprint("dashboard", __name__, template_folder="templates")
 
+# How long (in seconds) a request for the output of a running build waits for new output
+OUTPUT_POLL_TIMEOUT = 15
+
+# How long (in seconds) a request from a build page waits for build status changes
+STATUS_POLL_TIMEOUT = 25
+
 
 def _get_student(c):
     if not hasattr(g, "student"):
@@ -70,7 +81,7 @@ def index():
 @blueprint.route("/dashboard/assignments/")
 @_require_login
 def assignments():
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute("SELECT assignment, score, slipunits, updated FROM grades WHERE user = ?",
                   [user_id()])
         grade_info = {assignment: (score, slipunits, updated)
@@ -87,7 +98,7 @@ def assignments():
 @blueprint.route("/dashboard/assignments/<name>/")
 @_require_login
 def assignments_one(name):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         student = _get_student(c)
         user_id, _, _, login, _, _ = student
         assignment = get_assignment_by_name(name)
@@ -124,26 +135,15 @@ def assignments_one(name):
         else:
             most_recent_repo = None
         if grade[0] is not None:
-            c.execute('''SELECT COUNT(*) + 1 FROM grades WHERE assignment = ? AND score > ?''',
-                      [name, grade[0]])
-            rank, = c.fetchone()
+            rank = grade_stats.get_rank(c, name, grade[0])
         else:
             rank = None
-        c.execute('''SELECT COUNT(*), AVG(score) FROM grades
-                     WHERE assignment = ? AND score IS NOT NULL''', [name])
-        stats = c.fetchone()
-        if stats[0] == 0:
-            variance = None
-            stddev = None
-        else:
-            c.execute("SELECT AVG((score - ?) * (score - ?)) FROM grades WHERE assignment = ?",
-                      [stats[1], stats[1], name])
-            variance, = c.fetchone()
-            stddev = sqrt(variance)
+        # (count, mean, standard deviation)
+        stats = grade_stats.get_summary(c, name)
 
         assignment_info = ((assignment.name, assignment.full_score, assignment.weight,
                             assignment.due_date, assignment.category, assignment.is_group,
-                            assignment.manual_grading) + grade + (rank,) + stats + (stddev,))
+                            assignment.manual_grading) + grade + (rank,) + stats)
         template_common = _template_common(c)
     return render_template("dashboard/assignments_one.html",
                            assignment_info=assignment_info,
@@ -159,7 +159,7 @@ def assignments_one(name):
 @require_csrf_token
 @_require_login
 def assignments_one_grades_json(name):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         data = Datasets.grade_distribution(c, name)
     if not data:
         abort(404)
@@ -174,21 +174,23 @@ def assignments_one_grades_json(name):
 def builds(page):
     page_size = 50
     page = max(1, page)
-    with DbCursor() as c:
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    if page > 1 and after is None and before is None:
+        return redirect(url_for("dashboard.builds"))
+    if after is not None and before is not None:
+        abort(400)
+    with DbCursor(read_only=True) as c:
         student = _get_student(c)
         user_id, _, _, login, _, _ = student
         group_repos = get_groups(c, user_id)
         repos = [login] + group_repos
-        c.execute('''SELECT build_name, source, status, score, `commit`, message, job, started
-                     FROM builds WHERE source in (%s)
-                     ORDER BY started DESC LIMIT ? OFFSET ?''' % (",".join(["?"] * len(repos))),
-                  repos + [page_size + 1, (page - 1) * page_size])
-        builds = c.fetchall()
+        builds, prev_cursor, next_cursor = get_page(
+            c, "build_name, source, status, score, `commit`, message, job, started", "builds",
+            "started", page_size, where="builds.source IN (%s)" % ",".join(["?"] * len(repos)),
+            args=repos, after=after, before=before)
         if not builds and page > 1:
             abort(404)
-        more_pages = len(builds) == page_size + 1
-        if more_pages:
-            builds = builds[:-1]
         full_scores = {assignment.name: assignment.full_score
                        for assignment in config.assignments}
         builds_info = (build + (full_scores.get(build[6]),) for build in builds)
@@ -196,32 +198,90 @@ def builds(page):
     return render_template("dashboard/builds.html",
                            builds_info=builds_info,
                            page=page,
-                           more_pages=more_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
+                           status_seq=build_events.get_last_seq(),
+                           status_subscription=build_events.subscribe(user_id, repos),
                            **template_common)
 
 
 @blueprint.route("/dashboard/builds/<name>/")
 @_require_login
 def builds_one(name):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         student = _get_student(c)
         user_id, _, _, login, _, _ = student
         group_repos = get_groups(c, user_id)
         repos = [login] + group_repos
-        c.execute('''SELECT build_name, status, score, source, `commit`, message, job, started,
-                     log FROM builds WHERE build_name = ? AND source in (%s)
+        c.execute('''SELECT build_name, status, score, source, `commit`, message, job, started
+                     FROM builds WHERE build_name = ? AND source in (%s)
                      LIMIT 1''' % (",".join(["?"] * len(repos))),
                   [name] + repos)
         build = c.fetchone()
         if not build:
             abort(404)
-        build_info = build + (get_assignment_by_name(build[6]).full_score,)
+        build_info = build + (get_build_log(c, name),
+                              get_assignment_by_name(build[6]).full_score)
         template_common = _template_common(c)
     return render_template("dashboard/builds_one.html",
                            build_info=build_info,
+                           status_seq=build_events.get_last_seq(),
+                           status_subscription=build_events.subscribe(user_id, repos),
                            **template_common)
 
 
+@blueprint.route("/dashboard/builds/events.json")
+@require_csrf_token
+@_require_login
+def builds_events_json():
+    """
+    Returns the status changes of the student's builds after the "after" sequence number, and the
+    sequence number to use next. If there are none yet, waits up to STATUS_POLL_TIMEOUT seconds for
+    one. The repos to watch were looked up when the page subscribed, so this does not need the
+    database.
+
+    """
+    try:
+        after_seq = int(request.args.get("after"))
+    except (TypeError, ValueError):
+        abort(400)
+    repos = build_events.get_subscription(request.args.get("subscription"), user_id())
+    if repos is None:
+        # The subscription has expired (or the server restarted), so the page has to be reloaded.
+        return jsonify(events=[], last=build_events.get_last_seq(), complete=False)
+    events, last_seq, complete = build_events.wait(repos, after_seq, STATUS_POLL_TIMEOUT)
+    return jsonify(events=[event for _, _, event in events], last=last_seq, complete=complete)
+
+
+@blueprint.route("/dashboard/builds/<name>/output.json")
+@require_csrf_token
+@_require_login
+def builds_one_output_json(name):
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+    except ValueError:
+        abort(400)
+    with DbCursor(read_only=True) as c:
+        student = _get_student(c)
+        user_id, _, _, login, _, _ = student
+        repos = [login] + get_groups(c, user_id)
+        c.execute('''SELECT status FROM builds WHERE build_name = ? AND source in (%s)
+                     LIMIT 1''' % (",".join(["?"] * len(repos))),
+                  [name] + repos)
+        build = c.fetchone()
+        if not build:
+            abort(404)
+    status, = build
+    running = status in (QUEUED, IN_PROGRESS)
+    # While the build is running, the request waits a little while for new output. The page is
+    # done once the database has the result of the build (which is saved before the output is
+    # marked as finished), so that reloading it shows the result.
+    output, offset, _ = live_output.read(name, offset,
+                                         timeout=OUTPUT_POLL_TIMEOUT if running else 0)
+    return jsonify(output=ansi_to_html(output) if output else "", offset=offset,
+                   done=not running)
+
+
 @blueprint.route("/dashboard/build_now/", methods=["POST"])
 @_require_login
 def build_now():
@@ -235,7 +295,7 @@ def build_now():
     if now_compare(assignment.not_visible_before, assignment.cannot_build_after) != 0:
         abort(400)
 
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         student = _get_student(c)
         user_id, _, _, login, _, _ = student
         if assignment.is_group:
@@ -256,10 +316,11 @@ def build_now():
     # would be to fulfill a request when the current user's permissions have been revoked
     # between these two transactions.
     with DbCursor() as c:
-        build_name = create_build(c, job_name, repo, branch_hash, message)
+        build_name, job = create_build_job(c, job_name, repo, branch_hash, message,
+                                           "Web interface", staff=is_ta())
 
-    job = Job(build_name, repo, "Web interface")
-    dockergrader_queue.enqueue(job)
+    if job:
+        dockergrader_queue.enqueue(job)
 
     return redirect(url_for("dashboard.builds_one", name=build_name))
 
@@ -269,7 +330,7 @@ def build_now():
 def group():
     if not config.groups_enabled:
         abort(404)
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         student = _get_student(c)
         user_id, _, _, login, _, _ = student
 
@@ -369,7 +430,7 @@ def group_respond():
                                                          "%s has been created" % group_name,
                                                          group_name=group_name,
                                                          name=name, group_members=group_members)
-                            mailer_job = mailer_queue.create(c, "send", email_payload)
+                            mailer_job = mailer_queue.create(c, "send_template", email_payload)
                             mailer_jobs.append(mailer_job)
             elif response == "reject":
                 if status not in (ACCEPTED, INVITED):
@@ -431,7 +492,7 @@ def group_create():
                                                  inviter_github=inviter_github,
                                                  invitee_name=invitee_name,
                                                  invitees=invitees)
-                    mailer_job = mailer_queue.create(c, "send", email_payload)
+                    mailer_job = mailer_queue.create(c, "send_template", email_payload)
                     mailer_jobs.append(mailer_job)
             invitation_id = get_next_autoincrementing_value(c, "group_next_invitation_id")
             for invitation_user_id in invitation_user_ids:
@@ -455,7 +516,7 @@ def group_create():
                                                      "%s has been created" % group_name,
                                                      group_name=group_name,
                                                      name=name, group_members=group_members)
-                        mailer_job = mailer_queue.create(c, "send", email_payload)
+                        mailer_job = mailer_queue.create(c, "send_template", email_payload)
                         mailer_jobs.append(mailer_job)
         if config.mailer_enabled:
             for mailer_job in mailer_jobs:
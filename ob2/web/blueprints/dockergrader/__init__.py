@@ -0,0 +1,125 @@
+import apsw
+import base64
+import json
+import logging
+from flask import Blueprint, abort, jsonify, request
+from time import time
+
+from ob2.dockergrader import dockergrader_queue
+from ob2.dockergrader.live_output import live_output
+from ob2.dockergrader.worker import fail_build, finish_build, start_build
+from ob2.util.security import has_valid_worker_signature
+
+blueprint = Blueprint("dockergrader", __name__)
+
+# How long (in seconds) a remote worker may go without renewing its lease before its build is put
+# back in the queue. Remote workers renew their lease several times per period.
+REMOTE_LEASE = 120
+
+# Requests older than this (in seconds) are rejected, so that a signed request can't be replayed
+# later on.
+MAX_REQUEST_AGE = 300
+
+
+def _get_payload():
+    """
+    Checks the signature on a request from a remote worker, and returns the JSON payload.
+
+    """
+    if not has_valid_worker_signature():
+        abort(403)
+    try:
+        payload = json.loads(request.get_data())
+        assert isinstance(payload, dict)
+        assert isinstance(payload["worker"], basestring)
+        sent = float(payload["time"])
+    except Exception:
+        abort(400)
+    if abs(time() - sent) > MAX_REQUEST_AGE:
+        abort(403)
+    return payload
+
+
+@blueprint.route("/dockergrader/claim/", methods=["POST"])
+def claim():
+    payload = _get_payload()
+    # Remote workers poll instead of waiting here, so that they do not tie up web server threads.
+    job = dockergrader_queue.dequeue(payload["worker"], timeout=0, lease=REMOTE_LEASE)
+    if job is None:
+        return ('', 204)
+    build = start_build(job.build_name)
+    if build is None:
+        return ('', 204)
+    job_name, source, commit = build
+    logging.info("Remote worker %s claimed %s" % (payload["worker"], job.build_name))
+    return jsonify(build_name=job.build_name, job_name=job_name, source=source, commit=commit,
+                   lease=REMOTE_LEASE)
+
+
+@blueprint.route("/dockergrader/heartbeat/", methods=["POST"])
+def heartbeat():
+    payload = _get_payload()
+    build_name = payload.get("build_name")
+    if not isinstance(build_name, basestring):
+        abort(400)
+    if not dockergrader_queue.renew(build_name, payload["worker"], REMOTE_LEASE):
+        abort(409)
+    if payload.get("output"):
+        try:
+            output = base64.b64decode(payload["output"])
+            offset = int(payload["output_offset"])
+        except Exception:
+            abort(400)
+        live_output.write(build_name, output, offset=offset)
+    return ('', 204)
+
+
+@blueprint.route("/dockergrader/fail/", methods=["POST"])
+def fail():
+    payload = _get_payload()
+    build_name = payload.get("build_name")
+    error_message = payload.get("error_message")
+    internal_error = bool(payload.get("internal_error"))
+    if not isinstance(build_name, basestring):
+        abort(400)
+    if not internal_error and not isinstance(error_message, basestring):
+        abort(400)
+    # Fails if the worker no longer holds the job (for example, because its lease expired)
+    try:
+        recorded = fail_build(build_name, error_message, internal_error=internal_error,
+                              worker=payload["worker"])
+    except apsw.Error:
+        logging.exception("Failed to record the failure of build %s" % build_name)
+        # The worker tries again later
+        abort(503)
+    if not recorded:
+        abort(409)
+    return ('', 204)
+
+
+@blueprint.route("/dockergrader/finish/", methods=["POST"])
+def finish():
+    payload = _get_payload()
+    build_name = payload.get("build_name")
+    if not isinstance(build_name, basestring):
+        abort(400)
+    try:
+        score = float(payload["score"])
+        build_log = buffer(base64.b64decode(payload["log"]))
+    except Exception:
+        abort(400)
+    # Fails if the worker no longer holds the job (for example, because its lease expired)
+    try:
+        recorded = finish_build(build_name, score, build_log, worker=payload["worker"])
+    except apsw.Error:
+        # The worker tries again later
+        abort(503)
+    if not recorded:
+        abort(409)
+    return ('', 204)
+
+
+@blueprint.route("/dockergrader/status/", methods=["POST"])
+def status():
+    _get_payload()
+    return jsonify(waiting=dockergrader_queue.count_waiting())
@@ -38,7 +38,7 @@ def _get_current_step():
     github = github_username()
     if not github:
         return "onboarding.log_in"
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         user = get_user_by_github(c, github)
         if not user:
             return "onboarding.student_id"
@@ -69,7 +69,7 @@ def _get_next_step(current_step):
     if step_i == len(steps) - 1:
         # This is the final step of onboarding.
         # Authenticate the user and redirect them to the dashboard.
-        with DbCursor() as c:
+        with DbCursor(read_only=True) as c:
             user = get_user_by_github(c, github_username())
         assert user
         user_id_, _, _, _, _, _ = user
@@ -201,7 +201,7 @@ def student_id():
                                              "%s Autograder Registration" % config.course_number,
                                              _attachments=attachments, name=name, login=login,
                                              inst_account_enabled=config.inst_account_enabled)
-                mailer_job = mailer_queue.create(c, "send", email_payload)
+                mailer_job = mailer_queue.create(c, "send_template", email_payload)
         if config.mailer_enabled and mailer_job:
             mailer_queue.enqueue(mailer_job)
         if not config.github_read_only_mode and github_job:
@@ -242,7 +242,7 @@ if config.student_photos_enabled:
 @_onboarding_redirect(["dashboard.index"])
 def welcome():
     github = github_username()
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         user = get_user_by_id(c, user_id())
     return render_template("onboarding/welcome.html",
                            github=github,
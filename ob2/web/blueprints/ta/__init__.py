@@ -5,10 +5,9 @@ import json
 import StringIO
 import traceback
 from collections import OrderedDict
-from flask import (Blueprint, Response, abort, flash, redirect, render_template, request, session,
-                   url_for)
+from flask import (Blueprint, Response, abort, flash, jsonify, redirect, render_template, request,
+                   session, url_for)
 from functools import wraps
-from math import sqrt
 
 import ob2.config as config
 from ob2.config import (
@@ -17,10 +16,13 @@ from ob2.config import (
 )
 from ob2.database import DbCursor
 from ob2.database.export import get_export_by_name
+from ob2.database.grade_stats import grade_stats
 from ob2.database.helpers import (
-    assign_grade_batch,
+    assign_grades_bulk,
+    get_build_log,
     get_grouplimit,
     get_next_autoincrementing_value,
+    get_page,
     get_photo,
     get_repo_owners,
     get_super,
@@ -28,27 +30,67 @@ from ob2.database.helpers import (
     get_user_by_id,
     get_user_by_login,
     get_user_by_student_id,
-    get_users_by_identifier,
-    get_valid_ambiguous_identifiers,
+    get_users_by_ids,
     modify_grouplimit,
 )
-from ob2.dockergrader import dockergrader_queue
+from ob2.database.identifier_index import identifier_index
+from ob2.dockergrader import dockergrader_queue, worker_pool
+from ob2.dockergrader.live_output import live_output
+from ob2.mailer import create_email, mailer_queue
 from ob2.util.authentication import authenticate_as_user
+from ob2.util.build_constants import IN_PROGRESS, QUEUED
 from ob2.util.config_data import get_assignment_by_name
 from ob2.util.datasets import Datasets
 from ob2.util.github_login import github_username, is_ta
 from ob2.util.security import require_csrf_token
+from ob2.util.templating import ansi_to_html
 from ob2.util.validation import (float_or_none, int_or_none, same_length, fail_validation,
                                  ValidationError, redirect_with_error)
 
 blueprint = Blueprint("ta", __name__, template_folder="templates")
 
+# How long (in seconds) a request for the output of a running build waits for new output
+OUTPUT_POLL_TIMEOUT = 15
+
 
 def _template_common():
     return {"github_username": github_username(),
             "groups_enabled": config.groups_enabled}
 
 
+def _create_grade_notifications(c, assignment, user_ids, description):
+    """
+    Creates emails that tell students about their updated grade for ASSIGNMENT, as part of the
+    transaction. The emails are inserted into the mailer queue in one batch.
+
+    Returns a list of mailer jobs, which should be passed to mailer_queue.enqueue_batch() once the
+    transaction commits.
+
+    """
+    user_ids = list(user_ids)
+    students = get_users_by_ids(c, user_ids)
+    grades = {}
+    # Stays well under SQLite's limit on the number of parameters in one statement
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        c.execute('''SELECT user, score, slipunits FROM grades
+                     WHERE assignment = ? AND user IN (%s)''' % (",".join(["?"] * len(chunk))),
+                  [assignment.name] + chunk)
+        grades.update((user_id, (score, slipunits)) for user_id, score, slipunits in c.fetchall())
+    subject = "%s grade for %s" % (config.course_number, assignment.name)
+    emails = []
+    for user_id in user_ids:
+        _, name, _, _, _, email = students[user_id]
+        if not email:
+            continue
+        score, slipunits = grades.get(user_id, (None, None))
+        emails.append(create_email("grade_released", email, subject, name=name,
+                                   assignment_name=assignment.name, score=score,
+                                   full_score=assignment.full_score, slipunits=slipunits,
+                                   description=description))
+    return mailer_queue.create_batch(c, "send_template", emails)
+
+
 def _require_ta(fn):
     @wraps(fn)
     def wrapped(*args, **kwargs):
@@ -88,8 +130,7 @@ def enter_grades_validation_data():
     assignment_names = [assignment.name for assignment in config.assignments]
     min_scores = {assignment.name: assignment.min_score for assignment in config.assignments}
     max_scores = {assignment.name: assignment.max_score for assignment in config.assignments}
-    with DbCursor() as c:
-        valid_identifiers, ambiguous_identifiers = get_valid_ambiguous_identifiers(c)
+    valid_identifiers, ambiguous_identifiers = identifier_index.get_valid_ambiguous_identifiers()
     payload = {
         "assignment_names": assignment_names,
         "min_scores": min_scores,
@@ -124,11 +165,41 @@ def enter_grades_confirm():
 
         transaction_source = github_username()
 
+        # Only step 2 sends emails. Step 1 just passes the option along.
+        notify = config.mailer_enabled and request.form.get("f_notify") == "1"
+        notification_jobs = []
+
         entries = []
         user_id_set = set()
 
+        rows = []
+        if step == 1:
+            f_students = request.form.getlist("f_student")
+            f_scores = request.form.getlist("f_score")
+            f_slipunitss = request.form.getlist("f_slipunits")
+            if not same_length(f_students, f_scores, f_slipunitss):
+                fail_validation("Different numbers of students, scores, and slip %s " +
+                                "reported. Browser bug?" % slip_unit_name_plural)
+            rows.extend(zip(f_students, f_scores, f_slipunitss))
+
+        f_csv = request.form.get("f_csv", "")
+        for row in csv.reader(StringIO.StringIO(f_csv), delimiter=",", quotechar='"'):
+            if len(row) != 3:
+                fail_validation("CSV rows must contain 3 entries")
+            rows.append(row)
+
+        # All of the identifiers are looked up at once. In step 2, they are user IDs.
+        f_students = [f_student for f_student, _, _ in rows if f_student]
+        if step == 1:
+            _, ambiguous_identifiers = identifier_index.get_valid_ambiguous_identifiers()
+            ambiguous_identifiers = set(ambiguous_identifiers)
+            students_by_identifier = identifier_index.resolve(f_students)
+
         with DbCursor() as c:
-            valid_identifiers, ambiguous_identifiers = get_valid_ambiguous_identifiers(c)
+            if step == 2:
+                ambiguous_identifiers = set()
+                user_ids = [int(f_student) for f_student in f_students if f_student.isdigit()]
+                students_by_id = get_users_by_ids(c, user_ids) if user_ids else {}
 
             def try_add(f_student, f_score, f_slipunits):
                 if not any((f_student, f_score, f_slipunits)):
@@ -140,9 +211,10 @@ def enter_grades_confirm():
                                     f_student)
                 else:
                     if step == 1:
-                        students = get_users_by_identifier(c, f_student)
+                        students = students_by_identifier.get(f_student, [])
                     elif step == 2:
-                        student = get_user_by_id(c, f_student)
+                        student = (students_by_id.get(int(f_student))
+                                   if f_student.isdigit() else None)
                         # Let the usual error handling take care of this case
                         students = [student] if student else []
                     if not students:
@@ -168,41 +240,27 @@ def enter_grades_confirm():
                         entries.append([user_id, score, slipunits])
                         user_id_set.add(user_id)
 
-            if step == 1:
-                f_students = request.form.getlist("f_student")
-                f_scores = request.form.getlist("f_score")
-                f_slipunitss = request.form.getlist("f_slipunits")
-                if not same_length(f_students, f_scores, f_slipunitss):
-                    fail_validation("Different numbers of students, scores, and slip %s " +
-                                    "reported. Browser bug?" % slip_unit_name_plural)
-                for f_student, f_score, f_slipunits in zip(f_students, f_scores, f_slipunitss):
-                    try_add(f_student, f_score, f_slipunits)
-
-            f_csv = request.form.get("f_csv", "")
-            for row in csv.reader(StringIO.StringIO(f_csv), delimiter=",", quotechar='"'):
-                if len(row) != 3:
-                    fail_validation("CSV rows must contain 3 entries")
-                try_add(*row)
+            for f_student, f_score, f_slipunits in rows:
+                try_add(f_student, f_score, f_slipunits)
 
             if not entries:
                 fail_validation("No grade or slip %s changes entered" % slip_unit_name_plural)
 
             if step == 1:
-                c.execute('''SELECT id, name, sid, login, github FROM users
-                             WHERE id IN (%s)''' % (",".join(["?"] * len(entries))),
-                          [user_id for user_id, _, _ in entries])
-                students = c.fetchall()
+                students = get_users_by_ids(c, [user_id for user_id, _, _ in entries])
                 details_user = {}
-                for user_id, name, sid, login, github in students:
+                for user_id, name, sid, login, github, _ in students.values():
                     details_user[user_id] = [name, sid, login, github]
-                c.execute('''SELECT user, score, slipunits, updated FROM grades
-                             WHERE assignment = ? AND user IN (%s)''' %
-                          (",".join(["?"] * len(entries))),
-                          [assignment.name] + [user_id for user_id, _, _ in entries])
-                grades = c.fetchall()
+                entry_user_ids = [user_id for user_id, _, _ in entries]
                 details_grade = {}
-                for user_id, score, slipunits, updated in grades:
-                    details_grade[user_id] = [score, slipunits, updated]
+                for i in range(0, len(entry_user_ids), 500):
+                    chunk = entry_user_ids[i:i + 500]
+                    c.execute('''SELECT user, score, slipunits, updated FROM grades
+                                 WHERE assignment = ? AND user IN (%s)''' %
+                              (",".join(["?"] * len(chunk))),
+                              [assignment.name] + chunk)
+                    for user_id, score, slipunits, updated in c.fetchall():
+                        details_grade[user_id] = [score, slipunits, updated]
                 entries_details = []
                 for entry in entries:
                     user_id = entry[0]
@@ -213,10 +271,11 @@ def enter_grades_confirm():
                 transaction_number = get_next_autoincrementing_value(
                     c, "enter_grades_last_transaction_number")
                 transaction_name = "enter-grades-%s" % transaction_number
-                for user_id, score, slipunits in entries:
-                    assign_grade_batch(c, [user_id], assignment.name, score, slipunits,
-                                       transaction_name, description, transaction_source,
-                                       manual=True, dont_lower=False)
+                assign_grades_bulk(c, entries, assignment.name, transaction_name, description,
+                                   transaction_source, manual=True, dont_lower=False)
+                if notify:
+                    notification_jobs = _create_grade_notifications(
+                        c, assignment, [user_id for user_id, _, _ in entries], description)
         if step == 1:
             entries_csv = StringIO.StringIO()
             entries_csv_writer = csv.writer(entries_csv, delimiter=",", quotechar='"')
@@ -228,12 +287,19 @@ def enter_grades_confirm():
                                    assignment_name=assignment.name,
                                    description=description,
                                    full_score=assignment.full_score,
+                                   mailer_enabled=config.mailer_enabled,
+                                   notify=notify,
                                    **_template_common())
         elif step == 2:
+            if notification_jobs:
+                mailer_queue.enqueue_batch(notification_jobs)
             if len(entries) == 1:
                 flash("1 grade committed", "success")
             else:
                 flash("%d grades committed" % len(entries), "success")
+            if notification_jobs:
+                flash("%d students will be notified by email" % len(notification_jobs),
+                      "success")
             return redirect(url_for("ta.enter_grades"))
     except ValidationError as e:
         return redirect_with_error(url_for("ta.enter_grades"), e)
@@ -242,7 +308,7 @@ def enter_grades_confirm():
 @blueprint.route("/ta/students/")
 @_require_ta
 def students():
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute('''SELECT id, name, sid, login, github, email, super
                      FROM users ORDER BY super DESC, login''')
         students = c.fetchall()
@@ -260,7 +326,7 @@ def students():
 @blueprint.route("/ta/students/student_id/<int:identifier>/", defaults={"type_": "student_id"})
 @_require_ta
 def students_one(identifier, type_):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         student = None
         if type_ in ("id", "user_id"):
             student = get_user_by_id(c, identifier)
@@ -351,45 +417,73 @@ def modify_grouplimit_now():
 def builds(page):
     page_size = 50
     page = max(1, page)
-    with DbCursor() as c:
-        c.execute('''SELECT build_name, source, status, score, `commit`, message, job, started
-                     FROM builds ORDER BY started DESC LIMIT ? OFFSET ?''',
-                  [page_size + 1, (page - 1) * page_size])
-        builds = c.fetchall()
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    if page > 1 and after is None and before is None:
+        return redirect(url_for("ta.builds"))
+    if after is not None and before is not None:
+        abort(400)
+    with DbCursor(read_only=True) as c:
+        builds, prev_cursor, next_cursor = get_page(
+            c, "build_name, source, status, score, `commit`, message, job, started", "builds",
+            "started", page_size, after=after, before=before)
         if not builds and page > 1:
             abort(404)
-        more_pages = len(builds) == page_size + 1
-        if more_pages:
-            builds = builds[:-1]
         full_scores = {assignment.name: assignment.full_score
                        for assignment in config.assignments}
         builds_info = (build + (full_scores.get(build[6]),) for build in builds)
     return render_template("ta/builds.html",
                            builds_info=builds_info,
                            page=page,
-                           more_pages=more_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            **_template_common())
 
 
 @blueprint.route("/ta/builds/<name>/")
 @_require_ta
 def builds_one(name):
-    with DbCursor() as c:
-        c.execute('''SELECT build_name, status, score, source, `commit`, message, job, started,
-                     log FROM builds WHERE build_name = ? LIMIT 1''', [name])
+    with DbCursor(read_only=True) as c:
+        c.execute('''SELECT build_name, status, score, source, `commit`, message, job, started
+                     FROM builds WHERE build_name = ? LIMIT 1''', [name])
         build = c.fetchone()
         if not build:
             abort(404)
-        build_info = build + (get_assignment_by_name(build[6]).full_score,)
+        build_info = build + (get_build_log(c, name),
+                              get_assignment_by_name(build[6]).full_score)
     return render_template("ta/builds_one.html",
                            build_info=build_info,
                            **_template_common())
 
 
+@blueprint.route("/ta/builds/<name>/output.json")
+@require_csrf_token
+@_require_ta
+def builds_one_output_json(name):
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+    except ValueError:
+        abort(400)
+    with DbCursor(read_only=True) as c:
+        c.execute("SELECT status FROM builds WHERE build_name = ? LIMIT 1", [name])
+        build = c.fetchone()
+        if not build:
+            abort(404)
+    status, = build
+    running = status in (QUEUED, IN_PROGRESS)
+    # While the build is running, the request waits a little while for new output. The page is
+    # done once the database has the result of the build (which is saved before the output is
+    # marked as finished), so that reloading it shows the result.
+    output, offset, _ = live_output.read(name, offset,
+                                         timeout=OUTPUT_POLL_TIMEOUT if running else 0)
+    return jsonify(output=ansi_to_html(output) if output else "", offset=offset,
+                   done=not running)
+
+
 @blueprint.route("/ta/assignments/")
 @_require_ta
 def assignments():
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute('''SELECT assignment, count(*) FROM grades WHERE score IS NOT NULL
                      GROUP BY assignment''')
         counts_by_assignment = dict(c.fetchall())
@@ -412,49 +506,45 @@ def assignments():
 @_require_ta
 def assignments_one(name, page):
     page_size = 50
+    page = max(1, page)
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
     assignment = get_assignment_by_name(name)
 
     if not assignment:
         abort(404)
+    if page > 1 and after is None and before is None:
+        return redirect(url_for("ta.assignments_one", name=name))
+    if after is not None and before is not None:
+        abort(400)
 
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute('''SELECT id, name, sid, github, email, super, score, slipunits, updated
                      FROM grades LEFT JOIN users ON grades.user = users.id
                      WHERE assignment = ? ORDER BY super DESC, login''', [name])
         grades = c.fetchall()
-        c.execute('''SELECT build_name, source, status, score, `commit`, message, started
-                     FROM builds WHERE job = ? ORDER BY started DESC LIMIT ? OFFSET ?''',
-                  [name, page_size + 1, (page - 1) * page_size])
-        builds = c.fetchall()
+        builds, prev_cursor, next_cursor = get_page(
+            c, "build_name, source, status, score, `commit`, message, started", "builds",
+            "started", page_size, where="builds.job = ?", args=[name], after=after,
+            before=before)
         if not builds and page > 1:
             abort(404)
-        more_pages = len(builds) == page_size + 1
-        if more_pages:
-            builds = builds[:-1]
-        c.execute('''SELECT COUNT(*), AVG(score) FROM grades
-                     WHERE assignment = ? AND score IS NOT NULL''', [name])
-        stats = c.fetchone()
-        if stats[0] == 0:
-            variance = None
-            stddev = None
-        else:
-            c.execute("SELECT AVG((score - ?) * (score - ?)) FROM grades WHERE assignment = ?",
-                      [stats[1], stats[1], name])
-            variance, = c.fetchone()
-            stddev = sqrt(variance)
+        # (count, mean, standard deviation)
+        stats = grade_stats.get_summary(c, name)
 
     assignment_info = ((assignment.name, assignment.full_score, assignment.min_score,
                         assignment.max_score, assignment.weight, assignment.due_date,
                         assignment.category, assignment.is_group, assignment.manual_grading,
                         assignment.not_visible_before, assignment.cannot_build_after,
                         assignment.start_auto_building, assignment.end_auto_building) +
-                       stats + (stddev,))
+                       stats)
     return render_template("ta/assignments_one.html",
                            grades=grades,
                            builds=builds,
                            assignment_info=assignment_info,
                            page=page,
-                           more_pages=more_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            **_template_common())
 
 
@@ -462,7 +552,7 @@ def assignments_one(name, page):
 @require_csrf_token
 @_require_ta
 def assignments_one_grade_distribution(name):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         data = Datasets.grade_distribution(c, name)
     if not data:
         abort(404)
@@ -475,7 +565,7 @@ def assignments_one_grade_distribution(name):
 @require_csrf_token
 @_require_ta
 def assignments_one_timeseries_grade_percentiles(name):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         data = Datasets.timeseries_grade_percentiles(c, name)
     if not data:
         abort(404)
@@ -487,7 +577,7 @@ def assignments_one_timeseries_grade_percentiles(name):
 @blueprint.route("/ta/repo/<repo>/")
 @_require_ta
 def repo(repo):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         owners = get_repo_owners(c, repo)
         if not owners:
             abort(404)
@@ -514,32 +604,35 @@ def repo(repo):
 def gradeslog(page):
     page_size = 50
     page = max(1, page)
-    with DbCursor() as c:
-        c.execute('''SELECT gradeslog.transaction_name, gradeslog.source, users.id, users.name,
-                     users.github, users.super, gradeslog.assignment, gradeslog.score,
-                     gradeslog.slipunits, gradeslog.updated, gradeslog.description
-                     FROM gradeslog LEFT JOIN users ON gradeslog.user = users.id
-                     ORDER BY updated DESC LIMIT ? OFFSET ?''',
-                  [page_size + 1, (page - 1) * page_size])
-        entries = c.fetchall()
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    if page > 1 and after is None and before is None:
+        return redirect(url_for("ta.gradeslog"))
+    if after is not None and before is not None:
+        abort(400)
+    with DbCursor(read_only=True) as c:
+        entries, prev_cursor, next_cursor = get_page(
+            c, '''gradeslog.transaction_name, gradeslog.source, users.id, users.name, users.github,
+                  users.super, gradeslog.assignment, gradeslog.score, gradeslog.slipunits,
+                  gradeslog.updated, gradeslog.description''',
+            "gradeslog", "updated", page_size, joins="LEFT JOIN users ON gradeslog.user = users.id",
+            after=after, before=before)
         if not entries and page > 1:
             abort(404)
-        more_pages = len(entries) == page_size + 1
-        if more_pages:
-            entries = entries[:-1]
     full_scores = {assignment.name: assignment.full_score for assignment in config.assignments}
     events = [entry + (full_scores.get(entry[6]),) for entry in entries]
     return render_template("ta/gradeslog.html",
                            events=events,
                            page=page,
-                           more_pages=more_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            **_template_common())
 
 
 @blueprint.route("/ta/gradeslog/<name>/")
 @_require_ta
 def gradeslog_one(name):
-    with DbCursor() as c:
+    with DbCursor(read_only=True) as c:
         c.execute('''SELECT gradeslog.transaction_name, gradeslog.source, users.id, users.name,
                      users.github, users.super, gradeslog.assignment, gradeslog.score,
                      gradeslog.slipunits, gradeslog.updated, gradeslog.description
@@ -622,12 +715,35 @@ def sql():
 def queue_status():
     queue_workers = dockergrader_queue.probe_workers()
     queue_jobs = dockergrader_queue.snapshot()
+    pool_size, pool_running = worker_pool.get_size()
     return render_template("ta/queue_status.html",
                            queue_workers=queue_workers,
                            queue_jobs=queue_jobs,
+                           pool_size=pool_size,
+                           pool_running=pool_running,
+                           pool_max_size=config.dockergrader_max_workers,
+                           pool_autoscale=config.dockergrader_autoscale,
                            **_template_common())
 
 
+@blueprint.route("/ta/queue_status/workers/", methods=["POST"])
+@_require_ta
+def queue_status_workers():
+    try:
+        try:
+            num_workers = int(request.form.get("f_num_workers"))
+        except (TypeError, ValueError):
+            fail_validation("Number of workers must be an integer")
+        if not 0 <= num_workers <= config.dockergrader_max_workers:
+            fail_validation("Number of workers must be between 0 and %d" %
+                            config.dockergrader_max_workers)
+        worker_pool.set_size(num_workers)
+        flash("Number of workers has been set to %d" % num_workers, "success")
+    except ValidationError as e:
+        return redirect_with_error(url_for("ta.queue_status"), e)
+    return redirect(url_for("ta.queue_status"))
+
+
 @blueprint.route("/ta/queue_status/worker/<int:identifier>/")
 @_require_ta
 def queue_status_worker(identifier):
@@ -0,0 +1,29 @@
+$(document).ready(function() {
+    $(".js-ob2-build-output").each(function(_, element) {
+        var endpoint = $(element).data("endpoint");
+        var placeholder = $(element).siblings(".js-ob2-build-output-placeholder");
+        var offset = 0;
+        function poll() {
+            // The server holds each request until there is new output (or for a few seconds, if it
+            // is not too busy)
+            $.getJSON(endpoint, {"offset": offset}, function(data) {
+                if (data.output) {
+                    placeholder.hide();
+                    $(element).show().append(data.output);
+                }
+                offset = data.offset;
+                if (data.done) {
+                    // Shows the saved log and the score
+                    window.location.reload();
+                } else if (data.output) {
+                    poll();
+                } else {
+                    setTimeout(poll, 5000);
+                }
+            }).fail(function() {
+                setTimeout(poll, 10000);
+            });
+        }
+        poll();
+    });
+});
@@ -0,0 +1,33 @@
+$(document).ready(function() {
+    $(".js-ob2-build-status").each(function(_, element) {
+        var seq = $(element).data("seq");
+        var subscription = $(element).data("subscription");
+        // If this is not set, any build status change reloads the page.
+        var builds = $(element).data("builds");
+
+        function is_relevant(event) {
+            return !builds || builds.indexOf(event.build_name) != -1;
+        }
+
+        function poll() {
+            // The server holds each request until there is a status change (or for a few seconds,
+            // if it is not too busy)
+            $.getJSON($(element).data("poll"), {"after": seq, "subscription": subscription},
+                      function(data) {
+                if (!data.complete || data.events.some(is_relevant)) {
+                    window.location.reload();
+                    return;
+                }
+                seq = data.last;
+                if (data.events.length) {
+                    poll();
+                } else {
+                    setTimeout(poll, 5000);
+                }
+            }).fail(function() {
+                setTimeout(poll, 10000);
+            });
+        }
+        poll();
+    });
+});